@@ -0,0 +1,87 @@
+"""
+Micro-benchmark for actor_matches_allow(), the innermost loop of permission
+checks against "allow" blocks in configuration.
+
+Compares the current compiled implementation against the previous one that
+re-interpreted the allow block on every call:
+
+    python benchmarks/actor_matches_allow.py
+"""
+
+import timeit
+
+from datasette.utils import actor_matches_allow
+
+
+def interpreted_actor_matches_allow(actor, allow):
+    # The implementation prior to compiled allow matchers
+    if allow is True:
+        return True
+    if allow is False:
+        return False
+    if actor is None and allow and allow.get("unauthenticated") is True:
+        return True
+    if allow is None:
+        return True
+    actor = actor or {}
+    for key, values in allow.items():
+        if values == "*" and key in actor:
+            return True
+        if not isinstance(values, list):
+            values = [values]
+        actor_values = actor.get(key)
+        if actor_values is None:
+            continue
+        if not isinstance(actor_values, list):
+            actor_values = [actor_values]
+        actor_values = set(actor_values)
+        if actor_values.intersection(values):
+            return True
+    return False
+
+
+CASES = {
+    "single id": ({"id": "root"}, {"id": "root"}),
+    "id list miss": (
+        {"id": "garry"},
+        {"id": ["user{}".format(i) for i in range(50)]},
+    ),
+    "roles": (
+        {"id": "garry", "roles": ["staff", "dev"]},
+        {"bot_id": "my-bot", "roles": ["otter", "admin", "dev"]},
+    ),
+    "wildcard": ({"id": "root"}, {"id": "*"}),
+    "unauthenticated": (None, {"unauthenticated": True}),
+}
+
+
+def main(number=200_000):
+    print("{:<18} {:>14} {:>14} {:>8}".format("case", "before", "after", "speedup"))
+    for name, (actor, allow) in CASES.items():
+        assert interpreted_actor_matches_allow(actor, allow) == actor_matches_allow(
+            actor, allow
+        )
+        before = min(
+            timeit.repeat(
+                lambda: interpreted_actor_matches_allow(actor, allow),
+                number=number,
+                repeat=3,
+            )
+        )
+        after = min(
+            timeit.repeat(
+                lambda: actor_matches_allow(actor, allow), number=number, repeat=3
+            )
+        )
+        print(
+            "{:<18} {:>11.1f} ns {:>11.1f} ns {:>7.2f}x".format(
+                name,
+                before / number * 1e9,
+                after / number * 1e9,
+                before / after,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark for encoding a page of results as JSON, the way json_renderer()
+does for the default objects shape and for _shape=arrays.
+
+Compares the previous approach, which scanned every row for infinities and
+copied it before calling json.dumps(), against encode_json() with each
+available encoder:
+
+    python benchmarks/json_renderer.py
+"""
+
+import json
+import timeit
+
+from datasette.utils import CustomJSONEncoder, encode_json, orjson, remove_infinites
+from datasette.utils.sqlite import sqlite3
+
+
+def fetch_rows(count=1000):
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    return conn.execute(
+        """
+        with recursive counter(n) as (
+            select 1 union all select n + 1 from counter where n < ?
+        )
+        select
+            n as id,
+            'name ' || n as name,
+            n * 1.5 as score,
+            n % 7 = 0 as flag,
+            case when n % 3 = 0 then null else 'note ' || n end as note
+        from counter
+        """,
+        [count],
+    ).fetchall()
+
+
+def legacy(rows, shape):
+    if shape == "objects":
+        data = [remove_infinites(dict(row)) for row in rows]
+    else:
+        data = [remove_infinites(list(row)) for row in rows]
+    return json.dumps({"ok": True, "rows": data}, cls=CustomJSONEncoder)
+
+
+def current(rows, shape, encoder):
+    if shape == "objects":
+        data = [dict(row) for row in rows]
+    else:
+        data = rows
+    return encode_json({"ok": True, "rows": data}, encoder=encoder)
+
+
+def main(number=200):
+    rows = fetch_rows()
+    encoders = ["json"] + (["orjson"] if orjson is not None else [])
+    print(
+        "{:<10} {:<10} {:>12} {:>8}".format("shape", "encoder", "per page", "speedup")
+    )
+    for shape in ("objects", "arrays"):
+        before = min(
+            timeit.repeat(lambda: legacy(rows, shape), number=number, repeat=3)
+        )
+        print(
+            "{:<10} {:<10} {:>9.2f} ms".format(shape, "legacy", before / number * 1000)
+        )
+        for encoder in encoders:
+            assert json.loads(current(rows, shape, encoder)) == json.loads(
+                legacy(rows, shape)
+            )
+            after = min(
+                timeit.repeat(
+                    lambda: current(rows, shape, encoder), number=number, repeat=3
+                )
+            )
+            print(
+                "{:<10} {:<10} {:>9.2f} ms {:>7.2f}x".format(
+                    shape, encoder, after / number * 1000, before / after
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
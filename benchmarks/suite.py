@@ -0,0 +1,403 @@
+"""
+Benchmark suite for Datasette's core request paths.
+
+Generates synthetic databases - a large table, a wide table, a schema with
+hundreds of tables and a table with many foreign keys - then drives
+Datasette.client against the index, database, table, row, query, CSV and
+insert API pages, recording throughput and latency percentiles as JSON:
+
+    python benchmarks/suite.py --output before.json
+    git checkout my-branch
+    python benchmarks/suite.py --output after.json
+    python benchmarks/suite.py --compare before.json after.json
+
+Databases are cached between runs in --data-dir. Use --rows 10000000 for
+the full size large table, which takes a few minutes to generate the first
+time.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datasette.app import Datasette
+from datasette.utils.sqlite import sqlite3, sqlite_version
+from datasette.version import __version__
+
+NUM_CATEGORIES = 100
+WIDE_COLUMNS = 100
+MANY_TABLES = 500
+FK_TABLES = 8
+
+
+def _counter(count):
+    return (
+        "with recursive counter(n) as "
+        "(select 1 union all select n + 1 from counter where n < {})".format(int(count))
+    )
+
+
+def create_big(conn, rows):
+    conn.executescript(
+        """
+        create table categories (id integer primary key, name text);
+        create table big (
+            id integer primary key,
+            category_id integer references categories(id),
+            name text,
+            value real,
+            created text
+        );
+        create table inserts (id integer primary key, name text, value real);
+        """
+    )
+    conn.execute(
+        "{} insert into categories select n, 'Category ' || n from counter".format(
+            _counter(NUM_CATEGORIES)
+        )
+    )
+    conn.execute(
+        """
+        {} insert into big
+        select
+            n,
+            1 + n % {},
+            'Item ' || n,
+            (n * 7919 % 10000) / 100.0,
+            date('2020-01-01', '+' || (n % 1500) || ' days')
+        from counter
+        """.format(
+            _counter(rows), NUM_CATEGORIES
+        )
+    )
+
+
+def create_wide(conn, rows):
+    columns = ["c{}".format(i) for i in range(WIDE_COLUMNS)]
+    conn.execute(
+        "create table wide (id integer primary key, {})".format(
+            ", ".join("{} text".format(column) for column in columns)
+        )
+    )
+    conn.execute(
+        "{} insert into wide select n, {} from counter".format(
+            _counter(rows),
+            ", ".join("'{} ' || n".format(column) for column in columns),
+        )
+    )
+
+
+def create_many_tables(conn, rows):
+    for i in range(MANY_TABLES):
+        conn.execute(
+            "create table t{} (id integer primary key, name text, value integer)".format(
+                i
+            )
+        )
+        conn.execute(
+            "{} insert into t{} select n, 'Row ' || n, n from counter".format(
+                _counter(rows), i
+            )
+        )
+
+
+def create_fks(conn, rows):
+    for i in range(FK_TABLES):
+        conn.execute(
+            "create table lookup{} (id integer primary key, label text)".format(i)
+        )
+        conn.execute(
+            "{} insert into lookup{} select n, 'Label {} ' || n from counter".format(
+                _counter(NUM_CATEGORIES), i, i
+            )
+        )
+    conn.execute(
+        "create table facts (id integer primary key, {})".format(
+            ", ".join(
+                "lookup{i}_id integer references lookup{i}(id)".format(i=i)
+                for i in range(FK_TABLES)
+            )
+        )
+    )
+    conn.execute(
+        "{} insert into facts select n, {} from counter".format(
+            _counter(rows),
+            ", ".join(
+                "1 + (n * {}) % {}".format(i + 1, NUM_CATEGORIES)
+                for i in range(FK_TABLES)
+            ),
+        )
+    )
+
+
+DATABASES = {
+    # name: (create function, function of --rows giving the row count)
+    "big": (create_big, lambda rows: rows),
+    "wide": (create_wide, lambda rows: max(rows // 100, 1000)),
+    "many_tables": (create_many_tables, lambda rows: 10),
+    "fks": (create_fks, lambda rows: max(rows // 10, 1000)),
+}
+
+
+def create_databases(data_dir, rows):
+    data_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, (create, row_count) in DATABASES.items():
+        count = row_count(rows)
+        path = data_dir / "{}.db".format(name)
+        marker = data_dir / "{}.rows".format(name)
+        if not marker.exists() or marker.read_text() != str(count):
+            if path.exists():
+                path.unlink()
+            print("Creating {} with {:,} rows".format(path, count), file=sys.stderr)
+            conn = sqlite3.connect(str(path))
+            with conn:
+                create(conn, count)
+            conn.close()
+            marker.write_text(str(count))
+        paths.append(str(path))
+    return paths
+
+
+def cases(rows):
+    sql = "select category_id, count(*) from big group by category_id"
+    return {
+        "index": ("GET", "/", None),
+        "database": ("GET", "/big", None),
+        "database_many_tables": ("GET", "/many_tables", None),
+        "table": ("GET", "/big/big", None),
+        "table_json": ("GET", "/big/big.json", None),
+        "table_facets": ("GET", "/big/big?_facet=category_id", None),
+        "table_filters": (
+            "GET",
+            "/big/big.json?category_id=7&value__gt=50&_sort_desc=created",
+            None,
+        ),
+        "table_labels": ("GET", "/fks/facts.json?_labels=on", None),
+        "table_wide": ("GET", "/wide/wide", None),
+        "table_next_page": ("GET", "/big/big.json?_next={}".format(rows // 2), None),
+        "row": ("GET", "/big/big/{}".format(rows // 2), None),
+        "row_fks": ("GET", "/fks/facts/1", None),
+        "query": ("GET", "/big/-/query.json?sql=" + sql.replace(" ", "+"), None),
+        "csv_stream": (
+            "GET",
+            "/big/big.csv?_stream=on&_size=max&category_id=3",
+            None,
+        ),
+        "insert": (
+            "POST",
+            "/big/inserts/-/insert",
+            {"rows": [{"name": "Inserted", "value": 1.5} for _ in range(10)]},
+        ),
+    }
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_case(ds, method, path, body, headers, requests, concurrency, warmup):
+    async def request():
+        start = time.perf_counter()
+        if method == "POST":
+            response = await ds.client.post(path, json=body, headers=headers)
+        else:
+            response = await ds.client.get(path, headers=headers)
+        return time.perf_counter() - start, response.status_code
+
+    for _ in range(warmup):
+        await request()
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            duration, status = await request()
+            latencies.append(duration)
+            if status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    paths = create_databases(pathlib.Path(args.data_dir), args.rows)
+    ds = Datasette(
+        paths,
+        settings={"num_sql_threads": args.threads},
+        config={"permissions": {"insert-row": {"id": "benchmark"}}},
+    )
+    await ds.invoke_startup()
+    headers = {
+        "Authorization": "Bearer {}".format(ds.create_token("benchmark")),
+    }
+    selected = cases(args.rows)
+    if args.only:
+        selected = {name: selected[name] for name in args.only}
+    results = {}
+    for name, (method, path, body) in selected.items():
+        result = await run_case(
+            ds,
+            method,
+            path,
+            body,
+            headers,
+            args.requests,
+            args.concurrency,
+            args.warmup,
+        )
+        results[name] = result
+        print(
+            "{:<22} {:>9.1f} req/s  p50 {:>8.2f} ms  p99 {:>8.2f} ms{}".format(
+                name,
+                result["throughput_rps"],
+                result["p50_ms"],
+                result["p99_ms"],
+                "  ({} errors)".format(result["errors"]) if result["errors"] else "",
+            ),
+            file=sys.stderr,
+        )
+    return {
+        "datasette_version": __version__,
+        "git_commit": git_commit(),
+        "python_version": platform.python_version(),
+        "sqlite_version": ".".join(map(str, sqlite_version())),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "options": {
+            "rows": args.rows,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "threads": args.threads,
+        },
+        "results": results,
+    }
+
+
+def compare(before_path, after_path, threshold):
+    "Print the change for each case, returning True if any p50 regressed"
+    before = json.loads(pathlib.Path(before_path).read_text())
+    after = json.loads(pathlib.Path(after_path).read_text())
+    print(
+        "{:<22} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+            "case",
+            "p50 before",
+            "p50 after",
+            "change",
+            "p99 before",
+            "p99 after",
+            "change",
+        )
+    )
+    regressed = False
+    for name, new in after["results"].items():
+        old = before["results"].get(name)
+        if old is None:
+            continue
+        p50_change = (new["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100
+        p99_change = (new["p99_ms"] - old["p99_ms"]) / old["p99_ms"] * 100
+        flag = ""
+        if p50_change > threshold:
+            regressed = True
+            flag = "  REGRESSION"
+        print(
+            "{:<22} {:>10.2f} {:>10.2f} {:>+7.1f}% {:>10.2f} {:>10.2f} {:>+7.1f}%{}".format(
+                name,
+                old["p50_ms"],
+                new["p50_ms"],
+                p50_change,
+                old["p99_ms"],
+                new["p99_ms"],
+                p99_change,
+                flag,
+            )
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BEFORE", "AFTER"),
+        help="Compare two results files instead of running the benchmarks",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="Percentage p50 slowdown reported as a regression by --compare",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "datasette-benchmarks"),
+        help="Directory to create and cache the benchmark databases in",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=100_000, help="Rows in the large table"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Requests to time for each case"
+    )
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed requests first")
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="Requests to run at the same time"
+    )
+    parser.add_argument("--threads", type=int, default=3, help="num_sql_threads")
+    parser.add_argument(
+        "--only", nargs="+", metavar="CASE", help="Only run these cases"
+    )
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    if args.only:
+        unknown = set(args.only) - set(cases(args.rows))
+        if unknown:
+            parser.error("Unknown cases: {}".format(", ".join(sorted(unknown))))
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,5 +4,6 @@ from datasette.events import Event  # noqa
 from datasette.utils.asgi import Forbidden, NotFound, Request, Response  # noqa
 from datasette.utils import actor_matches_allow  # noqa
 from datasette.views import Context  # noqa
+from .hookspecs import cacheable  # noqa
 from .hookspecs import hookimpl  # noqa
 from .hookspecs import hookspec  # noqa
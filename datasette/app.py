@@ -8,7 +8,6 @@ import datetime
 import functools
 import glob
 import hashlib
-import httpx
 import importlib.metadata
 import inspect
 from itsdangerous import BadSignature
@@ -49,6 +48,10 @@ from .views.special import (
     AllowDebugView,
     PermissionsDebugView,
     MessagesDebugView,
+    IndexAdviceView,
+    MetricsView,
+    SlowQueriesView,
+    TracesView,
 )
 from .views.table import (
     TableInsertView,
@@ -62,6 +65,7 @@ from .url_builder import Urls
 from .database import Database, QueryInterrupted
 
 from .utils import (
+    JSON_ENCODERS,
     PrefixedUrlString,
     SPATIALITE_FUNCTIONS,
     StartupError,
@@ -77,6 +81,7 @@ from .utils import (
     module_from_path,
     move_plugins_and_allow,
     move_table_config,
+    orjson,
     parse_metadata,
     resolve_env_secrets,
     resolve_routes,
@@ -87,6 +92,7 @@ from .utils import (
     row_sql_params_pks,
 )
 from .utils.asgi import (
+    AsgiCompression,
     AsgiLifespan,
     Forbidden,
     NotFound,
@@ -100,13 +106,24 @@ from .utils.asgi import (
     asgi_send,
     asgi_send_file,
     asgi_send_redirect,
+    current_request_path,
 )
 from .utils.internal_db import init_internal_db, populate_schema_tables
 from .utils.sqlite import (
     sqlite3,
     using_pysqlite3,
 )
-from .tracer import AsgiTracer
+from .index_advisor import IndexAdvisor
+from .inspect import HASH_STRATEGIES, blake3, xxhash
+from .metrics import CacheStats, Metrics
+from .startup_snapshot import (
+    TemplateBytecodeCache,
+    load_snapshot_catalog,
+    snapshot_databases,
+    snapshot_is_current,
+    snapshot_templates,
+)
+from .tracer import AsgiSampledTracer, AsgiTracer
 from .plugins import pm, DEFAULT_PLUGINS, get_plugins
 from .version import __version__
 
@@ -153,6 +170,11 @@ SETTINGS = (
         True,
         "Allow users to download the original SQLite database files",
     ),
+    Setting(
+        "allow_snapshot_download",
+        False,
+        "Allow downloads of mutable databases, as a consistent snapshot",
+    ),
     Setting(
         "allow_signed_tokens",
         True,
@@ -180,11 +202,21 @@ SETTINGS = (
         True,
         "Allow .csv?_stream=1 to download all rows (ignoring max_returned_rows)",
     ),
+    Setting(
+        "allow_json_stream",
+        True,
+        "Allow .json?_stream=1 to stream all rows (ignoring max_returned_rows)",
+    ),
     Setting(
         "max_csv_mb",
         100,
         "Maximum size allowed for CSV export in MB - set 0 to disable this limit",
     ),
+    Setting(
+        "json_encoder",
+        "json",
+        "JSON encoder for API responses: json, orjson or auto",
+    ),
     Setting(
         "truncate_cells_html",
         2048,
@@ -200,11 +232,51 @@ SETTINGS = (
         False,
         "Allow display of template debug information with ?_context=1",
     ),
+    Setting(
+        "stream_html",
+        False,
+        "Stream HTML table pages to the client while they are rendered",
+    ),
+    Setting(
+        "compress_responses",
+        False,
+        "Compress responses with gzip or brotli if the client supports it",
+    ),
+    Setting(
+        "reload_templates",
+        True,
+        "Check template files for changes on every request",
+    ),
     Setting(
         "trace_debug",
         False,
         "Allow display of SQL trace debug information with ?_trace=1",
     ),
+    Setting(
+        "slow_query_ms",
+        0,
+        "Log queries that take longer than this many ms to /-/slow-queries",
+    ),
+    Setting(
+        "trace_sample_rate",
+        0,
+        "Record span timings for one in every N requests at /-/traces.json",
+    ),
+    Setting(
+        "trace_slow_ms",
+        0,
+        "Record span timings for requests that take longer than this many ms",
+    ),
+    Setting(
+        "sql_queue_limit_ms",
+        0,
+        "Reject queries with a 503 if the expected wait for a SQL thread is longer than this",
+    ),
+    Setting(
+        "hash_strategy",
+        "sha256",
+        "How to hash immutable databases: sha256, blake3, xxhash, sampled or header",
+    ),
     Setting("base_url", "/", "Datasette URLs should use this base path"),
 )
 _HASH_URLS_REMOVED = "The hash_urls setting has been removed, try the datasette-hashed-urls plugin instead"
@@ -234,6 +306,65 @@ ResolvedRow = collections.namedtuple(
 )
 
 
+# Jinja yields many small strings, so they are sent in chunks of this size
+HTML_STREAM_CHUNK_SIZE = 16 * 1024
+
+
+async def _coalesce_chunks(chunks, size):
+    buffer = []
+    buffered = 0
+    async for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+async def _single_chunk(chunk):
+    yield chunk
+
+
+class DatasetteEnvironment(Environment):
+    """
+    Jinja environment that remembers which template was picked for each
+    list of candidate names, so select_template() does not search the
+    template directories for missing templates on every request.
+
+    Only used when auto_reload is off, since new template files should be
+    picked up while templates are being reloaded.
+    """
+
+    _SELECTED_CACHE_SIZE = 1024
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._selected_templates = {}
+        self.cache_stats = CacheStats()
+
+    def select_template(self, names, parent=None, globals=None):
+        if (
+            self.auto_reload
+            or parent is not None
+            or not isinstance(names, (list, tuple))
+        ):
+            return super().select_template(names, parent=parent, globals=globals)
+        key = tuple(names)
+        name = self._selected_templates.get(key)
+        if name is not None:
+            self.cache_stats.hits += 1
+            return self.get_template(name, globals=globals)
+        self.cache_stats.misses += 1
+        template = super().select_template(names, globals=globals)
+        if len(self._selected_templates) >= self._SELECTED_CACHE_SIZE:
+            self._selected_templates.clear()
+        self._selected_templates[key] = template.name
+        return template
+
+
 def _to_string(value):
     if isinstance(value, str):
         return value
@@ -247,6 +378,8 @@ class Datasette:
     WARNING = 2
     ERROR = 3
 
+    _ASSET_URLS_CACHE_SIZE = 1024
+
     def __init__(
         self,
         files=None,
@@ -269,6 +402,7 @@ class Datasette:
         crossdb=False,
         nolock=False,
         internal=None,
+        startup_snapshot=None,
     ):
         self._startup_invoked = False
         assert config_dir is None or isinstance(
@@ -300,6 +434,8 @@ class Datasette:
         self.immutables = set(immutables or [])
         self.databases = collections.OrderedDict()
         self.permissions = {}  # .invoke_startup() will populate this
+        self.metrics = Metrics()
+        self._index_advisor = IndexAdvisor()
         try:
             self._refresh_schemas_lock = asyncio.Lock()
         except RuntimeError as rex:
@@ -322,6 +458,15 @@ class Datasette:
                 Database(self, file, is_mutable=file not in self.immutables)
             )
 
+        if not snapshot_is_current(startup_snapshot):
+            startup_snapshot = {}
+        self._snapshot_catalogs, snapshot_inspect_data = snapshot_databases(
+            startup_snapshot, self.databases
+        )
+        if snapshot_inspect_data:
+            # Explicitly provided inspect data takes precedence
+            self.inspect_data = dict(snapshot_inspect_data, **(self.inspect_data or {}))
+
         self.internal_db_created = False
         if internal is None:
             self._internal_database = Database(self, memory_name=secrets.token_hex())
@@ -401,6 +546,27 @@ class Datasette:
         self.max_returned_rows = self.setting("max_returned_rows")
         self.sql_time_limit_ms = self.setting("sql_time_limit_ms")
         self.page_size = self.setting("default_page_size")
+        if self.setting("json_encoder") not in JSON_ENCODERS:
+            raise StartupError(
+                "json_encoder setting must be one of: {}".format(
+                    ", ".join(JSON_ENCODERS)
+                )
+            )
+        if self.setting("json_encoder") == "orjson" and orjson is None:
+            raise StartupError("json_encoder=orjson requires the orjson package")
+        hash_strategy = self.setting("hash_strategy")
+        if hash_strategy not in HASH_STRATEGIES:
+            raise StartupError(
+                "hash_strategy setting must be one of: {}".format(
+                    ", ".join(HASH_STRATEGIES)
+                )
+            )
+        if (hash_strategy == "blake3" and blake3 is None) or (
+            hash_strategy == "xxhash" and xxhash is None
+        ):
+            raise StartupError(
+                "hash_strategy={0} requires the {0} package".format(hash_strategy)
+            )
         # Execute plugins in constructor, to ensure they are available
         # when the rest of `datasette inspect` executes
         if self.plugins_dir:
@@ -435,19 +601,27 @@ class Datasette:
                 ),
             ]
         )
-        environment = Environment(
+        environment = DatasetteEnvironment(
             loader=template_loader,
             autoescape=True,
             enable_async=True,
+            auto_reload=self.setting("reload_templates"),
+            bytecode_cache=TemplateBytecodeCache(snapshot_templates(startup_snapshot)),
             # undefined=StrictUndefined,
         )
         environment.filters["escape_css_string"] = escape_css_string
         environment.filters["quote_plus"] = urllib.parse.quote_plus
         self._jinja_env = environment
+        self.metrics.caches["templates"] = environment.cache_stats
         environment.filters["escape_sqlite"] = escape_sqlite
         environment.filters["to_css_class"] = to_css_class
         self._register_renderers()
         self._permission_checks = collections.deque(maxlen=200)
+        self._sampled_traces = collections.deque(maxlen=100)
+        self._asset_urls_cache = {}
+        # hook name => (implementations, callers) from _asset_url_callers()
+        self._asset_url_callers_cache = {}
+        self._asset_urls_cache_stats = self.metrics.cache_stats("asset_urls")
         self._root_token = secrets.token_hex(32)
         self.client = DatasetteClient(self)
 
@@ -519,6 +693,8 @@ class Datasette:
         if not self.internal_db_created:
             await init_internal_db(internal_db)
             await self.apply_metadata_json()
+            if self._snapshot_catalogs:
+                await load_snapshot_catalog(internal_db, self._snapshot_catalogs)
             self.internal_db_created = True
         current_schema_versions = {
             row["database_name"]: row["schema_version"]
@@ -587,6 +763,8 @@ class Datasette:
             await await_me_maybe(hook)
         for hook in pm.hook.startup(datasette=self):
             await await_me_maybe(hook)
+        for db in self.databases.values():
+            db.hash_in_background()
         self._startup_invoked = True
 
     def sign(self, value, namespace="default"):
@@ -1284,6 +1462,26 @@ class Datasette:
                 {"name": t.name, "ident": t.ident, "daemon": t.daemon} for t in threads
             ],
         }
+        metrics = self.metrics
+        recent_waits = list(metrics.recent_queue_waits)
+        d["executor"] = {
+            "max_threads": self.setting("num_sql_threads"),
+            "in_flight": metrics.executor_in_flight,
+            "queue_depth": self.executor._work_queue.qsize(),
+            "expected_queue_wait_ms": metrics.expected_queue_wait(
+                self.setting("num_sql_threads")
+            )
+            * 1000,
+            "recent_queue_wait_ms": {
+                "count": len(recent_waits),
+                "mean": (
+                    sum(recent_waits) / len(recent_waits) * 1000
+                    if recent_waits
+                    else None
+                ),
+                "max": max(recent_waits) * 1000 if recent_waits else None,
+            },
+        }
         tasks = asyncio.all_tasks()
         d.update(
             {
@@ -1336,6 +1534,43 @@ class Datasette:
     ):
         if not self._startup_invoked:
             raise Exception("render_template() called before await ds.invoke_startup()")
+        template, template_context = await self._template_and_context(
+            templates, context, request, view_name
+        )
+        if request and request.args.get("_context") and self.setting("template_debug"):
+            return self._template_context_debug(template_context)
+        return await template.render_async(template_context)
+
+    async def render_template_stream(
+        self,
+        templates: Union[List[str], str, Template],
+        context: Optional[Union[Dict[str, Any], Context]] = None,
+        request: Optional[Request] = None,
+        view_name: Optional[str] = None,
+    ):
+        """
+        Like render_template() but returns an async iterator of string chunks,
+        which can be sent to the client while the rest of the page renders.
+        """
+        if not self._startup_invoked:
+            raise Exception(
+                "render_template_stream() called before await ds.invoke_startup()"
+            )
+        template, template_context = await self._template_and_context(
+            templates, context, request, view_name
+        )
+        if request and request.args.get("_context") and self.setting("template_debug"):
+            return _single_chunk(self._template_context_debug(template_context))
+        return _coalesce_chunks(
+            template.generate_async(template_context), HTML_STREAM_CHUNK_SIZE
+        )
+
+    def _template_context_debug(self, template_context):
+        return "<pre>{}</pre>".format(
+            escape(json.dumps(template_context, default=repr, indent=4))
+        )
+
+    async def _template_and_context(self, templates, context, request, view_name):
         context = context or {}
         if isinstance(templates, Template):
             template = templates
@@ -1423,27 +1658,24 @@ class Datasette:
             },
             **extra_template_vars,
         }
-        if request and request.args.get("_context") and self.setting("template_debug"):
-            return "<pre>{}</pre>".format(
-                escape(json.dumps(template_context, default=repr, indent=4))
-            )
-
-        return await template.render_async(template_context)
+        return template, template_context
 
     async def _asset_urls(self, key, template, context, request, view_name):
         # Flatten list-of-lists from plugins:
         seen_urls = set()
         collected = []
-        for hook in getattr(pm.hook, key)(
-            template=template.name,
-            database=context.get("database"),
-            table=context.get("table"),
-            columns=context.get("columns"),
-            view_name=view_name,
-            request=request,
-            datasette=self,
+        for hook in await self._plugin_asset_urls(
+            key,
+            dict(
+                template=template.name,
+                database=context.get("database"),
+                table=context.get("table"),
+                columns=context.get("columns"),
+                view_name=view_name,
+                request=request,
+                datasette=self,
+            ),
         ):
-            hook = await await_me_maybe(hook)
             collected.extend(hook)
         collected.extend((self.config or {}).get(key) or [])
         output = []
@@ -1470,6 +1702,88 @@ class Datasette:
             output.append(script)
         return output
 
+    def _asset_url_callers(self, key):
+        """
+        Returns [(cacheable_function, caller), ...] for the implementations of
+        this hook in the order pluggy calls them, or None if nothing can be
+        cached. cacheable_function is None for runs of implementations that
+        are not marked with @cacheable, which share a single caller.
+        """
+        hookimpls = tuple(getattr(pm.hook, key).get_hookimpls())
+        cached = self._asset_url_callers_cache.get(key)
+        if cached is not None and cached[0] == hookimpls:
+            return cached[1]
+        callers = None
+        if any(
+            getattr(hookimpl.function, "_datasette_cacheable", False)
+            for hookimpl in hookimpls
+        ) and not any(
+            getattr(hookimpl, "hookwrapper", False)
+            or getattr(hookimpl, "wrapper", False)
+            for hookimpl in hookimpls
+        ):
+            groups = []
+            # Same order that pluggy calls them in
+            for hookimpl in reversed(hookimpls):
+                if getattr(hookimpl.function, "_datasette_cacheable", False):
+                    groups.append((hookimpl.function, [hookimpl]))
+                elif groups and groups[-1][0] is None:
+                    groups[-1][1].append(hookimpl)
+                else:
+                    groups.append((None, [hookimpl]))
+            callers = [
+                (
+                    function,
+                    # Calls just these implementations, still through pluggy
+                    pm.subset_hook_caller(
+                        key,
+                        [
+                            hookimpl.plugin
+                            for hookimpl in hookimpls
+                            if hookimpl not in group
+                        ],
+                    ),
+                )
+                for function, group in groups
+            ]
+        self._asset_url_callers_cache[key] = (hookimpls, callers)
+        return callers
+
+    async def _plugin_asset_urls(self, key, kwargs):
+        # Results are cached for implementations marked with @cacheable, by
+        # every argument they could depend on other than request or datasette
+        callers = self._asset_url_callers(key)
+        if callers is None:
+            hook_caller = getattr(pm.hook, key)
+            return [await await_me_maybe(hook) for hook in hook_caller(**kwargs)]
+        results = []
+        for function, caller in callers:
+            cache_key = None
+            if function is not None:
+                cache_key = (function,) + tuple(
+                    tuple(value) if isinstance(value, list) else value
+                    for name, value in kwargs.items()
+                    if name not in ("request", "datasette")
+                )
+                try:
+                    cached = self._asset_urls_cache[cache_key]
+                except KeyError:
+                    self._asset_urls_cache_stats.misses += 1
+                except TypeError:
+                    # Unhashable argument
+                    cache_key = None
+                else:
+                    self._asset_urls_cache_stats.hits += 1
+                    results.extend(cached)
+                    continue
+            result = [await await_me_maybe(hook) for hook in caller(**kwargs)]
+            if cache_key is not None:
+                if len(self._asset_urls_cache) >= self._ASSET_URLS_CACHE_SIZE:
+                    self._asset_urls_cache.clear()
+                self._asset_urls_cache[cache_key] = result
+            results.extend(result)
+        return results
+
     def _config(self):
         return redact_keys(
             self.config, ("secret", "key", "password", "token", "hash", "dsn")
@@ -1492,7 +1806,8 @@ class Datasette:
         add_route(favicon, "/favicon.ico")
 
         add_route(
-            asgi_static(app_root / "datasette" / "static"), r"/-/static/(?P<path>.*)$"
+            asgi_static(app_root / "datasette" / "static", immutable=True),
+            r"/-/static/(?P<path>.*)$",
         )
         for path, dirname in self.static_mounts:
             add_route(asgi_static(dirname), r"/" + path + "/(?P<path>.*)$")
@@ -1539,6 +1854,22 @@ class Datasette:
             JsonDataView.as_view(self, "threads.json", self._threads),
             r"/-/threads(\.(?P<format>json))?$",
         )
+        add_route(
+            TracesView.as_view(self),
+            r"/-/traces(\.(?P<format>json))?$",
+        )
+        add_route(
+            SlowQueriesView.as_view(self),
+            r"/-/slow-queries(\.(?P<format>json))?$",
+        )
+        add_route(
+            IndexAdviceView.as_view(self),
+            r"/-/index-advice(\.(?P<format>json))?$",
+        )
+        add_route(
+            MetricsView.as_view(self),
+            r"/-/metrics$",
+        )
         add_route(
             JsonDataView.as_view(self, "databases.json", self._connected_databases),
             r"/-/databases(\.(?P<format>json))?$",
@@ -1689,10 +2020,20 @@ class Datasette:
         )
         if self.setting("trace_debug"):
             asgi = AsgiTracer(asgi)
+        if self.setting("trace_sample_rate") or self.setting("trace_slow_ms"):
+            asgi = AsgiSampledTracer(
+                asgi,
+                self._sampled_traces,
+                sample_rate=self.setting("trace_sample_rate"),
+                slow_ms=self.setting("trace_slow_ms"),
+            )
         asgi = AsgiLifespan(asgi)
         asgi = AsgiRunOnFirstRequest(asgi, on_startup=[setup_db, self.invoke_startup])
         for wrapper in pm.hook.asgi_wrapper(datasette=self):
             asgi = wrapper(asgi)
+        if self.setting("compress_responses"):
+            # Outermost, so plugin wrappers see uncompressed responses
+            asgi = AsgiCompression(asgi)
         return asgi
 
 
@@ -1750,6 +2091,8 @@ class DatasetteRouter:
 
         new_scope = dict(scope, url_route={"kwargs": match.groupdict()})
         request.scope = new_scope
+        current_request_path.set(path)
+        start = time.perf_counter()
         try:
             response = await view(request, send)
             if response:
@@ -1770,6 +2113,10 @@ class DatasetteRouter:
                 return await custom_response.asgi_send(send)
         except Exception as exception:
             return await self.handle_exception(request, send, exception)
+        finally:
+            self.ds.metrics.request_histogram(
+                match.re.pattern, _view_name(view)
+            ).observe(time.perf_counter() - start)
 
     async def handle_404(self, request, send, exception=None):
         # If path contains % encoding, redirect to tilde encoding
@@ -1904,6 +2251,10 @@ def _cleaner_task_str(task):
     return _cleaner_task_str_re.sub("", s)
 
 
+def _view_name(view):
+    return getattr(view, "view_class", view).__name__
+
+
 def wrap_view(view_fn_or_class, datasette):
     is_function = isinstance(view_fn_or_class, types.FunctionType)
     if is_function:
@@ -2020,6 +2371,10 @@ class DatasetteClient:
         return path
 
     async def _request(self, method, path, **kwargs):
+        # Imported here as httpx is slow to import and only used by plugins
+        # and tests that make internal requests
+        import httpx
+
         async with httpx.AsyncClient(
             transport=httpx.ASGITransport(app=self.app),
             cookies=kwargs.pop("cookies", None),
@@ -2048,6 +2403,8 @@ class DatasetteClient:
         return await self._request("delete", path, **kwargs)
 
     async def request(self, method, path, **kwargs):
+        import httpx
+
         avoid_path_rewrites = kwargs.pop("avoid_path_rewrites", None)
         async with httpx.AsyncClient(
             transport=httpx.ASGITransport(app=self.app),
@@ -0,0 +1,328 @@
+from datasette import hookimpl
+from datasette.database import QueryInterrupted
+from datasette.utils import escape_sqlite, to_css_class
+from datasette.utils.asgi import Response
+import importlib.util
+import sqlite3
+
+# pyarrow is slow to import, so it is only imported the first time an Arrow
+# or Parquet file is rendered
+pyarrow_available = importlib.util.find_spec("pyarrow") is not None
+pyarrow = None
+
+
+def _import_pyarrow():
+    global pyarrow
+    if pyarrow is None:
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+
+ARROW_CONTENT_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+_MAX_INT64 = 2**63 - 1
+_MAX_EXACT_FLOAT = 2**53
+
+
+def arrow_type_for_declared_type(declared_type):
+    """
+    Arrow type for a SQLite declared column type, following SQLite's column
+    affinity rules - or None if the type should be inferred from the values
+    """
+    _import_pyarrow()
+    declared_type = (declared_type or "").upper()
+    if "INT" in declared_type:
+        return pyarrow.int64()
+    if "CHAR" in declared_type or "CLOB" in declared_type or "TEXT" in declared_type:
+        return pyarrow.string()
+    if "BLOB" in declared_type:
+        return pyarrow.binary()
+    if "REAL" in declared_type or "FLOA" in declared_type or "DOUB" in declared_type:
+        return pyarrow.float64()
+    return None
+
+
+async def declared_types_for_stream(db, table):
+    """
+    Declared types of the columns of table, for use in a streamed export.
+
+    The schema of a stream cannot change once the first page has been sent,
+    so INTEGER and REAL columns are checked for values that would not fit
+    before anything is sent, and given a wider declared type if needed.
+    """
+    _import_pyarrow()
+    declared_types = {
+        column.name: column.type for column in await db.table_column_details(table)
+    }
+    numeric_columns = [
+        column
+        for column, declared_type in declared_types.items()
+        if arrow_type_for_declared_type(declared_type)
+        in (pyarrow.int64(), pyarrow.float64())
+    ]
+    if numeric_columns:
+        checks = []
+        for column in numeric_columns:
+            escaped = escape_sqlite(column)
+            checks.extend(
+                (
+                    "max(typeof({}) in ('text', 'blob'))".format(escaped),
+                    "max(typeof({}) = 'real')".format(escaped),
+                    "max(typeof({}) = 'integer' and abs({}) > {})".format(
+                        escaped, escaped, _MAX_EXACT_FLOAT
+                    ),
+                )
+            )
+        try:
+            results = await db.execute(
+                "select {} from {}".format(", ".join(checks), escape_sqlite(table))
+            )
+            row = tuple(results.first())
+        except (QueryInterrupted, sqlite3.DatabaseError):
+            # Not worth risking a stream that cannot be finished
+            row = (1, 0, 0) * len(numeric_columns)
+        for index, column in enumerate(numeric_columns):
+            has_text, has_real, has_large_int = row[index * 3 : index * 3 + 3]
+            if has_text or (has_real and has_large_int):
+                declared_types[column] = "TEXT"
+            elif has_real:
+                declared_types[column] = "REAL"
+    # Only rowid tables without a primary key have rowid in their results
+    declared_types.setdefault("rowid", "INTEGER")
+    return declared_types
+
+
+def _infer_arrow_type(values):
+    types = {type(value) for value in values if value is not None}
+    if not types:
+        return pyarrow.string()
+    if types == {int}:
+        return pyarrow.int64()
+    if types <= {int, float}:
+        return pyarrow.float64()
+    if types == {bytes}:
+        return pyarrow.binary()
+    return pyarrow.string()
+
+
+def _widened_type(arrow_type, values):
+    """
+    SQLite columns can hold values of any type, regardless of declared type.
+    Returns arrow_type widened from int64 to float64 to string as needed to
+    hold every one of values without losing it.
+    """
+    if not (
+        pyarrow.types.is_integer(arrow_type) or pyarrow.types.is_floating(arrow_type)
+    ):
+        # Anything can be converted to a string, or encoded as binary
+        return arrow_type
+    widened = arrow_type
+    has_large_int = False
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, int):
+            has_large_int = has_large_int or abs(value) > _MAX_EXACT_FLOAT
+            continue
+        if not isinstance(value, float):
+            return pyarrow.string()
+        if not (value.is_integer() and -_MAX_INT64 - 1 <= value <= _MAX_INT64):
+            widened = pyarrow.float64()
+    if pyarrow.types.is_floating(widened) and has_large_int:
+        # These integers cannot be represented exactly as a float64
+        return pyarrow.string()
+    return widened
+
+
+def _coerce(value, arrow_type):
+    # Values have already been checked to fit arrow_type by _widened_type()
+    if value is None:
+        return None
+    if pyarrow.types.is_string(arrow_type):
+        if isinstance(value, bytes):
+            return value.decode("utf-8", "replace")
+        return str(value)
+    if pyarrow.types.is_binary(arrow_type):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode("utf-8")
+    if pyarrow.types.is_integer(arrow_type):
+        return int(value)
+    return float(value)
+
+
+class _ChunkSink:
+    # File-like object for pyarrow writers that collects written bytes so
+    # they can be sent to the client a page at a time
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ArrowEncoder:
+    """
+    Encodes pages of rows as an Arrow IPC stream or a Parquet file.
+
+    declared_types maps column names to their SQLite declared types, and
+    other columns have their type inferred from the values in rows. Columns
+    holding values that do not fit their type are widened to float64 or
+    string. Expanded foreign key columns get an extra {column}_label string
+    column, as in CSV exports.
+
+    The schema cannot change once it has been written, so with stream=True
+    it is decided without looking at any values: columns without a declared
+    type are strings, and the declared types are expected to come from
+    declared_types_for_stream(). encode() raises ValueError if a page has a
+    value that does not fit.
+    """
+
+    def __init__(
+        self,
+        format_,
+        columns,
+        rows,
+        expanded_columns=None,
+        declared_types=None,
+        stream=False,
+    ):
+        _import_pyarrow()
+        self.columns = columns
+        self.expanded_columns = set(expanded_columns or [])
+        declared_types = declared_types or {}
+        names, column_values = self._column_values(rows)
+        types = []
+        for name, values in zip(names, column_values):
+            arrow_type = None
+            if name in declared_types:
+                arrow_type = arrow_type_for_declared_type(declared_types[name])
+            if stream:
+                types.append(arrow_type or pyarrow.string())
+            else:
+                types.append(
+                    _widened_type(arrow_type or _infer_arrow_type(values), values)
+                )
+        self.schema = pyarrow.schema(list(zip(names, types)))
+        self.sink = _ChunkSink()
+        if format_ == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def _column_values(self, rows):
+        names = []
+        column_values = []
+        for index, column in enumerate(self.columns):
+            values = [row[index] for row in rows]
+            if column in self.expanded_columns:
+                names.extend((column, "{}_label".format(column)))
+                column_values.append(
+                    [v["value"] if isinstance(v, dict) else v for v in values]
+                )
+                column_values.append(
+                    [v["label"] if isinstance(v, dict) else None for v in values]
+                )
+            else:
+                names.append(column)
+                column_values.append(values)
+        return names, column_values
+
+    def encode(self, rows):
+        "Write a page of rows as a record batch, returning the bytes to send"
+        if rows:
+            arrays = []
+            for field, values in zip(self.schema, self._column_values(rows)[1]):
+                if _widened_type(field.type, values) != field.type:
+                    raise ValueError(
+                        "Column {} has values that do not fit its type of {}".format(
+                            field.name, field.type
+                        )
+                    )
+                try:
+                    array = pyarrow.array(values, type=field.type)
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+                    array = pyarrow.array(
+                        [_coerce(value, field.type) for value in values],
+                        type=field.type,
+                    )
+                arrays.append(array)
+            self.writer.write_batch(
+                pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+            )
+        return self.sink.take()
+
+    def close(self):
+        "Finish the stream or file, returning the remaining bytes to send"
+        self.writer.close()
+        return self.sink.take()
+
+
+def arrow_filename(request, format_, table=None, database=None):
+    name = table or request.url_vars.get("table") or database or "data"
+    return "{}.{}".format(to_css_class(name), format_)
+
+
+def _render(format_, datasette, request, database, table, rows, columns):
+    encoder = ArrowEncoder(format_, columns, rows)
+    body = encoder.encode(rows) + encoder.close()
+    return Response(
+        body=body,
+        content_type=ARROW_CONTENT_TYPES[format_],
+        headers={
+            "content-disposition": 'attachment; filename="{}"'.format(
+                arrow_filename(request, format_, table, database)
+            )
+        },
+    )
+
+
+def render_arrow(datasette, request, database, table, rows, columns):
+    return _render("arrow", datasette, request, database, table, rows, columns)
+
+
+def render_parquet(datasette, request, database, table, rows, columns):
+    return _render("parquet", datasette, request, database, table, rows, columns)
+
+
+ARROW_RENDERERS = {"arrow": render_arrow, "parquet": render_parquet}
+
+
+def is_arrow_format(datasette, format_):
+    "Is this format handled by these renderers, rather than a plugin?"
+    renderer = datasette.renderers.get(format_)
+    return renderer is not None and renderer[0] in ARROW_RENDERERS.values()
+
+
+# Run first, so renderers for these extensions registered by plugins win
+@hookimpl(tryfirst=True)
+def register_output_renderer():
+    if not pyarrow_available:
+        return []
+    return [
+        {"extension": format_, "render": render}
+        for format_, render in ARROW_RENDERERS.items()
+    ]
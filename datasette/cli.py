@@ -22,7 +22,6 @@ from .app import (
     pm,
 )
 from .utils import (
-    LoadExtension,
     StartupError,
     check_connection,
     deep_dict_update,
@@ -35,9 +34,11 @@ from .utils import (
     temporary_docker_directory,
     value_as_boolean,
     SpatialiteNotFound,
-    StaticMount,
     ValueAsBooleanError,
 )
+from .utils.click_types import LoadExtension, StaticMount
+from .inspect import inspect_hash
+from .startup_snapshot import create_startup_snapshot, snapshot_is_current
 from .utils.sqlite import sqlite3
 from .utils.testing import TestClient
 from .version import __version__
@@ -126,17 +127,28 @@ def cli():
 @cli.command()
 @click.argument("files", type=click.Path(exists=True), nargs=-1)
 @click.option("--inspect-file", default="-")
+@click.option(
+    "--previous",
+    type=click.File(mode="r"),
+    help="Reuse results from this inspect file for files with the same size and modification time",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    help="Number of files and tables to hash and count at once",
+)
 @sqlite_extensions
-def inspect(files, inspect_file, sqlite_extensions):
+def inspect(files, inspect_file, previous, threads, sqlite_extensions):
     """
     Generate JSON summary of provided database files
 
     This can then be passed to "datasette --inspect-file" to speed up count
     operations against immutable database files.
     """
-    app = Datasette([], immutables=files, sqlite_extensions=sqlite_extensions)
-    loop = asyncio.get_event_loop()
-    inspect_data = loop.run_until_complete(inspect_(files, sqlite_extensions))
+    previous_data = json.load(previous) if previous else None
+    inspect_data = asyncio.run(
+        inspect_(files, sqlite_extensions, previous_data, threads)
+    )
     if inspect_file == "-":
         sys.stdout.write(json.dumps(inspect_data, indent=2))
     else:
@@ -144,21 +156,101 @@ def inspect(files, inspect_file, sqlite_extensions):
             fp.write(json.dumps(inspect_data, indent=2))
 
 
-async def inspect_(files, sqlite_extensions):
-    app = Datasette([], immutables=files, sqlite_extensions=sqlite_extensions)
-    data = {}
-    for name, database in app.databases.items():
-        counts = await database.table_counts(limit=3600 * 1000)
-        data[name] = {
-            "hash": database.hash,
-            "size": database.size,
+async def inspect_(files, sqlite_extensions, previous=None, threads=None):
+    # Hashing and counting both spend most of their time in code that releases
+    # the GIL, so files and tables are processed in parallel using threads
+    app = Datasette(
+        [],
+        immutables=files,
+        sqlite_extensions=sqlite_extensions,
+        settings={"num_sql_threads": threads or min(32, (os.cpu_count() or 1) + 4)},
+    )
+    previous = previous or {}
+    loop = asyncio.get_running_loop()
+
+    async def inspect_database(name, database):
+        stat = os.stat(database.path)
+        info = previous.get(name) or {}
+        if (info.get("file"), info.get("size"), info.get("mtime_ns")) == (
+            database.path,
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return info
+        table_names = await database.table_names()
+        file_hash, *counts = await asyncio.gather(
+            loop.run_in_executor(
+                app.executor, inspect_hash, pathlib.Path(database.path)
+            ),
+            *[database.table_count(table, limit=3600 * 1000) for table in table_names],
+        )
+        return {
+            "hash": file_hash,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
             "file": database.path,
             "tables": {
                 table_name: {"count": table_count}
-                for table_name, table_count in counts.items()
+                for table_name, table_count in zip(table_names, counts)
             },
         }
-    return data
+
+    try:
+        results = await asyncio.gather(
+            *[
+                inspect_database(name, database)
+                for name, database in app.databases.items()
+            ]
+        )
+    finally:
+        app.executor.shutdown()
+    return dict(zip(app.databases.keys(), results))
+
+
+@cli.command()
+@click.argument("files", type=click.Path(exists=True), nargs=-1)
+@click.option(
+    "-i",
+    "--immutable",
+    type=click.Path(exists=True),
+    help="Database files to open in immutable mode",
+    multiple=True,
+)
+@click.option("--snapshot-file", default="-")
+@sqlite_extensions
+@click.option(
+    "--template-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="Path to directory containing custom templates",
+)
+@click.option(
+    "--plugins-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="Path to directory containing custom plugins",
+)
+def snapshot(
+    files, immutable, snapshot_file, sqlite_extensions, template_dir, plugins_dir
+):
+    """
+    Generate JSON snapshot of the work Datasette does at startup
+
+    This can then be passed to "datasette --snapshot" to start faster. It
+    includes the schema catalog of each database, hashes and row counts for
+    immutable databases and the compiled templates.
+    """
+    ds = Datasette(
+        files,
+        immutables=immutable,
+        sqlite_extensions=sqlite_extensions,
+        template_dir=template_dir,
+        plugins_dir=plugins_dir,
+    )
+    snapshot_data = asyncio.run(create_startup_snapshot(ds))
+    if snapshot_file == "-":
+        sys.stdout.write(json.dumps(snapshot_data))
+    else:
+        with open(snapshot_file, "w") as fp:
+            fp.write(json.dumps(snapshot_data))
 
 
 @cli.group()
@@ -381,6 +473,12 @@ def uninstall(packages, yes):
 @click.option(
     "--inspect-file", help='Path to JSON file created using "datasette inspect"'
 )
+@click.option(
+    "--snapshot",
+    "snapshot_file",
+    type=click.File(mode="r"),
+    help='Path to JSON file created using "datasette snapshot"',
+)
 @click.option(
     "-m",
     "--metadata",
@@ -512,6 +610,7 @@ def serve(
     ssl_keyfile,
     ssl_certfile,
     internal,
+    snapshot_file=None,
     return_instance=False,
 ):
     """Serve up specified SQLite database files with a web UI"""
@@ -542,6 +641,15 @@ def serve(
         with open(inspect_file) as fp:
             inspect_data = json.load(fp)
 
+    startup_snapshot = None
+    if snapshot_file:
+        startup_snapshot = json.load(snapshot_file)
+        if not snapshot_is_current(startup_snapshot):
+            click.echo(
+                "Ignoring snapshot created by a different version of Datasette",
+                err=True,
+            )
+
     metadata_data = None
     if metadata:
         metadata_data = parse_metadata(metadata.read())
@@ -564,6 +672,7 @@ def serve(
         cache_headers=not reload,
         cors=cors,
         inspect_data=inspect_data,
+        startup_snapshot=startup_snapshot,
         config=config_data,
         metadata=metadata_data,
         sqlite_extensions=sqlite_extensions,
@@ -611,15 +720,21 @@ def serve(
         # Private utility mechanism for writing unit tests
         return ds
 
-    # Run the "startup" plugin hooks
-    asyncio.get_event_loop().run_until_complete(ds.invoke_startup())
-
-    # Run async soundness checks - but only if we're not under pytest
-    asyncio.get_event_loop().run_until_complete(check_databases(ds))
-
     if token and not get:
         raise click.ClickException("--token can only be used with --get")
 
+    async def startup():
+        # Run the "startup" plugin hooks
+        await ds.invoke_startup()
+        # Run async soundness checks - but only if we're not under pytest
+        await check_databases(ds)
+        if open_browser and not root and not get:
+            # Figure out most convenient URL - to table, database or homepage
+            return await initial_path_for_datasette(ds)
+
+    # All of this runs in one event loop, before uvicorn starts its own
+    initial_path = asyncio.run(startup())
+
     if get:
         client = TestClient(ds)
         headers = {}
@@ -643,11 +758,7 @@ def serve(
         click.echo(url)
     if open_browser:
         if url is None:
-            # Figure out most convenient URL - to table, database or homepage
-            path = asyncio.get_event_loop().run_until_complete(
-                initial_path_for_datasette(ds)
-            )
-            url = f"http://{host}:{port}{path}"
+            url = f"http://{host}:{port}{initial_path}"
         webbrowser.open(url)
     uvicorn_kwargs = dict(
         host=host, port=port, log_level="info", lifespan="on", workers=1
@@ -748,8 +859,7 @@ def create_token(
     ds = Datasette(secret=secret, plugins_dir=plugins_dir)
 
     # Run ds.invoke_startup() in an event loop
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(ds.invoke_startup())
+    asyncio.run(ds.invoke_startup())
 
     # Warn about any unknown actions
     actions = []
@@ -1,10 +1,14 @@
 import asyncio
 from collections import namedtuple
+from concurrent import futures
 from pathlib import Path
 import janus
+import json
+import math
 import queue
 import sys
 import threading
+import time
 import uuid
 
 from .tracer import trace
@@ -20,11 +24,30 @@ from .utils import (
     table_columns,
     table_column_details,
 )
+from .utils.asgi import ServiceUnavailable, current_request_path
 from .utils.sqlite import sqlite_version
 from .inspect import inspect_hash
 
 connections = threading.local()
 
+
+# Number of entries kept in the slow_queries internal table
+SLOW_QUERY_LOG_SIZE = 1000
+
+# Immutable files at least this large are hashed in a background thread at
+# startup, rather than the first time their hash is needed
+BACKGROUND_HASH_SIZE = 32 * 1024 * 1024
+
+# Snapshots are copied this many pages at a time, so progress can be reported.
+# If writes restart the copy more than SNAPSHOT_MAX_RESTARTS times, the rest is
+# copied in a single step instead.
+SNAPSHOT_PAGES = 1024
+SNAPSHOT_MAX_RESTARTS = 3
+# Seconds to wait before retrying a step that found the database locked
+SNAPSHOT_BUSY_SLEEP = 0.01
+# sqlite3.SQLITE_OK is only available in Python 3.11 and higher
+_SQLITE_OK = 0
+
 AttachedDatabase = namedtuple("AttachedDatabase", ("seq", "name", "file"))
 
 
@@ -51,7 +74,13 @@ class Database:
         if memory_name is not None:
             self.is_memory = True
         self.cached_hash = None
+        self._hash_future = None
+        # Slow query log entries that are still being written
+        self._slow_query_tasks = set()
         self.cached_size = None
+        # (pages copied, total pages) while a snapshot() is running
+        self.snapshot_progress = None
+        self._snapshot_lock = None
         self._cached_table_counts = None
         self._write_thread = None
         self._write_queue = None
@@ -126,6 +155,62 @@ class Database:
         for connection in self._all_file_connections:
             connection.close()
 
+    async def snapshot(self, path, progress=None):
+        """
+        Write a consistent copy of this database to path using the SQLite
+        backup API. progress is an optional callable that is passed the
+        number of pages copied and the total number of pages.
+        """
+
+        restarts = 0
+        copied_so_far = 0
+
+        def _progress(status, remaining, total):
+            nonlocal restarts, copied_so_far
+            copied = total - remaining
+            if status == _SQLITE_OK and copied <= copied_so_far:
+                # A write from another connection restarted the copy
+                restarts += 1
+                if restarts > SNAPSHOT_MAX_RESTARTS:
+                    raise _SnapshotRestarted()
+            copied_so_far = copied
+            self.snapshot_progress = (copied, total)
+            if progress is not None:
+                progress(copied, total)
+
+        def _snapshot():
+            source = self.connect()
+            dest = sqlite3.connect(str(path))
+            try:
+                try:
+                    source.backup(
+                        dest,
+                        pages=SNAPSHOT_PAGES,
+                        progress=_progress,
+                        sleep=SNAPSHOT_BUSY_SLEEP,
+                    )
+                except _SnapshotRestarted:
+                    # Under steady writes copying in batches might never
+                    # finish, so copy every page in one read transaction
+                    source.backup(
+                        dest, pages=-1, progress=_progress, sleep=SNAPSHOT_BUSY_SLEEP
+                    )
+            finally:
+                dest.close()
+                source.close()
+
+        # One snapshot of each database at a time
+        if self._snapshot_lock is None:
+            self._snapshot_lock = asyncio.Lock()
+        async with self._snapshot_lock:
+            self.snapshot_progress = (0, None)
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.ds.executor, _snapshot
+                )
+            finally:
+                self.snapshot_progress = None
+
     async def execute_write(self, sql, params=None, block=True):
         def _inner(conn):
             return conn.execute(sql, params or [])
@@ -268,15 +353,24 @@ class Database:
             task.reply_queue.sync_q.put(result)
 
     async def execute_fn(self, fn):
+        result, _ = await self._execute_fn(fn)
+        return result
+
+    async def _execute_fn(self, fn):
+        "Returns the result of fn and the seconds it waited for a thread"
         if self.ds.executor is None:
             # non-threaded mode
             if self._read_connection is None:
                 self._read_connection = self.connect()
                 self.ds._prepare_connection(self._read_connection, self.name)
-            return fn(self._read_connection)
+            return fn(self._read_connection), 0.0
 
         # threaded mode
+        started = None
+
         def in_thread():
+            nonlocal started
+            started = time.perf_counter()
             conn = getattr(connections, self.name, None)
             if not conn:
                 conn = self.connect()
@@ -284,9 +378,20 @@ class Database:
                 setattr(connections, self.name, conn)
             return fn(conn)
 
-        return await asyncio.get_event_loop().run_in_executor(
-            self.ds.executor, in_thread
-        )
+        metrics = self.ds.metrics
+        metrics.executor_in_flight += 1
+        queued = time.perf_counter()
+        try:
+            result = await asyncio.get_event_loop().run_in_executor(
+                self.ds.executor, in_thread
+            )
+        finally:
+            metrics.executor_in_flight -= 1
+            if started is not None:
+                metrics.executor_finished(
+                    started - queued, time.perf_counter() - started
+                )
+        return result, started - queued
 
     async def execute(
         self,
@@ -315,7 +420,7 @@ class Database:
                     if max_returned_rows and truncate:
                         rows = cursor.fetchmany(max_returned_rows + 1)
                         truncated = len(rows) > max_returned_rows
-                        rows = rows[:max_returned_rows]
+                        del rows[max_returned_rows:]
                     else:
                         rows = cursor.fetchall()
                         truncated = False
@@ -337,10 +442,130 @@ class Database:
             else:
                 return Results(rows, False, cursor.description)
 
-        with trace("sql", database=self.name, sql=sql.strip(), params=params):
-            results = await self.execute_fn(sql_operation_in_thread)
+        queue_limit_ms = self.ds.setting("sql_queue_limit_ms")
+        if (
+            queue_limit_ms
+            and self.ds.executor is not None
+            and self is not self.ds.get_internal_database()
+        ):
+            expected_wait = self.ds.metrics.expected_queue_wait(
+                self.ds.setting("num_sql_threads")
+            )
+            if expected_wait * 1000 > queue_limit_ms:
+                self.ds.metrics.query_rejected(self.name)
+                raise QueryQueueFull(expected_wait)
+
+        interrupted = False
+        start = time.perf_counter()
+        try:
+            with trace(
+                "sql", database=self.name, sql=sql.strip(), params=params
+            ) as span:
+                results, queue_wait = await self._execute_fn(sql_operation_in_thread)
+                # Time spent waiting for a thread, included in duration_ms
+                span["queue_ms"] = queue_wait * 1000
+        except QueryInterrupted:
+            interrupted = True
+            self.ds.metrics.query_interrupted(self.name)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.ds.metrics.sql_histogram(self.name).observe(duration)
+            slow_query_ms = self.ds.setting("slow_query_ms")
+            if (
+                slow_query_ms
+                and (interrupted or duration * 1000 >= slow_query_ms)
+                and self is not self.ds.get_internal_database()
+            ):
+                # Logged in the background so the query plan and the write to
+                # the internal database do not slow down the request
+                task = asyncio.create_task(
+                    self._log_slow_query(sql, params, duration * 1000, interrupted)
+                )
+                self._slow_query_tasks.add(task)
+                task.add_done_callback(self._slow_query_logged)
         return results
 
+    def _slow_query_logged(self, task):
+        self._slow_query_tasks.discard(task)
+        if task.cancelled():
+            return
+        exception = task.exception()
+        if exception is not None:
+            sys.stderr.write("Error logging slow query: {}\n".format(exception))
+            sys.stderr.flush()
+
+    async def explain_query_plan(self, sql, params=None):
+        """
+        Returns the EXPLAIN QUERY PLAN for sql as a list of dicts. This uses a
+        new connection, so it is unaffected by the state of the connection
+        that ran the query - for example after it was interrupted.
+        """
+
+        def in_thread():
+            conn = self.connect()
+            try:
+                self.ds._prepare_connection(conn, self.name)
+                rows = conn.execute(
+                    "explain query plan " + sql, params if params is not None else {}
+                ).fetchall()
+            finally:
+                conn.close()
+                try:
+                    self._all_file_connections.remove(conn)
+                except ValueError:
+                    # Was probably a memory connection
+                    pass
+            return [{"id": row[0], "parent": row[1], "detail": row[3]} for row in rows]
+
+        if self.ds.executor is None:
+            return in_thread()
+        return await asyncio.get_event_loop().run_in_executor(
+            self.ds.executor, in_thread
+        )
+
+    async def _log_slow_query(self, sql, params, duration_ms, interrupted):
+        # Parameter values may be private, so only their names and types are kept
+        if isinstance(params, dict):
+            params_shape = {key: type(value).__name__ for key, value in params.items()}
+        elif params:
+            params_shape = [type(value).__name__ for value in params]
+        else:
+            params_shape = None
+        path = current_request_path.get()
+        try:
+            query_plan = await self.explain_query_plan(sql, params)
+        except sqlite3.Error:
+            query_plan = None
+
+        def insert(conn):
+            conn.execute(
+                """
+                insert into slow_queries
+                    (database_name, path, sql, params, duration_ms, interrupted, query_plan)
+                values (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    self.name,
+                    path,
+                    sql,
+                    json.dumps(params_shape),
+                    duration_ms,
+                    int(interrupted),
+                    json.dumps(query_plan),
+                ],
+            )
+            conn.execute(
+                "delete from slow_queries where id <= (select max(id) from slow_queries) - ?",
+                [SLOW_QUERY_LOG_SIZE],
+            )
+
+        try:
+            await self.ds.get_internal_database().execute_write_fn(insert)
+        except sqlite3.Error:
+            # For example if the internal database has not been created yet
+            pass
+
     @property
     def hash(self):
         if self.cached_hash is not None:
@@ -350,11 +575,53 @@ class Database:
         elif self.ds.inspect_data and self.ds.inspect_data.get(self.name):
             self.cached_hash = self.ds.inspect_data[self.name]["hash"]
             return self.cached_hash
+        elif self._hash_future is not None:
+            # Still being calculated by hash_in_background()
+            if not self._hash_future.done():
+                return None
+            self.cached_hash = self._hash_future.result()
+            return self.cached_hash
         else:
-            p = Path(self.path)
-            self.cached_hash = inspect_hash(p)
+            self.cached_hash = self._calculate_hash()
             return self.cached_hash
 
+    def _calculate_hash(self):
+        return inspect_hash(Path(self.path), self.ds.setting("hash_strategy"))
+
+    def hash_in_background(self):
+        """
+        Start calculating the hash of a large immutable database in a thread,
+        so no request has to wait for it. .hash is None until it has finished.
+        """
+        if (
+            self.is_mutable
+            or self.is_memory
+            or self._hash_future is not None
+            or self.cached_hash is not None
+            or (self.ds.inspect_data and self.ds.inspect_data.get(self.name))
+            or Path(self.path).stat().st_size < BACKGROUND_HASH_SIZE
+        ):
+            return
+        future = futures.Future()
+
+        def calculate():
+            try:
+                future.set_result(self._calculate_hash())
+            except Exception as e:
+                future.set_exception(e)
+
+        self._hash_future = future
+        # A daemon thread, so hashing a huge file does not delay shutdown
+        threading.Thread(
+            target=calculate, name="datasette-hash-{}".format(self.name), daemon=True
+        ).start()
+
+    async def wait_for_hash(self):
+        "Returns .hash, waiting for hash_in_background() to finish if necessary"
+        if self.hash is None and self._hash_future is not None:
+            await asyncio.wrap_future(self._hash_future)
+        return self.hash
+
     @property
     def size(self):
         if self.cached_size is not None:
@@ -376,22 +643,25 @@ class Database:
         # Try to get counts for each table, $limit timeout for each count
         counts = {}
         for table in await self.table_names():
-            try:
-                table_count = (
-                    await self.execute(
-                        f"select count(*) from (select * from [{table}] limit {self.count_limit + 1})",
-                        custom_time_limit=limit,
-                    )
-                ).rows[0][0]
-                counts[table] = table_count
-            # In some cases I saw "SQL Logic Error" here in addition to
-            # QueryInterrupted - so we catch that too:
-            except (QueryInterrupted, sqlite3.OperationalError, sqlite3.DatabaseError):
-                counts[table] = None
+            counts[table] = await self.table_count(table, limit)
         if not self.is_mutable:
             self._cached_table_counts = counts
         return counts
 
+    async def table_count(self, table, limit=10):
+        "Count rows in table up to count_limit, or None if that took too long"
+        try:
+            return (
+                await self.execute(
+                    f"select count(*) from (select * from [{table}] limit {self.count_limit + 1})",
+                    custom_time_limit=limit,
+                )
+            ).rows[0][0]
+        # In some cases I saw "SQL Logic Error" here in addition to
+        # QueryInterrupted - so we catch that too:
+        except (QueryInterrupted, sqlite3.OperationalError, sqlite3.DatabaseError):
+            return None
+
     @property
     def mtime_ns(self):
         if self.is_memory:
@@ -641,6 +911,10 @@ class WriteTask:
         self.transaction = transaction
 
 
+class _SnapshotRestarted(Exception):
+    pass
+
+
 class QueryInterrupted(Exception):
     def __init__(self, e, sql, params):
         self.e = e
@@ -651,6 +925,23 @@ class QueryInterrupted(Exception):
         return "QueryInterrupted: {}".format(self.e)
 
 
+class QueryQueueFull(ServiceUnavailable):
+    """
+    Raised instead of running a query when the expected wait for a thread
+    is longer than the sql_queue_limit_ms setting
+    """
+
+    def __init__(self, expected_wait):
+        self.expected_wait = expected_wait
+        # Whole seconds for the Retry-After header
+        self.retry_after = max(1, math.ceil(expected_wait))
+        super().__init__(
+            "Too many queries are waiting to run, try again in {} second{}".format(
+                self.retry_after, "" if self.retry_after == 1 else "s"
+            )
+        )
+
+
 class MultipleValues(Exception):
     pass
 
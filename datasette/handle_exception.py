@@ -2,6 +2,7 @@ from datasette import hookimpl, Response
 from .utils import add_cors_headers
 from .utils.asgi import (
     Base400,
+    Base500,
 )
 from .views.base import DatasetteError
 from markupsafe import Markup
@@ -28,7 +29,7 @@ def handle_exception(datasette, request, exception):
             rich.get_console().print_exception(show_locals=True)
 
         title = None
-        if isinstance(exception, Base400):
+        if isinstance(exception, (Base400, Base500)):
             status = exception.status
             info = {}
             message = exception.args[0]
@@ -56,6 +57,9 @@ def handle_exception(datasette, request, exception):
         headers = {}
         if datasette.cors:
             add_cors_headers(headers)
+        retry_after = getattr(exception, "retry_after", None)
+        if retry_after:
+            headers["Retry-After"] = str(retry_after)
         if request.path.split("?")[0].endswith(".json"):
             return Response.json(info, status=status, headers=headers)
         else:
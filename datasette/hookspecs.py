@@ -5,6 +5,16 @@ hookspec = HookspecMarker("datasette")
 hookimpl = HookimplMarker("datasette")
 
 
+def cacheable(fn):
+    """
+    Marks an extra_css_urls() or extra_js_urls() implementation as always
+    returning the same URLs for the same template, database, table, columns
+    and view_name, so Datasette can cache its result
+    """
+    fn._datasette_cacheable = True
+    return fn
+
+
 @hookspec
 def startup(datasette):
     """Fires directly after Datasette first starts running"""
@@ -59,6 +69,11 @@ def render_cell(row, value, column, table, database, datasette, request):
     """Customize rendering of HTML table cell values"""
 
 
+@hookspec
+def render_cells(column, table, database, datasette, request):
+    """Return a function for rendering every HTML table cell in a column"""
+
+
 @hookspec
 def register_output_renderer(datasette):
     """Register a renderer to output data in a different format"""
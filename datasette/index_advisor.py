@@ -0,0 +1,175 @@
+from collections import namedtuple
+import re
+
+from datasette.utils import escape_sqlite, sqlite3
+
+# Lookups from datasette.filters that SQLite can answer using an index
+EQUALITY_LOOKUPS = {"exact", "in", "isnull"}
+RANGE_LOOKUPS = {"gt", "gte", "lt", "lte"}
+
+# Stop recording new query shapes after this many, since filter column
+# names come from the query string
+MAX_QUERY_SHAPES = 1000
+
+
+class QueryShape(
+    namedtuple(
+        "QueryShape",
+        ("database", "table", "where_columns", "range_column", "order_by", "group_by"),
+    )
+):
+    """
+    The parts of a table view query that an index could help with: columns
+    compared for equality, a column compared with a range, and a column
+    used for ordering or for grouping by a facet.
+    """
+
+    def index_columns(self):
+        columns = []
+        for column in self.where_columns + (
+            self.range_column,
+            self.order_by,
+            self.group_by,
+        ):
+            if column is not None and column not in columns:
+                columns.append(column)
+        return tuple(columns)
+
+    def sql(self):
+        "Representative SQL and parameters for this shape, for EXPLAIN"
+        wheres = []
+        params = {}
+        for i, column in enumerate(self.where_columns):
+            wheres.append("{} = :p{}".format(escape_sqlite(column), i))
+            params["p{}".format(i)] = None
+        if self.range_column is not None:
+            wheres.append("{} > :range".format(escape_sqlite(self.range_column)))
+            params["range"] = None
+        if self.group_by is not None:
+            sql = "select {}, count(*) from {}".format(
+                escape_sqlite(self.group_by), escape_sqlite(self.table)
+            )
+        else:
+            sql = "select * from {}".format(escape_sqlite(self.table))
+        if wheres:
+            sql += " where " + " and ".join(wheres)
+        if self.group_by is not None:
+            sql += " group by {}".format(escape_sqlite(self.group_by))
+        elif self.order_by is not None:
+            sql += " order by {}".format(escape_sqlite(self.order_by))
+        return sql, params
+
+
+def create_index_sql(table, columns):
+    return "CREATE INDEX {} ON {} ({})".format(
+        escape_sqlite("idx_{}_{}".format(table, "_".join(columns))),
+        escape_sqlite(table),
+        ", ".join(escape_sqlite(column) for column in columns),
+    )
+
+
+def plan_problems(plan, table, filtered=True):
+    """
+    Steps of an EXPLAIN QUERY PLAN that an index on table could avoid. A full
+    table scan is only a problem if the query is filtered.
+    """
+    full_scan = re.compile(r"^SCAN (TABLE )?{}( |$)".format(re.escape(table)))
+    return [
+        step["detail"]
+        for step in plan
+        if "USE TEMP B-TREE" in step["detail"]
+        or (
+            filtered
+            and full_scan.match(step["detail"])
+            and "USING" not in step["detail"]
+        )
+    ]
+
+
+class IndexAdvisor:
+    """
+    Counts the filter, sort and facet columns used by table pages, then uses
+    EXPLAIN QUERY PLAN to find which of those queries would benefit from an
+    index.
+    """
+
+    def __init__(self):
+        # QueryShape => number of times it was seen
+        self.shapes = {}
+
+    def observe(self, database, table, filters, sort=None, facets=None):
+        where_columns = set()
+        range_column = None
+        for column, lookup, _ in filters.selections():
+            if lookup in EQUALITY_LOOKUPS:
+                where_columns.add(column)
+            elif lookup in RANGE_LOOKUPS and range_column is None:
+                range_column = column
+        where_columns = tuple(sorted(where_columns))
+        if where_columns or range_column or sort:
+            self._count(
+                QueryShape(database, table, where_columns, range_column, sort, None)
+            )
+        for facet in facets or ():
+            self._count(QueryShape(database, table, where_columns, None, None, facet))
+
+    def _count(self, shape):
+        count = self.shapes.get(shape)
+        if count is None and len(self.shapes) >= MAX_QUERY_SHAPES:
+            return
+        self.shapes[shape] = (count or 0) + 1
+
+    async def advice(self, datasette):
+        "Suggested indexes, most frequently needed first"
+        suggestions = {}
+        for shape, count in list(self.shapes.items()):
+            try:
+                db = datasette.get_database(shape.database)
+            except KeyError:
+                continue
+            if not await db.table_exists(shape.table):
+                continue
+            sql, params = shape.sql()
+            try:
+                problems = plan_problems(
+                    await db.explain_query_plan(sql, params),
+                    shape.table,
+                    filtered=bool(shape.where_columns or shape.range_column),
+                )
+            except sqlite3.Error:
+                # Probably a filter against a column that does not exist
+                continue
+            if not problems:
+                continue
+            columns = shape.index_columns()
+            key = (shape.database, shape.table, columns)
+            suggestion = suggestions.get(key)
+            if suggestion is None:
+                suggestion = suggestions[key] = {
+                    "database": shape.database,
+                    "table": shape.table,
+                    "columns": list(columns),
+                    "sql": create_index_sql(shape.table, columns),
+                    "is_mutable": db.is_mutable,
+                    "count": 0,
+                    "queries": [],
+                }
+            suggestion["count"] += count
+            suggestion["queries"].append(
+                {"sql": sql, "count": count, "problems": problems}
+            )
+        # An index on (a, b) can also be used by queries that need (a)
+        for key in sorted(suggestions, key=lambda key: len(key[2])):
+            database, table, columns = key
+            wider = [
+                other
+                for other in suggestions
+                if other[:2] == (database, table)
+                and len(other[2]) > len(columns)
+                and other[2][: len(columns)] == columns
+            ]
+            if wider:
+                covered = suggestions.pop(key)
+                suggestions[wider[0]]["count"] += covered["count"]
+                suggestions[wider[0]]["queries"].extend(covered["queries"])
+        return sorted(suggestions.values(), key=lambda suggestion: -suggestion["count"])
@@ -1,5 +1,15 @@
 import hashlib
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 from .utils import (
     detect_spatialite,
     detect_fts,
@@ -13,10 +23,28 @@ from .utils import (
 
 HASH_BLOCK_SIZE = 1024 * 1024
 
+# Options for the hash_strategy setting
+HASH_STRATEGIES = ("sha256", "blake3", "xxhash", "sampled", "header")
+
+# Number of pages read by the "sampled" hash strategy
+SAMPLED_PAGES = 256
 
-def inspect_hash(path):
+# The first 100 bytes of a SQLite database file
+SQLITE_HEADER_SIZE = 100
+
+
+def inspect_hash(path, strategy="sha256"):
     """Calculate the hash of a database, efficiently."""
-    m = hashlib.sha256()
+    if strategy == "sampled":
+        return sampled_hash(path)
+    elif strategy == "header":
+        return header_hash(path)
+    elif strategy == "blake3":
+        m = blake3.blake3()
+    elif strategy == "xxhash":
+        m = xxhash.xxh3_128()
+    else:
+        m = hashlib.sha256()
     with path.open("rb") as fp:
         while True:
             data = fp.read(HASH_BLOCK_SIZE)
@@ -27,6 +55,42 @@ def inspect_hash(path):
     return m.hexdigest()
 
 
+def sampled_hash(path):
+    """
+    Hash the SQLite header and up to SAMPLED_PAGES pages spread evenly through
+    the file, along with its size. This reads a fixed amount of data however
+    large the file is, but will miss changes to pages that are not sampled.
+    """
+    size = path.stat().st_size
+    m = hashlib.sha256(str(size).encode("utf-8"))
+    with path.open("rb") as fp:
+        header = fp.read(SQLITE_HEADER_SIZE)
+        m.update(header)
+        page_size = int.from_bytes(header[16:18], "big")
+        # A page size of 1 means 65536
+        if page_size == 1:
+            page_size = 65536
+        page_size = page_size or HASH_BLOCK_SIZE
+        num_pages = -(-size // page_size)
+        for page in range(0, num_pages, max(1, num_pages // SAMPLED_PAGES)):
+            fp.seek(page * page_size)
+            m.update(fp.read(page_size))
+    return m.hexdigest()
+
+
+def header_hash(path):
+    """
+    Hash the SQLite header, which includes the file change counter, page count
+    and schema cookie, along with the size of the file. SQLite increments the
+    change counter for every transaction that modifies a database that is not
+    in WAL mode.
+    """
+    size = path.stat().st_size
+    with path.open("rb") as fp:
+        header = fp.read(SQLITE_HEADER_SIZE)
+    return hashlib.sha256(str(size).encode("utf-8") + header).hexdigest()
+
+
 def inspect_views(conn):
     """List views in a database."""
     return [
@@ -0,0 +1,270 @@
+from bisect import bisect_left
+import collections
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Weight given to the newest run time in the moving average used to estimate
+# how long a new query will wait for an executor thread
+RUN_TIME_SMOOTHING = 0.1
+
+
+class Histogram:
+    # Observations only increment an existing slot, so recording a value
+    # does not allocate. Buckets are made cumulative when rendered.
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class CacheStats:
+    __slots__ = ("hits", "misses")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+
+# Statistics for caches that are shared by every Datasette instance in the
+# process, such as the compiled allow block cache
+_shared_caches = {}
+
+
+def shared_cache_stats(name):
+    "Returns the CacheStats for a module-level cache, creating it if needed"
+    stats = _shared_caches.get(name)
+    if stats is None:
+        stats = _shared_caches[name] = CacheStats()
+    return stats
+
+
+class Metrics:
+    """
+    Aggregate counters for a Datasette instance, served at /-/metrics in the
+    Prometheus text exposition format.
+
+    All of these are updated from the event loop thread, never from the
+    threads that run SQL queries.
+    """
+
+    def __init__(self):
+        # (route pattern, view name) => Histogram
+        self.request_durations = {}
+        # database name => Histogram
+        self.sql_durations = {}
+        # database name => number of queries cancelled by sql_time_limit_ms
+        self.queries_interrupted = {}
+        # Number of functions submitted to the executor that have not finished
+        self.executor_in_flight = 0
+        # Time functions spent waiting for an executor thread to pick them up
+        self.executor_queue_wait = Histogram()
+        self.recent_queue_waits = collections.deque(maxlen=100)
+        # Moving average of the time functions take once they are running
+        self.executor_run_time = None
+        # database name => number of queries rejected by sql_queue_limit_ms
+        self.queries_rejected = {}
+        self.caches = {}
+
+    def request_histogram(self, route, view_name):
+        key = (route, view_name)
+        histogram = self.request_durations.get(key)
+        if histogram is None:
+            histogram = self.request_durations[key] = Histogram()
+        return histogram
+
+    def sql_histogram(self, database):
+        histogram = self.sql_durations.get(database)
+        if histogram is None:
+            histogram = self.sql_durations[database] = Histogram()
+        return histogram
+
+    def query_interrupted(self, database):
+        self.queries_interrupted[database] = (
+            self.queries_interrupted.get(database, 0) + 1
+        )
+
+    def executor_finished(self, queue_wait, run_time):
+        self.executor_queue_wait.observe(queue_wait)
+        self.recent_queue_waits.append(queue_wait)
+        if self.executor_run_time is None:
+            self.executor_run_time = run_time
+        else:
+            self.executor_run_time += RUN_TIME_SMOOTHING * (
+                run_time - self.executor_run_time
+            )
+
+    def expected_queue_wait(self, max_threads):
+        """
+        Estimated seconds a function submitted now would wait for a thread,
+        based on how many are ahead of it and how long they usually take
+        """
+        ahead = self.executor_in_flight - max_threads + 1
+        if ahead <= 0 or not self.executor_run_time:
+            return 0.0
+        return ahead * self.executor_run_time / max_threads
+
+    def query_rejected(self, database):
+        self.queries_rejected[database] = self.queries_rejected.get(database, 0) + 1
+
+    def cache_stats(self, name):
+        stats = self.caches.get(name)
+        if stats is None:
+            stats = self.caches[name] = CacheStats()
+        return stats
+
+    def render(self, datasette):
+        "Returns the metrics as text in the Prometheus exposition format"
+        lines = []
+
+        def family(name, type_, help_):
+            lines.append("# HELP {} {}".format(name, help_))
+            lines.append("# TYPE {} {}".format(name, type_))
+
+        def sample(name, labels, value):
+            if labels:
+                name += "{%s}" % ",".join(
+                    '{}="{}"'.format(key, _escape_label(label_value))
+                    for key, label_value in labels.items()
+                )
+            lines.append("{} {}".format(name, _format_value(value)))
+
+        def histogram(name, labels, histogram):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                sample(name + "_bucket", dict(labels, le=str(bound)), cumulative)
+            sample(name + "_sum", labels, histogram.sum)
+            sample(name + "_count", labels, histogram.count)
+
+        family(
+            "datasette_request_duration_seconds",
+            "histogram",
+            "Time taken to respond to HTTP requests",
+        )
+        for (route, view_name), h in sorted(self.request_durations.items()):
+            histogram(
+                "datasette_request_duration_seconds",
+                {"route": route, "view": view_name},
+                h,
+            )
+
+        family(
+            "datasette_sql_duration_seconds",
+            "histogram",
+            "Time taken to execute read queries, including waiting for a thread",
+        )
+        for database, h in sorted(self.sql_durations.items()):
+            histogram("datasette_sql_duration_seconds", {"database": database}, h)
+
+        family(
+            "datasette_sql_interrupted_total",
+            "counter",
+            "Queries cancelled for exceeding the time limit",
+        )
+        for database, count in sorted(self.queries_interrupted.items()):
+            sample("datasette_sql_interrupted_total", {"database": database}, count)
+
+        family(
+            "datasette_sql_rejected_total",
+            "counter",
+            "Queries rejected because the wait for a thread exceeded sql_queue_limit_ms",
+        )
+        for database, count in sorted(self.queries_rejected.items()):
+            sample("datasette_sql_rejected_total", {"database": database}, count)
+
+        executor = datasette.executor
+        family(
+            "datasette_executor_threads",
+            "gauge",
+            "Threads started by the SQL executor",
+        )
+        sample(
+            "datasette_executor_threads",
+            None,
+            len(executor._threads) if executor is not None else 0,
+        )
+        family(
+            "datasette_executor_max_threads",
+            "gauge",
+            "Maximum number of threads for the SQL executor",
+        )
+        sample(
+            "datasette_executor_max_threads",
+            None,
+            executor._max_workers if executor is not None else 0,
+        )
+        queued = executor._work_queue.qsize() if executor is not None else 0
+        family(
+            "datasette_executor_queue_depth",
+            "gauge",
+            "Functions waiting for a free SQL executor thread",
+        )
+        sample("datasette_executor_queue_depth", None, queued)
+        family(
+            "datasette_executor_queue_wait_seconds",
+            "histogram",
+            "Time functions waited for a free SQL executor thread",
+        )
+        histogram("datasette_executor_queue_wait_seconds", {}, self.executor_queue_wait)
+        family(
+            "datasette_executor_active_threads",
+            "gauge",
+            "SQL executor threads that are currently running a function",
+        )
+        sample(
+            "datasette_executor_active_threads",
+            None,
+            max(0, self.executor_in_flight - queued),
+        )
+
+        family(
+            "datasette_write_queue_depth",
+            "gauge",
+            "Writes waiting for the write thread of each database",
+        )
+        for name, db in datasette.databases.items():
+            depth = db._write_queue.qsize() if db._write_queue is not None else 0
+            sample("datasette_write_queue_depth", {"database": name}, depth)
+
+        caches = dict(_shared_caches, **self.caches)
+        for attr in ("hits", "misses"):
+            name = "datasette_cache_{}_total".format(attr)
+            family(name, "counter", "Cache {} for internal caches".format(attr))
+            for cache_name, stats in sorted(caches.items()):
+                sample(name, {"cache": cache_name}, getattr(stats, attr))
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
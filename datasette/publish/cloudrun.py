@@ -1,19 +1,21 @@
 from datasette import hookimpl
-import click
 import json
 import os
 import re
 from subprocess import check_call, check_output
 
-from .common import (
-    add_common_publish_arguments_and_options,
-    fail_if_publish_binary_not_installed,
-)
 from ..utils import temporary_docker_directory
 
 
 @hookimpl
 def publish_subcommand(publish):
+    # See the comment in datasette/publish/heroku.py
+    import click
+    from .common import (
+        add_common_publish_arguments_and_options,
+        fail_if_publish_binary_not_installed,
+    )
+
     @publish.command()
     @add_common_publish_arguments_and_options
     @click.option(
@@ -218,6 +220,8 @@ def get_existing_services():
 
 
 def _validate_memory(ctx, param, value):
+    import click
+
     if value and re.match(r"^\d+(Gi|G|Mi|M)$", value) is None:
         raise click.BadParameter("--memory should be a number then Gi/G/Mi/M e.g 1Gi")
     return value
@@ -1,4 +1,4 @@
-from ..utils import StaticMount
+from ..utils.click_types import StaticMount
 import click
 import os
 import shutil
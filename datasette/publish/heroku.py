@@ -1,6 +1,5 @@
 from contextlib import contextmanager
 from datasette import hookimpl
-import click
 import json
 import os
 import pathlib
@@ -9,15 +8,19 @@ import shutil
 from subprocess import call, check_output
 import tempfile
 
-from .common import (
-    add_common_publish_arguments_and_options,
-    fail_if_publish_binary_not_installed,
-)
 from datasette.utils import link_or_copy, link_or_copy_directory, parse_metadata
 
 
 @hookimpl
 def publish_subcommand(publish):
+    # click is only imported when the publish command is being assembled, so
+    # that registering this plugin does not slow down `import datasette.app`
+    import click
+    from .common import (
+        add_common_publish_arguments_and_options,
+        fail_if_publish_binary_not_installed,
+    )
+
     @publish.command()
     @add_common_publish_arguments_and_options
     @click.option(
@@ -1,8 +1,7 @@
 import json
 from datasette.utils import (
     value_as_boolean,
-    remove_infinites,
-    CustomJSONEncoder,
+    encode_json,
     path_from_row_pks,
     sqlite3,
 )
@@ -27,7 +26,7 @@ def convert_specific_columns_to_json(rows, columns, json_cols):
     return new_rows
 
 
-def json_renderer(request, args, data, error, truncated=None):
+def json_renderer(datasette, request, args, data, error, truncated=None):
     """Render a response as JSON"""
     status_code = 200
 
@@ -40,9 +39,9 @@ def json_renderer(request, args, data, error, truncated=None):
             data["rows"], data["columns"], json_cols
         )
 
-    # unless _json_infinity=1 requested, replace infinity with None
-    if "rows" in data and not value_as_boolean(args.get("_json_infinity", "0")):
-        data["rows"] = [remove_infinites(row) for row in data["rows"]]
+    # unless _json_infinity=1 requested, infinity is replaced with None
+    # by encode_json() - no need to check every row here
+    json_infinity = value_as_boolean(args.get("_json_infinity", "0"))
 
     # Deal with the _shape option
     shape = args.get("_shape", "objects")
@@ -67,8 +66,11 @@ def json_renderer(request, args, data, error, truncated=None):
     elif shape in ("objects", "object", "array"):
         columns = data.get("columns")
         rows = data.get("rows")
-        if rows and columns and not isinstance(rows[0], dict):
-            data["rows"] = [dict(zip(columns, row)) for row in rows]
+        if rows and not isinstance(rows[0], dict):
+            if columns:
+                data["rows"] = [dict(zip(columns, row)) for row in rows]
+            else:
+                data["rows"] = [dict(row) for row in rows]
         if shape == "object":
             shape_error = None
             if "primary_keys" not in data:
@@ -90,13 +92,21 @@ def json_renderer(request, args, data, error, truncated=None):
         elif shape == "array":
             data = data["rows"]
 
+    elif shape == "columns":
+        columns = data.get("columns")
+        rows = data["rows"]
+        if columns is None:
+            columns = list(rows[0].keys()) if rows else []
+        # Transpose the rows in one pass rather than building a dict per row
+        values = zip(*(row.values() if type(row) is dict else row for row in rows))
+        data["rows"] = {column: [] for column in columns}
+        data["rows"].update(zip(columns, map(list, values)))
     elif shape == "arrays":
         if not data["rows"]:
             pass
-        elif isinstance(data["rows"][0], sqlite3.Row):
-            data["rows"] = [list(row) for row in data["rows"]]
-        else:
+        elif isinstance(data["rows"][0], dict):
             data["rows"] = [list(row.values()) for row in data["rows"]]
+        # Anything else, including sqlite3.Row, is encoded as an array as-is
     else:
         status_code = 400
         data = {
@@ -111,13 +121,16 @@ def json_renderer(request, args, data, error, truncated=None):
     if isinstance(data, dict) and "columns" not in request.args.getlist("_extra"):
         data.pop("columns", None)
 
+    encoder = datasette.setting("json_encoder") if datasette else "json"
     # Handle _nl option for _shape=array
     nl = args.get("_nl", "")
     if nl and shape == "array":
-        body = "\n".join(json.dumps(item, cls=CustomJSONEncoder) for item in data)
+        body = "\n".join(
+            encode_json(item, encoder=encoder, infinity=json_infinity) for item in data
+        )
         content_type = "text/plain"
     else:
-        body = json.dumps(data, cls=CustomJSONEncoder)
+        body = encode_json(data, encoder=encoder, infinity=json_infinity)
         content_type = "application/json; charset=utf-8"
     headers = {}
     return Response(
@@ -0,0 +1,159 @@
+import base64
+import os
+from pathlib import Path
+
+from jinja2 import BytecodeCache, TemplateError
+
+from datasette.version import __version__
+
+CATALOG_TABLES = (
+    "catalog_tables",
+    "catalog_columns",
+    "catalog_indexes",
+    "catalog_foreign_keys",
+)
+
+
+class TemplateBytecodeCache(BytecodeCache):
+    """
+    Keeps compiled templates in memory so they can be written to a startup
+    snapshot. Jinja checks each entry against a checksum of the template
+    source, so bytecode for a template that has since changed is ignored.
+    """
+
+    def __init__(self, bytecode=None):
+        self.bytecode = dict(bytecode or {})
+
+    def load_bytecode(self, bucket):
+        code = self.bytecode.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self.bytecode[bucket.key] = bucket.bytecode_to_string()
+
+
+async def create_startup_snapshot(datasette):
+    """
+    Returns a JSON serializable dictionary of the work Datasette does when it
+    starts: the internal schema catalog, plus the hash and table counts for
+    immutable databases and the compiled templates.
+    """
+    await datasette.invoke_startup()
+    await datasette.refresh_schemas()
+    internal_db = datasette.get_internal_database()
+    databases = {}
+    for name, db in datasette.databases.items():
+        if db.is_memory:
+            continue
+        stat = Path(db.path).stat()
+        info = {
+            "file": db.path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "is_mutable": db.is_mutable,
+            "schema_version": (await db.execute("PRAGMA schema_version")).first()[0],
+            "catalog": {},
+        }
+        if not db.is_mutable:
+            # Same keys as "datasette inspect", so these can be used as inspect_data
+            info["hash"] = await db.wait_for_hash()
+            info["tables"] = {
+                table: {"count": count}
+                for table, count in (await db.table_counts(limit=3600 * 1000)).items()
+            }
+        for table in CATALOG_TABLES:
+            rows = await internal_db.execute(
+                "select * from {} where database_name = ?".format(table), [name]
+            )
+            info["catalog"][table] = [dict(row) for row in rows]
+        databases[name] = info
+
+    environment = datasette._jinja_env
+    for template in environment.list_templates():
+        # Templates with the "default:" prefix are the same files again
+        if template.startswith("default:"):
+            continue
+        try:
+            environment.get_template(template)
+        except (TemplateError, UnicodeDecodeError):
+            # Not every file in a templates directory is a valid template
+            continue
+    return {
+        "datasette_version": __version__,
+        "databases": databases,
+        "templates": {
+            key: base64.b64encode(code).decode("ascii")
+            for key, code in environment.bytecode_cache.bytecode.items()
+        },
+    }
+
+
+def snapshot_is_current(snapshot):
+    "Snapshots are only used by the version of Datasette that created them"
+    return bool(snapshot) and snapshot.get("datasette_version") == __version__
+
+
+def snapshot_templates(snapshot):
+    return {
+        key: base64.b64decode(code)
+        for key, code in snapshot.get("templates", {}).items()
+    }
+
+
+def snapshot_databases(snapshot, databases):
+    """
+    Entries from the snapshot for the databases that are attached from the
+    same files, where the size and modification time of the file have not
+    changed. Catalogs are also checked against PRAGMA schema_version later,
+    as changes written to a WAL file leave the database file untouched.
+    Hashes and counts are only used for immutable databases.
+
+    Returns (catalogs, inspect_data)
+    """
+    catalogs = {}
+    inspect_data = {}
+    for name, info in snapshot.get("databases", {}).items():
+        db = databases.get(name)
+        if db is None or db.is_memory:
+            continue
+        if os.path.abspath(db.path) != os.path.abspath(info["file"]):
+            continue
+        try:
+            stat = Path(db.path).stat()
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) != (info["size"], info["mtime_ns"]):
+            continue
+        catalogs[name] = info
+        if not db.is_mutable and "hash" in info:
+            inspect_data[name] = info
+    return catalogs, inspect_data
+
+
+async def load_snapshot_catalog(internal_db, catalogs):
+    "Populates the internal catalog tables from snapshot entries"
+
+    def load(conn):
+        for name, info in catalogs.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_databases "
+                "(database_name, path, is_memory, schema_version) "
+                "VALUES (?, ?, 0, ?)",
+                [name, str(info["file"]), info["schema_version"]],
+            )
+            for table in CATALOG_TABLES:
+                conn.execute(
+                    "DELETE FROM {} WHERE database_name = ?".format(table), [name]
+                )
+                for row in info["catalog"].get(table, []):
+                    conn.execute(
+                        "INSERT INTO {} ({}) VALUES ({})".format(
+                            table,
+                            ", ".join('"{}"'.format(column) for column in row),
+                            ", ".join("?" for _ in row),
+                        ),
+                        list(row.values()),
+                    )
+
+    await internal_db.execute_write_fn(load)
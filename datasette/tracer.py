@@ -13,6 +13,13 @@ TRACE_RESERVED_KEYS = {"type", "start", "end", "duration_ms", "traceback"}
 trace_task_id = ContextVar("trace_task_id", default=None)
 
 
+class Spans(list):
+    """
+    A tracer that only records timings. Used for sampled tracing, which can
+    run on every request so skips the cost of extracting a traceback.
+    """
+
+
 def get_task_id():
     current = trace_task_id.get(None)
     if current is not None:
@@ -58,9 +65,12 @@ def trace(trace_type, **kwargs):
             "start": start,
             "end": end,
             "duration_ms": (end - start) * 1000,
-            "traceback": traceback.format_list(traceback.extract_stack(limit=6)[:-3]),
-            "error": str(captured_error) if captured_error else None,
         }
+        if not isinstance(tracer, Spans):
+            trace_info["traceback"] = traceback.format_list(
+                traceback.extract_stack(limit=6)[:-3]
+            )
+        trace_info["error"] = str(captured_error) if captured_error else None
         trace_info.update(kwargs)
         tracer.append(trace_info)
 
@@ -72,9 +82,15 @@ def capture_traces(tracer):
     if task_id is None:
         yield
         return
+    previous = tracers.get(task_id)
     tracers[task_id] = tracer
-    yield
-    del tracers[task_id]
+    try:
+        yield
+    finally:
+        if previous is None:
+            del tracers[task_id]
+        else:
+            tracers[task_id] = previous
 
 
 class AsgiTracer:
@@ -151,3 +167,89 @@ class AsgiTracer:
 
         with capture_traces(traces):
             await self.app(scope, receive, wrapped_send)
+
+
+class AsgiSampledTracer:
+    """
+    Records span timings for a sample of requests, appending completed
+    traces to the traces deque - which should have a maxlen, so it acts as a
+    ring buffer of the most recent traces.
+
+    A request is kept if it is one of every sample_rate requests, or if it
+    took at least slow_ms milliseconds. Setting slow_ms means every request
+    has to be traced, since its duration is not known until it has finished.
+    """
+
+    def __init__(self, app, traces, sample_rate=0, slow_ms=0):
+        self.app = app
+        self.traces = traces
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._count = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        self._count += 1
+        sampled = bool(self.sample_rate) and self._count % self.sample_rate == 0
+        if not sampled and not self.slow_ms:
+            await self.app(scope, receive, send)
+            return
+        spans = Spans()
+        status = None
+
+        async def wrapped_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            with capture_traces(spans):
+                await self.app(scope, receive, wrapped_send)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            if sampled or duration_ms >= self.slow_ms:
+                self.traces.append(
+                    {
+                        "method": scope.get("method"),
+                        "path": scope.get("path"),
+                        "query_string": scope.get("query_string", b"").decode(
+                            "latin-1"
+                        ),
+                        "status": status,
+                        "started": started,
+                        "duration_ms": duration_ms,
+                        "sampled": sampled,
+                        # Converted to offsets when the trace is displayed
+                        "perf_counter_start": start,
+                        "spans": spans,
+                    }
+                )
+
+
+def sampled_traces_json(traces):
+    "JSON-serializable version of the traces recorded by AsgiSampledTracer"
+    output = []
+    for trace_ in reversed(traces):
+        trace_ = dict(trace_)
+        start = trace_.pop("perf_counter_start")
+        spans = trace_.pop("spans")
+        trace_["num_spans"] = len(spans)
+        trace_["sum_span_duration_ms"] = sum(span["duration_ms"] for span in spans)
+        trace_["spans"] = [
+            dict(
+                {
+                    key: value
+                    for key, value in span.items()
+                    if key not in ("start", "end")
+                },
+                offset_ms=(span["start"] - start) * 1000,
+            )
+            for span in spans
+        ]
+        output.append(trace_)
+    return output
@@ -1,8 +1,8 @@
 import asyncio
 from contextlib import contextmanager
 import aiofiles
-import click
 from collections import OrderedDict, namedtuple, Counter
+from collections.abc import Hashable
 import copy
 import base64
 import hashlib
@@ -21,10 +21,15 @@ import secrets
 import shutil
 from typing import Iterable, List, Tuple
 import urllib
-import yaml
+from datasette.metrics import shared_cache_stats
 from .shutil_backport import copytree
 from .sqlite import sqlite3, supports_table_xinfo
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 if typing.TYPE_CHECKING:
     from datasette.database import Database
 
@@ -139,7 +144,50 @@ def path_from_row_pks(row, pks, use_rowid, quote=True):
     return ",".join(bits)
 
 
-def compound_keys_after_sql(pks, start_index=0):
+def keyset_token(values):
+    """
+    Encode values as a _next token that records the SQLite type of each one,
+    for keyset pagination over columns that may not have a type affinity.
+    """
+    bits = []
+    for value in values:
+        if isinstance(value, dict) and "value" in value:
+            value = value["value"]
+        if value is None:
+            bit = "n"
+        elif isinstance(value, bool) or isinstance(value, int):
+            bit = "i{}".format(int(value))
+        elif isinstance(value, float):
+            bit = "f{!r}".format(value)
+        elif isinstance(value, bytes):
+            bit = "b{}".format(value.hex())
+        else:
+            bit = "s{}".format(value)
+        bits.append(tilde_encode(bit))
+    return ",".join(bits)
+
+
+def keyset_token_values(token):
+    "Decode a token created by keyset_token() - raises ValueError if invalid"
+    values = []
+    for bit in urlsafe_components(token):
+        tag, value = bit[:1], bit[1:]
+        if tag == "n" and not value:
+            values.append(None)
+        elif tag == "i":
+            values.append(int(value))
+        elif tag == "f":
+            values.append(float(value))
+        elif tag == "b":
+            values.append(bytes.fromhex(value))
+        elif tag == "s":
+            values.append(value)
+        else:
+            raise ValueError("Invalid keyset token: {}".format(token))
+    return values
+
+
+def compound_keys_after_sql(pks, start_index=0, param_prefix="p"):
     # Implementation of keyset pagination
     # See https://github.com/simonw/datasette/issues/190
     # For pk1/pk2/pk3 returns:
@@ -156,31 +204,76 @@ def compound_keys_after_sql(pks, start_index=0):
         last = pks_left[-1]
         rest = pks_left[:-1]
         and_clauses = [
-            f"{escape_sqlite(pk)} = :p{i + start_index}" for i, pk in enumerate(rest)
+            f"{escape_sqlite(pk)} = :{param_prefix}{i + start_index}"
+            for i, pk in enumerate(rest)
         ]
-        and_clauses.append(f"{escape_sqlite(last)} > :p{len(rest) + start_index}")
+        and_clauses.append(
+            f"{escape_sqlite(last)} > :{param_prefix}{len(rest) + start_index}"
+        )
         or_clauses.append(f"({' and '.join(and_clauses)})")
         pks_left.pop()
     or_clauses.reverse()
     return "({})".format("\n  or\n".join(or_clauses))
 
 
+def _json_default(obj):
+    if isinstance(obj, sqlite3.Row):
+        return tuple(obj)
+    if isinstance(obj, sqlite3.Cursor):
+        return list(obj)
+    if isinstance(obj, bytes):
+        # Does it encode to utf8?
+        try:
+            return obj.decode("utf8")
+        except UnicodeDecodeError:
+            return {
+                "$base64": True,
+                "encoded": base64.b64encode(obj).decode("latin1"),
+            }
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, sqlite3.Row):
-            return tuple(obj)
-        if isinstance(obj, sqlite3.Cursor):
-            return list(obj)
-        if isinstance(obj, bytes):
-            # Does it encode to utf8?
-            try:
-                return obj.decode("utf8")
-            except UnicodeDecodeError:
-                return {
-                    "$base64": True,
-                    "encoded": base64.b64encode(obj).decode("latin1"),
-                }
-        return json.JSONEncoder.default(self, obj)
+        return _json_default(obj)
+
+
+JSON_ENCODERS = ("json", "orjson", "auto")
+
+
+def _without_infinities(value):
+    if isinstance(value, float):
+        return None if value in _infinities else value
+    if isinstance(value, dict):
+        return {k: _without_infinities(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, sqlite3.Row)):
+        return [_without_infinities(v) for v in value]
+    return value
+
+
+def encode_json(data, encoder="json", infinity=False):
+    """
+    Encode data as a JSON string, handling bytes and sqlite3.Row values.
+
+    Infinite floats become null unless infinity=True, in which case they are
+    output as the non-standard Infinity and -Infinity.
+    """
+    if encoder == "auto":
+        encoder = "orjson" if orjson is not None else "json"
+    if encoder == "orjson" and not infinity:
+        if orjson is None:
+            raise ImportError("The orjson JSON encoder requires the orjson package")
+        # orjson writes infinities as null itself
+        return orjson.dumps(
+            data, default=_json_default, option=orjson.OPT_NON_STR_KEYS
+        ).decode("utf-8")
+    if infinity:
+        return json.dumps(data, cls=CustomJSONEncoder)
+    try:
+        # Avoids scanning every value for infinities up front
+        return json.dumps(data, cls=CustomJSONEncoder, allow_nan=False)
+    except ValueError:
+        return json.dumps(_without_infinities(data), cls=CustomJSONEncoder)
 
 
 @contextmanager
@@ -850,35 +943,6 @@ def remove_infinites(row):
         return [None if (isinstance(c, float) and c in _infinities) else c for c in row]
 
 
-class StaticMount(click.ParamType):
-    name = "mount:directory"
-
-    def convert(self, value, param, ctx):
-        if ":" not in value:
-            self.fail(
-                f'"{value}" should be of format mountpoint:directory',
-                param,
-                ctx,
-            )
-        path, dirpath = value.split(":", 1)
-        dirpath = os.path.abspath(dirpath)
-        if not os.path.exists(dirpath) or not os.path.isdir(dirpath):
-            self.fail(f"{value} is not a valid directory path", param, ctx)
-        return path, dirpath
-
-
-# The --load-extension parameter can optionally include a specific entrypoint.
-# This is done by appending ":entrypoint_name" after supplying the path to the extension
-class LoadExtension(click.ParamType):
-    name = "path:entrypoint?"
-
-    def convert(self, value, param, ctx):
-        if ":" not in value:
-            return value
-        path, entrypoint = value.split(":", 1)
-        return path, entrypoint
-
-
 def format_bytes(bytes):
     current = float(bytes)
     for unit in ("bytes", "KB", "MB", "GB", "TB"):
@@ -992,6 +1056,8 @@ def parse_metadata(content: str) -> dict:
     try:
         return json.loads(content)
     except json.JSONDecodeError:
+        import yaml
+
         try:
             return yaml.safe_load(content)
         except yaml.YAMLError:
@@ -1022,30 +1088,77 @@ async def async_call_with_supported_arguments(fn, **kwargs):
     return await fn(*call_with)
 
 
+class _AllowMatcher:
+    """
+    An "allow" block compiled into sets and flags, so checking an actor
+    against it does not need to re-interpret the block on every call.
+    """
+
+    __slots__ = ("allow", "snapshot", "values")
+
+    def __init__(self, allow):
+        # Holding a reference to allow stops its id() being reused
+        self.allow = allow
+        # Used to spot allow blocks that have been modified in place
+        self.snapshot = {
+            key: list(values) if isinstance(values, list) else values
+            for key, values in allow.items()
+        }
+        self.values = []
+        for key, values in allow.items():
+            # "*" against a missing key falls through to a literal match
+            if not isinstance(values, list):
+                values = [values]
+            try:
+                values = frozenset(values)
+            except TypeError:
+                # Unhashable values such as nested lists can never match
+                values = frozenset(v for v in values if isinstance(v, Hashable))
+            self.values.append((key, values))
+
+    def matches(self, actor):
+        for key, values in self.values:
+            actor_values = actor.get(key)
+            if actor_values is None:
+                continue
+            if isinstance(actor_values, list):
+                if not values.isdisjoint(actor_values):
+                    return True
+            elif actor_values in values:
+                return True
+        return False
+
+
+_allow_matcher_cache = {}
+_ALLOW_MATCHER_CACHE_SIZE = 1024
+_allow_matcher_cache_stats = shared_cache_stats("allow_matchers")
+
+
 def actor_matches_allow(actor, allow):
     if allow is True:
         return True
     if allow is False:
         return False
-    if actor is None and allow and allow.get("unauthenticated") is True:
-        return True
     if allow is None:
         return True
-    actor = actor or {}
+    if actor is None:
+        return allow.get("unauthenticated") is True
+    # Wildcards are cheaper to check than a cache lookup
     for key, values in allow.items():
         if values == "*" and key in actor:
             return True
-        if not isinstance(values, list):
-            values = [values]
-        actor_values = actor.get(key)
-        if actor_values is None:
-            continue
-        if not isinstance(actor_values, list):
-            actor_values = [actor_values]
-        actor_values = set(actor_values)
-        if actor_values.intersection(values):
-            return True
-    return False
+    matcher = _allow_matcher_cache.get(id(allow))
+    if matcher is not None and matcher.allow is allow and matcher.snapshot == allow:
+        _allow_matcher_cache_stats.hits += 1
+    else:
+        _allow_matcher_cache_stats.misses += 1
+        matcher = _AllowMatcher(allow)
+        _allow_matcher_cache.pop(id(allow), None)
+        if len(_allow_matcher_cache) >= _ALLOW_MATCHER_CACHE_SIZE:
+            # Evict the least recently compiled matcher
+            del _allow_matcher_cache[next(iter(_allow_matcher_cache))]
+        _allow_matcher_cache[id(allow)] = matcher
+    return matcher.matches(actor)
 
 
 def resolve_env_secrets(config, environ):
@@ -1368,6 +1481,7 @@ _table_config_keys = (
     "fts_table",
     "fts_pk",
     "searchmode",
+    "keyset_columns",
 )
 
 
@@ -1432,11 +1546,21 @@ def md5_not_usedforsecurity(s):
 
 
 _etag_cache = {}
-
-
-async def calculate_etag(filepath, chunk_size=4096):
-    if filepath in _etag_cache:
+_etag_cache_stats = shared_cache_stats("etags")
+# (st_mtime_ns, st_size) of files at the time their ETag was calculated
+_etag_stats = {}
+
+
+async def calculate_etag(filepath, chunk_size=4096, stat_result=None):
+    # If stat_result is provided the cached ETag is only used if the file's
+    # modification time and size have not changed since it was calculated
+    stats = stat_result and (stat_result.st_mtime_ns, stat_result.st_size)
+    if filepath in _etag_cache and (
+        stats is None or _etag_stats.get(filepath, stats) == stats
+    ):
+        _etag_cache_stats.hits += 1
         return _etag_cache[filepath]
+    _etag_cache_stats.misses += 1
 
     hasher = hashlib.md5()
     async with aiofiles.open(filepath, "rb") as f:
@@ -1448,6 +1572,8 @@ async def calculate_etag(filepath, chunk_size=4096):
 
     etag = f'"{hasher.hexdigest()}"'
     _etag_cache[filepath] = etag
+    if stats is not None:
+        _etag_stats[filepath] = stats
 
     return etag
 
@@ -1459,3 +1585,13 @@ def deep_dict_update(dict1, dict2):
         else:
             dict1[key] = value
     return dict1
+
+
+def __getattr__(name):
+    # These click parameter types are only needed by the CLI, so click is
+    # not imported until they are used
+    if name in ("LoadExtension", "StaticMount"):
+        from datasette.utils import click_types
+
+        return getattr(click_types, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
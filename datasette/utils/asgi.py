@@ -1,5 +1,9 @@
+from contextvars import ContextVar
 import hashlib
 import json
+import os
+import secrets
+import zlib
 from datasette.utils import MultiParams, calculate_etag
 from mimetypes import guess_type
 from urllib.parse import parse_qs, urlunparse, parse_qsl
@@ -8,6 +12,11 @@ from http.cookies import SimpleCookie, Morsel
 import aiofiles
 import aiofiles.os
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Workaround for adding samesite support to pre 3.8 python
 Morsel._reserved["samesite"] = "SameSite"
 # Thanks, Starlette:
@@ -51,6 +60,18 @@ class BadRequest(Base400):
     status = 400
 
 
+class Base500(Exception):
+    status = 500
+
+
+class ServiceUnavailable(Base500):
+    status = 503
+
+
+# Path of the request currently being handled, used to record which page
+# caused a slow query
+current_request_path = ContextVar("current_request_path", default=None)
+
 SAMESITE_VALUES = ("strict", "lax", "none")
 
 
@@ -217,10 +238,12 @@ class AsgiWriter:
         self.send = send
 
     async def write(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
         await self.send(
             {
                 "type": "http.response.body",
-                "body": chunk.encode("utf-8"),
+                "body": chunk,
                 "more_body": True,
             }
         )
@@ -280,40 +303,223 @@ async def asgi_start(send, status, headers=None, content_type="text/plain"):
     )
 
 
+# Files are sent in chunks of between these sizes, depending on file size
+MIN_FILE_CHUNK_SIZE = 64 * 1024
+MAX_FILE_CHUNK_SIZE = 1024 * 1024
+
+ZEROCOPY_SEND = "http.response.zerocopysend"
+
+# Requests for more byte ranges than this are answered with the whole file
+MAX_RANGES = 16
+
+
+def file_chunk_size(size):
+    "Chunk size for sending a file - larger files are sent in larger chunks"
+    return max(MIN_FILE_CHUNK_SIZE, min(MAX_FILE_CHUNK_SIZE, size // 64))
+
+
+def parse_range_header(range_header, size):
+    """
+    Parse a Range: bytes=... header into a list of (start, end) byte ranges,
+    where end is inclusive. Returns None if the header should be ignored and
+    the whole file sent, or an empty list if no range can be satisfied.
+    """
+    if not range_header:
+        return None
+    unit, _, specs = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        first, dash, last = spec.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if not first:
+                # bytes=-500 is the last 500 bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length and size:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if end is None:
+            end = size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
+
+
+def range_header_for_request(request, etag=None):
+    """
+    The Range header that should be honored for this request: an If-Range
+    header that does not match the current ETag means the client's copy is
+    out of date, so the whole file must be sent
+    """
+    range_header = request.headers.get("range", "")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and (etag is None or if_range.strip() != etag):
+        return ""
+    return range_header
+
+
 async def asgi_send_file(
-    send, filepath, filename=None, content_type=None, chunk_size=4096, headers=None
+    send,
+    filepath,
+    filename=None,
+    content_type=None,
+    chunk_size=None,
+    headers=None,
+    range_header=None,
+    scope=None,
+    size=None,
 ):
+    """
+    Send a file, or byte ranges of it if range_header is provided - several
+    ranges are sent as multipart/byteranges. Pass the ASGI scope to use the
+    zero-copy send extension if the server supports it, and the file size
+    if it is already known to skip a stat.
+    """
     headers = headers or {}
     if filename:
         headers["content-disposition"] = f'attachment; filename="{filename}"'
+    if size is None:
+        size = (await aiofiles.os.stat(str(filepath))).st_size
+    content_type = content_type or guess_type(str(filepath))[0] or "text/plain"
+
+    status = 200
+    # (prefix, offset, count) for each part of the file to send
+    parts = [(b"", 0, size)]
+    suffix = b""
+    if range_header is not None:
+        headers["accept-ranges"] = "bytes"
+        ranges = parse_range_header(range_header, size)
+        if ranges == []:
+            headers["content-range"] = f"bytes */{size}"
+            return await asgi_send(
+                send, "", 416, headers=headers, content_type=content_type
+            )
+        if ranges and len(ranges) == 1:
+            status = 206
+            start, end = ranges[0]
+            parts = [(b"", start, end - start + 1)]
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+        elif ranges and len(ranges) <= MAX_RANGES:
+            status = 206
+            boundary = secrets.token_hex(16)
+            parts = [
+                (
+                    "{}--{}\r\nContent-Type: {}\r\nContent-Range: bytes {}-{}/{}"
+                    "\r\n\r\n".format(
+                        "\r\n" if i else "",
+                        boundary,
+                        content_type,
+                        start,
+                        end,
+                        size,
+                    ).encode("latin-1"),
+                    start,
+                    end - start + 1,
+                )
+                for i, (start, end) in enumerate(ranges)
+            ]
+            suffix = "\r\n--{}--\r\n".format(boundary).encode("latin-1")
+            content_type = f"multipart/byteranges; boundary={boundary}"
+    headers["content-length"] = str(
+        sum(len(prefix) + count for prefix, _, count in parts) + len(suffix)
+    )
 
-    first = True
-    headers["content-length"] = str((await aiofiles.os.stat(str(filepath))).st_size)
-    async with aiofiles.open(str(filepath), mode="rb") as fp:
-        if first:
-            await asgi_start(
-                send,
-                200,
-                headers,
-                content_type or guess_type(str(filepath))[0] or "text/plain",
+    zerocopy = ZEROCOPY_SEND in ((scope or {}).get("extensions") or {})
+    chunk_size = chunk_size or file_chunk_size(max(count for _, _, count in parts))
+
+    async def send_part(fp, offset, count, more_body):
+        if zerocopy:
+            await send(
+                {
+                    "type": ZEROCOPY_SEND,
+                    "file": fp,
+                    "offset": offset,
+                    "count": count,
+                    "more_body": more_body,
+                }
             )
-            first = False
-        more_body = True
-        while more_body:
-            chunk = await fp.read(chunk_size)
-            more_body = len(chunk) == chunk_size
+            return
+        await fp.seek(offset)
+        remaining = count
+        while True:
+            chunk = await fp.read(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            last = remaining <= 0 or not chunk
             await send(
-                {"type": "http.response.body", "body": chunk, "more_body": more_body}
+                {
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": more_body or not last,
+                }
             )
-
-
-def asgi_static(root_path, chunk_size=4096, headers=None, content_type=None):
+            if last:
+                break
+
+    async def send_parts(fp):
+        await asgi_start(send, status, headers, content_type)
+        for i, (prefix, offset, count) in enumerate(parts):
+            if prefix:
+                await send(
+                    {"type": "http.response.body", "body": prefix, "more_body": True}
+                )
+            more_body = bool(suffix) or i < len(parts) - 1
+            await send_part(fp, offset, count, more_body)
+        if suffix:
+            await send({"type": "http.response.body", "body": suffix})
+
+    if zerocopy:
+        # The server reads from the file itself
+        with open(str(filepath), mode="rb") as fp:
+            await send_parts(fp)
+    else:
+        async with aiofiles.open(str(filepath), mode="rb") as fp:
+            await send_parts(fp)
+
+
+def asgi_static(
+    root_path, chunk_size=None, headers=None, content_type=None, immutable=False
+):
     root_path = Path(root_path)
     static_headers = {}
 
     if headers:
         static_headers = headers.copy()
 
+    # For directories that do not change while running: path => (size, ETag,
+    # {encoding: (path, size)} of precompressed .br or .gz variants), recorded
+    # on the first request for each file so later ones need not stat or read it
+    file_info = {}
+
+    async def static_file_info(full_path):
+        info = file_info.get(full_path)
+        if info is not None:
+            return info
+        stat_result = os.stat(full_path)
+        etag = await calculate_etag(full_path, stat_result=stat_result)
+        variants = {}
+        if immutable:
+            for encoding, suffix in PRECOMPRESSED_SUFFIXES.items():
+                variant = full_path.with_name(full_path.name + suffix)
+                try:
+                    variants[encoding] = (variant, variant.stat().st_size)
+                except FileNotFoundError:
+                    continue
+        info = (stat_result.st_size, etag, variants)
+        if immutable:
+            file_info[full_path] = info
+        return info
+
     async def inner_static(request, send):
         path = request.scope["url_route"]["kwargs"]["path"]
         headers = static_headers.copy()
@@ -332,14 +538,30 @@ def asgi_static(root_path, chunk_size=4096, headers=None, content_type=None):
             await asgi_send_html(send, "404: Path not inside root path", 404)
             return
         try:
-            # Calculate ETag for filepath
-            etag = await calculate_etag(full_path, chunk_size=chunk_size)
+            size, etag, variants = await static_file_info(full_path)
+            send_path = full_path
+            if variants:
+                headers["Vary"] = "Accept-Encoding"
+                encoding = choose_encoding(
+                    request.headers.get("accept-encoding"), list(variants)
+                )
+                if encoding:
+                    send_path, size = variants[encoding]
+                    headers["content-encoding"] = encoding
+                    etag = '{}-{}"'.format(etag[:-1], encoding)
             headers["ETag"] = etag
             if_none_match = request.headers.get("if-none-match")
             if if_none_match and if_none_match == etag:
                 return await asgi_send(send, "", 304)
             await asgi_send_file(
-                send, full_path, chunk_size=chunk_size, headers=headers
+                send,
+                send_path,
+                chunk_size=chunk_size,
+                headers=headers,
+                content_type=content_type or guess_type(str(full_path))[0],
+                range_header=range_header_for_request(request, etag),
+                scope=request.scope,
+                size=size,
             )
         except FileNotFoundError:
             await asgi_send_html(send, "404: File not found", 404)
@@ -348,6 +570,157 @@ def asgi_static(root_path, chunk_size=4096, headers=None, content_type=None):
     return inner_static
 
 
+# Encodings in order of preference, and the suffixes of precompressed files
+PRECOMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# Responses smaller than this are not worth compressing
+COMPRESSION_MIN_SIZE = 1024
+
+COMPRESSIBLE_CONTENT_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/geo+json",
+    "image/svg+xml",
+)
+
+
+def choose_encoding(accept_encoding, encodings=None):
+    """
+    Pick the preferred encoding that is acceptable according to an
+    Accept-Encoding header, or None if the response should not be encoded
+    """
+    if encodings is None:
+        encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor()
+        else:
+            # wbits=31 produces a gzip rather than a zlib stream
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # Flush after every message so streamed responses are not held back
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+class AsgiCompression:
+    """
+    Compresses responses with gzip or brotli, depending on the request's
+    Accept-Encoding header. Streamed responses are compressed as they are
+    sent. Responses that are small, already encoded, carry an ETag or are
+    not of a textual content type are passed through unchanged.
+    """
+
+    def __init__(self, app, min_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") == "HEAD":
+            return await self.app(scope, receive, send)
+        accept_encoding = None
+        for key, value in scope.get("headers") or []:
+            if key.lower() == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = choose_encoding(accept_encoding)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+
+        async def wrapped_send(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                if self._should_compress(message):
+                    # Hold back the start until the first body message
+                    start = message
+                    return
+                return await send(message)
+            if message["type"] != "http.response.body" or (
+                start is None and compressor is None
+            ):
+                return await send(message)
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                if not more_body and len(body) < self.min_size:
+                    await send(start)
+                    start = None
+                    return await send(message)
+                headers = [
+                    [key, value]
+                    for key, value in start["headers"]
+                    if key.lower() not in (b"content-length", b"vary")
+                ]
+                vary = [
+                    value for key, value in start["headers"] if key.lower() == b"vary"
+                ]
+                headers.append([b"content-encoding", encoding.encode("latin-1")])
+                headers.append([b"vary", b", ".join(vary + [b"Accept-Encoding"])])
+                await send(dict(start, headers=headers))
+                start = None
+                compressor = _Compressor(encoding)
+            chunk = compressor.compress(body)
+            if not more_body:
+                chunk += compressor.finish()
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": more_body}
+            )
+
+        await self.app(scope, receive, wrapped_send)
+        if start is not None:
+            # Response ended without sending a body
+            await send(start)
+            await send({"type": "http.response.body", "body": b""})
+
+    def _should_compress(self, message):
+        if message.get("status") in (204, 206, 304, 416):
+            return False
+        content_type = b""
+        for key, value in message.get("headers") or []:
+            key = key.lower()
+            if key in (b"content-encoding", b"content-range", b"etag"):
+                return False
+            if key == b"content-length" and int(value) < self.min_size:
+                return False
+            if key == b"content-type":
+                content_type = value
+        return (
+            content_type.decode("latin-1")
+            .lower()
+            .startswith(COMPRESSIBLE_CONTENT_TYPES)
+        )
+
+
 class Response:
     def __init__(self, body=None, status=200, headers=None, content_type="text/plain"):
         self.body = body
@@ -450,19 +823,28 @@ class AsgiFileDownload:
         filename=None,
         content_type="application/octet-stream",
         headers=None,
+        request=None,
     ):
         self.headers = headers or {}
         self.filepath = filepath
         self.filename = filename
         self.content_type = content_type
+        # If a request is provided, Range: headers are supported
+        self.request = request
 
     async def asgi_send(self, send):
+        range_header = None
+        if self.request is not None:
+            etag = {k.lower(): v for k, v in self.headers.items()}.get("etag")
+            range_header = range_header_for_request(self.request, etag)
         return await asgi_send_file(
             send,
             self.filepath,
             filename=self.filename,
             content_type=self.content_type,
             headers=self.headers,
+            range_header=range_header,
+            scope=self.request.scope if self.request else None,
         )
 
 
@@ -0,0 +1,31 @@
+import click
+import os
+
+
+class StaticMount(click.ParamType):
+    name = "mount:directory"
+
+    def convert(self, value, param, ctx):
+        if ":" not in value:
+            self.fail(
+                f'"{value}" should be of format mountpoint:directory',
+                param,
+                ctx,
+            )
+        path, dirpath = value.split(":", 1)
+        dirpath = os.path.abspath(dirpath)
+        if not os.path.exists(dirpath) or not os.path.isdir(dirpath):
+            self.fail(f"{value} is not a valid directory path", param, ctx)
+        return path, dirpath
+
+
+# The --load-extension parameter can optionally include a specific entrypoint.
+# This is done by appending ":entrypoint_name" after supplying the path to the extension
+class LoadExtension(click.ParamType):
+    name = "path:entrypoint?"
+
+    def convert(self, value, param, ctx):
+        if ":" not in value:
+            return value
+        path, entrypoint = value.split(":", 1)
+        return path, entrypoint
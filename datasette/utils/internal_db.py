@@ -60,6 +60,17 @@ async def init_internal_db(db):
         FOREIGN KEY (database_name) REFERENCES databases(database_name),
         FOREIGN KEY (database_name, table_name) REFERENCES tables(database_name, table_name)
     );
+    CREATE TABLE IF NOT EXISTS slow_queries (
+        id INTEGER PRIMARY KEY,
+        created TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+        database_name TEXT,
+        path TEXT,
+        sql TEXT,
+        params TEXT, -- JSON names and types of the parameters, not their values
+        duration_ms REAL,
+        interrupted INTEGER,
+        query_plan TEXT -- JSON rows from EXPLAIN QUERY PLAN
+    );
     """
     ).strip()
     await db.execute_write_script(create_tables_sql)
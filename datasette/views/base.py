@@ -1,6 +1,8 @@
 import asyncio
 import csv
 import hashlib
+import io
+import json
 import sys
 import textwrap
 import time
@@ -8,12 +10,19 @@ import urllib
 from markupsafe import escape
 
 
+from datasette.arrow_renderer import (
+    ARROW_CONTENT_TYPES,
+    ArrowEncoder,
+    arrow_filename,
+    declared_types_for_stream,
+)
 from datasette.database import QueryInterrupted
+from datasette.plugins import pm
+from datasette.renderer import convert_specific_columns_to_json
 from datasette.utils.asgi import Request
 from datasette.utils import (
     add_cors_headers,
     await_me_maybe,
-    EscapeHtmlWriter,
     InvalidSql,
     LimitedWriter,
     call_with_supported_arguments,
@@ -21,7 +30,10 @@ from datasette.utils import (
     path_with_added_args,
     path_with_removed_args,
     path_with_format,
+    encode_json,
     sqlite3,
+    value_as_boolean,
+    WriteLimitExceeded,
 )
 from datasette.utils.asgi import (
     AsgiStream,
@@ -403,19 +415,80 @@ class DataView(BaseView):
         return response
 
 
+async def plugin_cell_renderers(datasette, database, table, columns, request):
+    """
+    Resolves plugin cell rendering once per page. Returns a list with one
+    entry per column: None if no plugin can render cells in that column,
+    otherwise an async function taking (row, value) that returns the plugin
+    display value or None.
+    """
+    # pylint: disable=no-member
+    has_render_cell = bool(pm.hook.render_cell.get_hookimpls())
+    has_render_cells = bool(pm.hook.render_cells.get_hookimpls())
+    if not has_render_cell and not has_render_cells:
+        return [None] * len(columns)
+
+    def make_renderer(column, column_functions):
+        async def render(row, value):
+            for fn in column_functions:
+                candidate = await await_me_maybe(fn(row, value))
+                if candidate is not None:
+                    return candidate
+            if not has_render_cell:
+                return None
+            for candidate in pm.hook.render_cell(
+                row=row,
+                value=value,
+                column=column,
+                table=table,
+                database=database,
+                datasette=datasette,
+                request=request,
+            ):
+                candidate = await await_me_maybe(candidate)
+                if candidate is not None:
+                    return candidate
+            return None
+
+        return render
+
+    renderers = []
+    for column in columns:
+        column_functions = []
+        if has_render_cells:
+            for fn in pm.hook.render_cells(
+                column=column,
+                table=table,
+                database=database,
+                datasette=datasette,
+                request=request,
+            ):
+                # Not await_me_maybe(), since that would call the function
+                if asyncio.iscoroutine(fn):
+                    fn = await fn
+                if fn is not None:
+                    column_functions.append(fn)
+        if column_functions or has_render_cell:
+            renderers.append(make_renderer(column, column_functions))
+        else:
+            renderers.append(None)
+    return renderers
+
+
 def _error(messages, status=400):
     return Response.json({"ok": False, "errors": messages}, status=status)
 
 
-async def stream_csv(datasette, fetch_data, request, database):
-    kwargs = {}
-    stream = request.args.get("_stream")
+def _request_without_facets_or_count(request, max_size=False):
     # Do not calculate facets or counts:
     extra_parameters = [
         "{}=1".format(key)
         for key in ("_nofacet", "_nocount")
         if not request.args.get(key)
     ]
+    # Streams that follow every page use pages that are as large as possible
+    if max_size and not request.args.get("_size"):
+        extra_parameters.append("_size=max")
     if extra_parameters:
         # Replace request object with a new one with modified scope
         if not request.query_string:
@@ -425,14 +498,10 @@ async def stream_csv(datasette, fetch_data, request, database):
         new_scope = dict(request.scope, query_string=new_query_string.encode("latin-1"))
         receive = request.receive
         request = Request(new_scope, receive)
-    if stream:
-        # Some quick soundness checks
-        if not datasette.setting("allow_csv_stream"):
-            raise BadRequest("CSV streaming is disabled")
-        if request.args.get("_next"):
-            raise BadRequest("_next not allowed for CSV streaming")
-        kwargs["_size"] = "max"
-    # Fetch the first page
+    return request
+
+
+async def _fetch_first_page(fetch_data, request):
     try:
         response_or_template_contexts = await fetch_data(request)
         if isinstance(response_or_template_contexts, Response):
@@ -449,6 +518,26 @@ async def stream_csv(datasette, fetch_data, request, database):
 
     except DatasetteError:
         raise
+    return data
+
+
+# CSV output is sent to the client in chunks of around this size
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+async def stream_csv(datasette, fetch_data, request, database):
+    stream = request.args.get("_stream")
+    request = _request_without_facets_or_count(request, max_size=bool(stream))
+    if stream:
+        # Some quick soundness checks
+        if not datasette.setting("allow_csv_stream"):
+            raise BadRequest("CSV streaming is disabled")
+        if request.args.get("_next"):
+            raise BadRequest("_next not allowed for CSV streaming")
+    # Fetch the first page
+    data = await _fetch_first_page(fetch_data, request)
+    if isinstance(data, Response):
+        return data
 
     # Convert rows and columns to CSV
     headings = data["columns"]
@@ -474,90 +563,109 @@ async def stream_csv(datasette, fetch_data, request, database):
         )
         postamble = "</textarea></body></html>"
 
+    def blob_url(data, row, column, cell):
+        # If this is a table page, use .urls.row_blob()
+        if data.get("table"):
+            pks = data.get("primary_keys") or []
+            return datasette.absolute_url(
+                request,
+                datasette.urls.row_blob(
+                    database,
+                    data["table"],
+                    path_from_row_pks(row, pks, not pks),
+                    column,
+                ),
+            )
+        # Otherwise generate URL for this query
+        url = datasette.absolute_url(
+            request,
+            path_with_format(
+                request=request,
+                format="blob",
+                extra_qs={
+                    "_blob_column": column,
+                    "_blob_hash": hashlib.sha256(cell).hexdigest(),
+                },
+                replace_format="csv",
+            ),
+        )
+        return url.replace("&_nocount=1", "").replace("&_nofacet=1", "")
+
+    def csv_rows(data):
+        for row in data["rows"]:
+            if any(isinstance(r, bytes) for r in row):
+                row = [
+                    (
+                        blob_url(data, row, column, cell)
+                        if isinstance(cell, bytes)
+                        else cell
+                    )
+                    for column, cell in zip(headings, row)
+                ]
+            if not expanded_columns:
+                # Simple path
+                yield row
+                continue
+            # Look for {"value": "label": } dicts and expand
+            new_row = []
+            for heading, cell in zip(data["columns"], row):
+                if heading in expanded_columns:
+                    if cell is None:
+                        new_row.extend(("", ""))
+                    else:
+                        if not isinstance(cell, dict):
+                            new_row.extend((cell, ""))
+                        else:
+                            new_row.append(cell["value"])
+                            new_row.append(cell["label"])
+                else:
+                    new_row.append(cell)
+            yield new_row
+
     async def stream_fn(r):
-        nonlocal data, trace
+        nonlocal data
         limited_writer = LimitedWriter(r, datasette.setting("max_csv_mb"))
+        # Rows are written to an in-memory buffer which is sent in chunks of
+        # around CSV_CHUNK_SIZE, rather than sending one message per row
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def take_buffer():
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return escape(chunk) if trace else chunk
+
         if trace:
             await limited_writer.write(preamble)
-            writer = csv.writer(EscapeHtmlWriter(limited_writer))
-        else:
-            writer = csv.writer(limited_writer)
-        first = True
-        next = None
-        while first or (next and stream):
-            try:
-                kwargs = {}
+        if request.args.get("_header") != "off":
+            writer.writerow(headings)
+        next_page = None
+        try:
+            while True:
+                next = data.get("next") if stream else None
                 if next:
-                    kwargs["_next"] = next
-                if not first:
-                    data, _, _ = await fetch_data(request, **kwargs)
-                if first:
-                    if request.args.get("_header") != "off":
-                        await writer.writerow(headings)
-                    first = False
-                next = data.get("next")
-                for row in data["rows"]:
-                    if any(isinstance(r, bytes) for r in row):
-                        new_row = []
-                        for column, cell in zip(headings, row):
-                            if isinstance(cell, bytes):
-                                # If this is a table page, use .urls.row_blob()
-                                if data.get("table"):
-                                    pks = data.get("primary_keys") or []
-                                    cell = datasette.absolute_url(
-                                        request,
-                                        datasette.urls.row_blob(
-                                            database,
-                                            data["table"],
-                                            path_from_row_pks(row, pks, not pks),
-                                            column,
-                                        ),
-                                    )
-                                else:
-                                    # Otherwise generate URL for this query
-                                    url = datasette.absolute_url(
-                                        request,
-                                        path_with_format(
-                                            request=request,
-                                            format="blob",
-                                            extra_qs={
-                                                "_blob_column": column,
-                                                "_blob_hash": hashlib.sha256(
-                                                    cell
-                                                ).hexdigest(),
-                                            },
-                                            replace_format="csv",
-                                        ),
-                                    )
-                                    cell = url.replace("&_nocount=1", "").replace(
-                                        "&_nofacet=1", ""
-                                    )
-                            new_row.append(cell)
-                        row = new_row
-                    if not expanded_columns:
-                        # Simple path
-                        await writer.writerow(row)
-                    else:
-                        # Look for {"value": "label": } dicts and expand
-                        new_row = []
-                        for heading, cell in zip(data["columns"], row):
-                            if heading in expanded_columns:
-                                if cell is None:
-                                    new_row.extend(("", ""))
-                                else:
-                                    if not isinstance(cell, dict):
-                                        new_row.extend((cell, ""))
-                                    else:
-                                        new_row.append(cell["value"])
-                                        new_row.append(cell["label"])
-                            else:
-                                new_row.append(cell)
-                        await writer.writerow(new_row)
-            except Exception as ex:
-                sys.stderr.write("Caught this error: {}\n".format(ex))
-                sys.stderr.flush()
-                await r.write(str(ex))
-                return
+                    # Fetch the next page while this one is being written
+                    next_page = asyncio.ensure_future(fetch_data(request, _next=next))
+                for row in csv_rows(data):
+                    writer.writerow(row)
+                    if buffer.tell() >= CSV_CHUNK_SIZE:
+                        await limited_writer.write(take_buffer())
+                if next_page is None:
+                    break
+                data, _, _ = await next_page
+                next_page = None
+            await limited_writer.write(take_buffer())
+        except Exception as ex:
+            if next_page is not None:
+                next_page.cancel()
+            sys.stderr.write("Caught this error: {}\n".format(ex))
+            sys.stderr.flush()
+            if not isinstance(ex, WriteLimitExceeded):
+                # Send the rows that were written before the error
+                await r.write(take_buffer())
+            await r.write(str(ex))
+            return
         await limited_writer.write(postamble)
 
     headers = {}
@@ -572,3 +680,160 @@ async def stream_csv(datasette, fetch_data, request, database):
         headers["content-disposition"] = disposition
 
     return AsgiStream(stream_fn, headers=headers, content_type=content_type)
+
+
+async def stream_json(datasette, fetch_data, request):
+    """
+    Stream every page of results as JSON, following "next" tokens, so
+    the full set of rows never needs to be held in memory at once.
+    """
+    shape = request.args.get("_shape") or "objects"
+    nl = value_as_boolean(request.args.get("_nl", "0")) and shape == "array"
+    if shape not in ("objects", "arrays", "array"):
+        raise BadRequest("_shape={} is not supported for JSON streaming".format(shape))
+    if not datasette.setting("allow_json_stream"):
+        raise BadRequest("JSON streaming is disabled")
+    if request.args.get("_next"):
+        raise BadRequest("_next not allowed for JSON streaming")
+    request = _request_without_facets_or_count(request, max_size=True)
+    data = await _fetch_first_page(fetch_data, request)
+    if isinstance(data, Response):
+        return data
+
+    json_cols = set(request.args.getlist("_json"))
+    json_infinity = value_as_boolean(request.args.get("_json_infinity", "0"))
+    encoder = datasette.setting("json_encoder")
+
+    def encode_rows(data):
+        columns = data["columns"]
+        rows = data["rows"]
+        if json_cols.intersection(columns):
+            rows = convert_specific_columns_to_json(rows, columns, json_cols)
+        if shape != "arrays":
+            rows = [dict(zip(columns, row)) for row in rows]
+        if nl:
+            return "\n".join(
+                encode_json(row, encoder=encoder, infinity=json_infinity)
+                for row in rows
+            )
+        # Encode the whole page in one call, then strip the [ and ]
+        return encode_json(rows, encoder=encoder, infinity=json_infinity)[1:-1]
+
+    error_closing = None
+    if nl:
+        content_type = "text/plain"
+        opening, separator, closing = "", "\n", ""
+    elif shape == "array":
+        content_type = "application/json; charset=utf-8"
+        opening, separator, closing = "[", ",\n", "]"
+    else:
+        content_type = "application/json; charset=utf-8"
+        # "ok" comes after the rows, so an error part way through can be
+        # reported in a well-formed document
+        opening, separator, closing = '{"rows": [', ",\n", '], "ok": true}'
+        error_closing = '], "ok": false, "error": {}}}'
+
+    async def stream_fn(r):
+        nonlocal data
+        await r.write(opening)
+        first = True
+        while True:
+            try:
+                # One write per page rather than one per row
+                if data["rows"]:
+                    chunk = encode_rows(data)
+                    await r.write(chunk if first else separator + chunk)
+                    first = False
+                next = data.get("next")
+                if not next:
+                    break
+                data, _, _ = await fetch_data(request, _next=next)
+            except Exception as ex:
+                sys.stderr.write("Caught this error: {}\n".format(ex))
+                sys.stderr.flush()
+                if error_closing is None:
+                    # A list of rows has nowhere to report an error, so abort
+                    # the connection rather than let it look complete
+                    raise
+                await r.write(error_closing.format(json.dumps(str(ex))))
+                return
+        await r.write(closing)
+
+    headers = {}
+    if datasette.cors:
+        add_cors_headers(headers)
+    return AsgiStream(stream_fn, headers=headers, content_type=content_type)
+
+
+async def stream_arrow(datasette, fetch_data, request, db, format_, table=None):
+    """
+    Stream results as an Arrow IPC stream or a Parquet file, one record
+    batch per page. Like CSV, only the first page is returned unless
+    ?_stream=1 is passed, in which case every page is followed.
+    """
+    stream = request.args.get("_stream")
+    if stream:
+        if not datasette.setting("allow_csv_stream"):
+            raise BadRequest("Streaming is disabled")
+        if request.args.get("_next"):
+            raise BadRequest("_next not allowed for streaming")
+    request = _request_without_facets_or_count(request, max_size=bool(stream))
+    data = await _fetch_first_page(fetch_data, request)
+    if isinstance(data, Response):
+        return data
+
+    declared_types = None
+    if table is not None:
+        if stream:
+            declared_types = await declared_types_for_stream(db, table)
+        else:
+            declared_types = {
+                column.name: column.type
+                for column in await db.table_column_details(table)
+            }
+    encoder = ArrowEncoder(
+        format_,
+        data["columns"],
+        data["rows"],
+        expanded_columns=data.get("expanded_columns"),
+        declared_types=declared_types,
+        stream=bool(stream),
+    )
+
+    async def stream_fn(r):
+        nonlocal data
+        next_page = None
+        try:
+            while True:
+                next = data.get("next") if stream else None
+                if next:
+                    # Fetch the next page while this one is being encoded
+                    next_page = asyncio.ensure_future(fetch_data(request, _next=next))
+                chunk = encoder.encode(data["rows"])
+                if chunk:
+                    await r.write(chunk)
+                if next_page is None:
+                    break
+                data, _, _ = await next_page
+                next_page = None
+            await r.write(encoder.close())
+        except Exception as ex:
+            if next_page is not None:
+                next_page.cancel()
+            # There is no way to signal an error part way through a binary
+            # format, so abort the connection rather than let a truncated
+            # file look like a complete one
+            sys.stderr.write("Caught this error: {}\n".format(ex))
+            sys.stderr.flush()
+            raise
+
+    headers = {
+        "content-disposition": 'attachment; filename="{}"'.format(
+            arrow_filename(request, format_, database=db.name)
+        )
+    }
+    if datasette.cors:
+        add_cors_headers(headers)
+    return AsgiStream(
+        stream_fn, headers=headers, content_type=ARROW_CONTENT_TYPES[format_]
+    )
@@ -7,7 +7,7 @@ import json
 import markupsafe
 import os
 import re
-import sqlite_utils
+import tempfile
 import textwrap
 from typing import List
 
@@ -17,8 +17,12 @@ from datasette.utils import (
     add_cors_headers,
     await_me_maybe,
     call_with_supported_arguments,
+    compound_keys_after_sql,
+    escape_sqlite,
     named_parameters as derive_named_parameters,
     format_bytes,
+    keyset_token,
+    keyset_token_values,
     make_slot_function,
     tilde_decode,
     to_css_class,
@@ -27,14 +31,32 @@ from datasette.utils import (
     path_with_added_args,
     path_with_format,
     path_with_removed_args,
+    path_with_replaced_args,
     sqlite3,
     truncate_url,
     InvalidSql,
 )
-from datasette.utils.asgi import AsgiFileDownload, NotFound, Response, Forbidden
+from datasette.utils.asgi import (
+    AsgiFileDownload,
+    asgi_send_file,
+    BadRequest,
+    NotFound,
+    Response,
+    Forbidden,
+)
 from datasette.plugins import pm
 
-from .base import BaseView, DatasetteError, View, _error, stream_csv
+from datasette.arrow_renderer import is_arrow_format
+from .base import (
+    BaseView,
+    DatasetteError,
+    View,
+    _error,
+    plugin_cell_renderers,
+    stream_arrow,
+    stream_csv,
+    stream_json,
+)
 
 
 class DatabaseView(View):
@@ -161,7 +183,7 @@ class DatabaseView(View):
             "metadata": metadata,
             "count_limit": db.count_limit,
             "allow_download": datasette.setting("allow_download")
-            and not db.is_mutable
+            and (not db.is_mutable or datasette.setting("allow_snapshot_download"))
             and not db.is_memory,
             "attached_databases": attached_databases,
             "alternate_url_json": alternate_url_json,
@@ -268,6 +290,10 @@ class QueryContext:
             "help": "Callable returning a list of links for the query action menu"
         }
     )
+    next_url: str = field(
+        default=None,
+        metadata={"help": "URL for the next page, for keyset paginated queries"},
+    )
 
 
 async def get_tables(datasette, request, db):
@@ -305,6 +331,34 @@ async def get_tables(datasette, request, db):
     return tables
 
 
+class SnapshotDownload:
+    """
+    Sends a consistent copy of a mutable database. The snapshot is taken
+    when the response is sent and deleted once it has been sent, so writes
+    to the database are never blocked by a slow download.
+    """
+
+    def __init__(self, db, filename, headers):
+        self.db = db
+        self.filename = filename
+        self.headers = headers
+
+    async def asgi_send(self, send):
+        fd, snapshot_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            await self.db.snapshot(snapshot_path)
+            await asgi_send_file(
+                send,
+                snapshot_path,
+                filename=self.filename,
+                content_type="application/octet-stream",
+                headers=self.headers,
+            )
+        finally:
+            os.remove(snapshot_path)
+
+
 async def database_download(request, datasette):
     database = tilde_decode(request.url_vars["database"])
     await datasette.ensure_permissions(
@@ -322,7 +376,9 @@ async def database_download(request, datasette):
 
     if db.is_memory:
         raise DatasetteError("Cannot download in-memory databases", status=404)
-    if not datasette.setting("allow_download") or db.is_mutable:
+    if not datasette.setting("allow_download") or (
+        db.is_mutable and not datasette.setting("allow_snapshot_download")
+    ):
         raise Forbidden("Database download is forbidden")
     if not db.path:
         raise DatasetteError("Cannot download database", status=404)
@@ -330,6 +386,8 @@ async def database_download(request, datasette):
     headers = {}
     if datasette.cors:
         add_cors_headers(headers)
+    if db.is_mutable:
+        return SnapshotDownload(db, os.path.basename(filepath), headers)
     if db.hash:
         etag = '"{}"'.format(db.hash)
         headers["Etag"] = etag
@@ -337,12 +395,12 @@ async def database_download(request, datasette):
         if_none_match = request.headers.get("if-none-match")
         if if_none_match and if_none_match == etag:
             return Response("", status=304)
-    headers["Transfer-Encoding"] = "chunked"
     return AsgiFileDownload(
         filepath,
         filename=os.path.basename(filepath),
         content_type="application/octet-stream",
         headers=headers,
+        request=request,
     )
 
 
@@ -510,12 +568,22 @@ class QueryView(View):
         if params.get("_timelimit"):
             extra_args["custom_time_limit"] = int(params["_timelimit"])
 
+        # Read-only canned queries with keyset_columns can be paginated
+        keyset_columns = None
+        page_size = None
+        if canned_query and not canned_query_write:
+            keyset_columns = canned_query.get("keyset_columns") or None
+        if keyset_columns:
+            page_size = _page_size(datasette, request)
+
         format_ = request.url_vars.get("format") or "html"
 
         query_error = None
         results = None
         rows = []
         columns = []
+        next_value = None
+        next_url = None
 
         params_for_query = params
 
@@ -528,9 +596,27 @@ class QueryView(View):
                     # Canned queries can run magic parameters
                     params_for_query = MagicParameters(sql, params, request, datasette)
                     await params_for_query.execute_params()
-                results = await datasette.execute(
-                    database, sql, params_for_query, truncate=True, **extra_args
-                )
+                if keyset_columns:
+                    results, next_value = await _execute_keyset_page(
+                        db,
+                        sql,
+                        params_for_query,
+                        keyset_columns,
+                        request.args.get("_next"),
+                        page_size,
+                        **extra_args,
+                    )
+                    if next_value:
+                        next_url = datasette.absolute_url(
+                            request,
+                            datasette.urls.path(
+                                path_with_replaced_args(request, {"_next": next_value})
+                            ),
+                        )
+                else:
+                    results = await datasette.execute(
+                        database, sql, params_for_query, truncate=True, **extra_args
+                    )
                 columns = results.columns
                 rows = results.rows
             except QueryInterrupted as ex:
@@ -566,13 +652,38 @@ class QueryView(View):
                 raise
 
         # Handle formats from plugins
-        if format_ == "csv":
+        if (
+            format_ == "csv"
+            or (format_ == "json" and request.args.get("_stream"))
+            or is_arrow_format(datasette, format_)
+        ):
 
             async def fetch_data_for_csv(request, _next=None):
+                if keyset_columns:
+                    results, next_value = await _execute_keyset_page(
+                        db,
+                        sql,
+                        params,
+                        keyset_columns,
+                        _next or request.args.get("_next"),
+                        _page_size(datasette, request),
+                    )
+                    data = {
+                        "rows": results.rows,
+                        "columns": results.columns,
+                        "next": next_value,
+                    }
+                    return data, None, None
                 results = await db.execute(sql, params, truncate=True)
                 data = {"rows": results.rows, "columns": results.columns}
                 return data, None, None
 
+            if format_ == "json":
+                return await stream_json(datasette, fetch_data_for_csv, request)
+            if format_ != "csv":
+                return await stream_arrow(
+                    datasette, fetch_data_for_csv, request, db, format_
+                )
             return await stream_csv(datasette, fetch_data_for_csv, request, db.name)
         elif format_ in datasette.renderers.keys():
             # Dispatch request to the correct output format renderer
@@ -592,7 +703,14 @@ class QueryView(View):
                 error=query_error,
                 # These will be deprecated in Datasette 1.0:
                 args=request.args,
-                data={"ok": True, "rows": rows, "columns": columns},
+                data=dict(
+                    {"ok": True, "rows": rows, "columns": columns},
+                    **(
+                        {"next": next_value, "next_url": next_url}
+                        if keyset_columns
+                        else {}
+                    ),
+                ),
             )
             if asyncio.iscoroutine(result):
                 result = await result
@@ -782,6 +900,7 @@ class QueryView(View):
                             query_name=canned_query["name"] if canned_query else None,
                         ),
                         query_actions=query_actions,
+                        next_url=next_url,
                     ),
                     request=request,
                     view_name="database",
@@ -790,11 +909,75 @@ class QueryView(View):
             )
         else:
             assert False, "Invalid format: {}".format(format_)
+        if next_url:
+            r.headers["link"] = f'<{next_url}>; rel="next"'
         if datasette.cors:
             add_cors_headers(r.headers)
         return r
 
 
+def _page_size(datasette, request):
+    page_size = request.args.get("_size")
+    if not page_size:
+        return datasette.page_size
+    if page_size == "max":
+        return datasette.max_returned_rows
+    try:
+        page_size = int(page_size)
+        if page_size < 0:
+            raise ValueError
+    except ValueError:
+        raise BadRequest("_size must be a positive integer")
+    if page_size > datasette.max_returned_rows:
+        raise BadRequest(f"_size must be <= {datasette.max_returned_rows}")
+    return page_size
+
+
+async def _execute_keyset_page(
+    db, sql, params, keyset_columns, _next, page_size, **kwargs
+):
+    """
+    Wrap a canned query in order to return the page of results following
+    the _next token, ordered by keyset_columns. Returns (results, next_value)
+    """
+    where = ""
+    params = dict(params)
+    if _next:
+        try:
+            components = keyset_token_values(_next)
+        except ValueError:
+            raise BadRequest("Invalid _next value")
+        if len(components) != len(keyset_columns):
+            raise BadRequest("Invalid _next value")
+        where = "where {} ".format(
+            compound_keys_after_sql(keyset_columns, param_prefix="keyset_")
+        )
+        for i, component in enumerate(components):
+            params[f"keyset_{i}"] = component
+    # Newline before the closing bracket in case SQL ends with a -- comment
+    page_sql = (
+        "select * from (\n{sql}\n) {where}order by {order_by} limit {limit}".format(
+            sql=sql.strip().rstrip(";").rstrip(),
+            where=where,
+            order_by=", ".join(escape_sqlite(column) for column in keyset_columns),
+            limit=page_size + 1,
+        )
+    )
+    results = await db.execute(page_sql, params, **kwargs)
+    bad_columns = [column for column in keyset_columns if column not in results.columns]
+    if bad_columns:
+        raise DatasetteError(
+            "keyset_columns={} - invalid columns".format(", ".join(bad_columns))
+        )
+    next_value = None
+    if len(results.rows) > page_size:
+        results.rows = results.rows[:page_size]
+        next_value = keyset_token(
+            [results.rows[-1][column] for column in keyset_columns]
+        )
+    return results, next_value
+
+
 class MagicParameters(dict):
     def __init__(self, sql, data, request, datasette):
         super().__init__(data)
@@ -864,6 +1047,8 @@ class TableCreateView(BaseView):
         self.ds = datasette
 
     async def post(self, request):
+        import sqlite_utils
+
         db = await self.ds.resolve_database(request)
         database_name = db.name
 
@@ -1103,26 +1288,15 @@ async def _table_columns(datasette, database_name):
 async def display_rows(datasette, database, request, rows, columns):
     display_rows = []
     truncate_cells = datasette.setting("truncate_cells_html")
+    renderers = await plugin_cell_renderers(datasette, database, None, columns, request)
     for row in rows:
         display_row = []
-        for column, value in zip(columns, row):
+        for column, value, renderer in zip(columns, row, renderers):
             display_value = value
             # Let the plugins have a go
-            # pylint: disable=no-member
             plugin_display_value = None
-            for candidate in pm.hook.render_cell(
-                row=row,
-                value=value,
-                column=column,
-                table=None,
-                database=database,
-                datasette=datasette,
-                request=request,
-            ):
-                candidate = await await_me_maybe(candidate)
-                if candidate is not None:
-                    plugin_display_value = candidate
-                    break
+            if renderer is not None:
+                plugin_display_value = await renderer(row, value)
             if plugin_display_value is not None:
                 display_value = plugin_display_value
             else:
@@ -10,7 +10,6 @@ from datasette.utils import (
 )
 from datasette.plugins import pm
 import json
-import sqlite_utils
 from .table import display_columns_and_rows
 
 
@@ -199,6 +198,8 @@ class RowDeleteView(BaseView):
         self.ds = datasette
 
     async def post(self, request):
+        import sqlite_utils
+
         ok, resolved = await _resolve_row_and_check_permission(
             self.ds, request, "delete-row"
         )
@@ -233,6 +234,8 @@ class RowUpdateView(BaseView):
         self.ds = datasette
 
     async def post(self, request):
+        import sqlite_utils
+
         ok, resolved = await _resolve_row_and_check_permission(
             self.ds, request, "update-row"
         )
@@ -1,13 +1,18 @@
 import json
 from datasette.events import LogoutEvent, LoginEvent, CreateTokenEvent
+from datasette.index_advisor import create_index_sql
+from datasette.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from datasette.tracer import sampled_traces_json
 from datasette.utils.asgi import Response, Forbidden
 from datasette.utils import (
     actor_matches_allow,
     add_cors_headers,
+    await_me_maybe,
     tilde_encode,
     tilde_decode,
 )
-from .base import BaseView, View
+from datasette.utils.sqlite import sqlite3
+from .base import BaseView, View, _error
 import secrets
 import urllib
 
@@ -34,9 +39,9 @@ class JsonDataView(BaseView):
         if self.permission:
             await self.ds.ensure_permissions(request.actor, [self.permission])
         if self.needs_request:
-            data = self.data_callback(request)
+            data = await await_me_maybe(self.data_callback(request))
         else:
-            data = self.data_callback()
+            data = await await_me_maybe(self.data_callback())
         if as_format:
             headers = {}
             if self.ds.cors:
@@ -58,6 +63,120 @@ class JsonDataView(BaseView):
             )
 
 
+class TracesView(JsonDataView):
+    name = "traces"
+
+    def __init__(self, datasette):
+        super().__init__(
+            datasette,
+            "traces.json",
+            lambda: sampled_traces_json(datasette._sampled_traces),
+        )
+
+    async def get(self, request):
+        # Traces include SQL queries and parameters from every user
+        if not await self.ds.permission_allowed(request.actor, "debug-menu"):
+            raise Forbidden("Permission denied")
+        return await super().get(request)
+
+
+class SlowQueriesView(JsonDataView):
+    name = "slow_queries"
+
+    def __init__(self, datasette):
+        super().__init__(
+            datasette, "slow-queries.json", self.slow_queries, needs_request=True
+        )
+
+    async def slow_queries(self, request):
+        sql = "select * from slow_queries"
+        params = {}
+        if request.args.get("database"):
+            sql += " where database_name = :database"
+            params["database"] = request.args["database"]
+        sql += " order by id desc limit 100"
+        results = await self.ds.get_internal_database().execute(sql, params)
+        rows = []
+        for row in results.rows:
+            row = dict(row)
+            row["interrupted"] = bool(row["interrupted"])
+            row["params"] = json.loads(row["params"])
+            row["query_plan"] = json.loads(row["query_plan"])
+            rows.append(row)
+        return rows
+
+    async def get(self, request):
+        # Slow queries include SQL run by every user
+        if not await self.ds.permission_allowed(request.actor, "debug-menu"):
+            raise Forbidden("Permission denied")
+        return await super().get(request)
+
+
+class IndexAdviceView(JsonDataView):
+    name = "index_advice"
+
+    def __init__(self, datasette):
+        super().__init__(
+            datasette,
+            "index-advice.json",
+            lambda: datasette._index_advisor.advice(datasette),
+        )
+
+    async def get(self, request):
+        # Advice reveals which columns are being filtered on
+        if not await self.ds.permission_allowed(request.actor, "debug-menu"):
+            raise Forbidden("Permission denied")
+        return await super().get(request)
+
+    async def post(self, request):
+        # Create a suggested index: {"database": ..., "table": ..., "columns": [...]}
+        try:
+            data = json.loads(await request.post_body())
+            database_name = data["database"]
+            table_name = data["table"]
+            columns = data["columns"]
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return _error(['JSON must contain "database", "table" and "columns"'])
+        if not isinstance(columns, list) or not columns:
+            return _error(['"columns" must be a non-empty list'])
+        # Check permissions first, so as not to reveal which tables exist
+        if not await self.ds.permission_allowed(
+            request.actor, "alter-table", resource=(database_name, table_name)
+        ):
+            return _error(["Permission denied"], 403)
+        try:
+            db = self.ds.get_database(database_name)
+        except KeyError:
+            return _error(["Database not found: {}".format(database_name)], 404)
+        if not await db.table_exists(table_name):
+            return _error(["Table not found: {}".format(table_name)], 404)
+        if not db.is_mutable:
+            return _error(["Database is immutable"], 403)
+        table_columns = await db.table_columns(table_name)
+        invalid = [column for column in columns if column not in table_columns]
+        if invalid:
+            return _error(["Invalid columns: {}".format(", ".join(map(str, invalid)))])
+        sql = create_index_sql(table_name, columns)
+        try:
+            await db.execute_write(sql)
+        except sqlite3.OperationalError as ex:
+            return _error([str(ex)])
+        return Response.json({"ok": True, "sql": sql}, status=201)
+
+
+class MetricsView(BaseView):
+    name = "metrics"
+    has_json_alternate = False
+
+    async def get(self, request):
+        # Metrics are labelled with the names of every database
+        if not await self.ds.permission_allowed(request.actor, "debug-menu"):
+            raise Forbidden("Permission denied")
+        return Response(
+            self.ds.metrics.render(self.ds), content_type=METRICS_CONTENT_TYPE
+        )
+
+
 class PatternPortfolioView(View):
     async def get(self, request, datasette):
         await datasette.ensure_permissions(request.actor, ["view-instance"])
@@ -28,6 +28,8 @@ from datasette.utils import (
     escape_sqlite,
     filters_should_redirect,
     is_url,
+    keyset_token,
+    keyset_token_values,
     path_from_row_pks,
     path_with_added_args,
     path_with_format,
@@ -40,10 +42,20 @@ from datasette.utils import (
     InvalidSql,
     sqlite3,
 )
-from datasette.utils.asgi import BadRequest, Forbidden, NotFound, Response
+from datasette.utils.asgi import AsgiStream, BadRequest, Forbidden, NotFound, Response
+from datasette.facets import load_facet_configs
 from datasette.filters import Filters
-import sqlite_utils
-from .base import BaseView, DatasetteError, _error, stream_csv
+from datasette.arrow_renderer import is_arrow_format
+from datasette.renderer import json_renderer
+from .base import (
+    BaseView,
+    DatasetteError,
+    _error,
+    plugin_cell_renderers,
+    stream_arrow,
+    stream_csv,
+    stream_json,
+)
 from .database import QueryView
 
 LINK_WITH_LABEL = (
@@ -133,6 +145,29 @@ async def _redirect_if_needed(datasette, request, resolved):
         )
 
 
+class LazyDisplayRows:
+    """
+    Rows for the HTML table, rendered as they are iterated over with async for.
+
+    Used when streaming HTML so the first rows can be sent before the rest
+    have been rendered.
+    """
+
+    def __init__(self, rows, display_row):
+        self.rows = rows
+        self.display_row = display_row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    async def __aiter__(self):
+        for row in self.rows:
+            yield await self.display_row(row)
+
+
 async def display_columns_and_rows(
     datasette,
     database_name,
@@ -143,8 +178,14 @@ async def display_columns_and_rows(
     truncate_cells=0,
     sortable_columns=None,
     request=None,
+    lazy=False,
 ):
-    """Returns columns, rows for specified table - including fancy foreign key treatment"""
+    """
+    Returns columns, rows for specified table - including fancy foreign key treatment
+
+    If lazy=True the rows are returned as a LazyDisplayRows, which renders
+    each row as it is iterated over.
+    """
     sortable_columns = sortable_columns or set()
     db = datasette.databases[database_name]
     column_descriptions = dict(
@@ -195,9 +236,20 @@ async def display_columns_and_rows(
         for fk in await db.foreign_keys_for_table(table_name)
     }
 
-    cell_rows = []
+    renderers = await plugin_cell_renderers(
+        datasette,
+        database_name,
+        table_name,
+        [column["name"] for column in columns],
+        request,
+    )
+    table_path = datasette.urls.table(database_name, table_name)
+
     base_url = datasette.setting("base_url")
-    for row in rows:
+    # The link column below replaces columns, so keep a reference for rows
+    cell_columns = columns
+
+    async def display_row(row):
         cells = []
         # Unless we are a view, the first column is a link - either to the rowid
         # or to the simple or compound primary key
@@ -212,7 +264,7 @@ async def display_columns_and_rows(
                     "raw": pk_path,
                     "value": markupsafe.Markup(
                         '<a href="{table_path}/{flat_pks_quoted}">{flat_pks}</a>'.format(
-                            table_path=datasette.urls.table(database_name, table_name),
+                            table_path=table_path,
                             flat_pks=str(markupsafe.escape(pk_path)),
                             flat_pks_quoted=path_from_row_pks(row, pks, not pks),
                         )
@@ -220,7 +272,7 @@ async def display_columns_and_rows(
                 }
             )
 
-        for value, column_dict in zip(row, columns):
+        for value, column_dict, renderer in zip(row, cell_columns, renderers):
             column = column_dict["name"]
             if link_column and len(pks) == 1 and column == pks[0]:
                 # If there's a simple primary key, don't repeat the value as it's
@@ -228,21 +280,9 @@ async def display_columns_and_rows(
                 continue
 
             # First let the plugins have a go
-            # pylint: disable=no-member
             plugin_display_value = None
-            for candidate in pm.hook.render_cell(
-                row=row,
-                value=value,
-                column=column,
-                table=table_name,
-                database=database_name,
-                datasette=datasette,
-                request=request,
-            ):
-                candidate = await await_me_maybe(candidate)
-                if candidate is not None:
-                    plugin_display_value = candidate
-                    break
+            if renderer is not None:
+                plugin_display_value = await renderer(row, value)
             if plugin_display_value:
                 display_value = plugin_display_value
             elif isinstance(value, bytes):
@@ -307,7 +347,12 @@ async def display_columns_and_rows(
                     ),
                 }
             )
-        cell_rows.append(Row(cells))
+        return Row(cells)
+
+    if lazy:
+        cell_rows = LazyDisplayRows(rows, display_row)
+    else:
+        cell_rows = [await display_row(row) for row in rows]
 
     if link_column:
         # Add the link column header.
@@ -433,6 +478,9 @@ class TableInsertView(BaseView):
         return rows, errors, extras
 
     async def post(self, request, upsert=False):
+        # sqlite_utils is slow to import, so wait until it is needed
+        import sqlite_utils
+
         try:
             resolved = await self.ds.resolve_table(request)
         except NotFound as e:
@@ -616,6 +664,8 @@ class TableDropView(BaseView):
         self.ds = datasette
 
     async def post(self, request):
+        import sqlite_utils
+
         try:
             resolved = await self.ds.resolve_table(request)
         except NotFound as e:
@@ -707,6 +757,16 @@ async def _columns_to_select(table_columns, pks, request):
     return columns
 
 
+def _keyset_columns_for_view(table_metadata, table_columns):
+    keyset_columns = list(table_metadata.get("keyset_columns") or [])
+    bad_columns = [column for column in keyset_columns if column not in table_columns]
+    if bad_columns:
+        raise DatasetteError(
+            "keyset_columns={} - invalid columns".format(", ".join(bad_columns))
+        )
+    return keyset_columns
+
+
 async def _sortable_columns_for_table(datasette, database_name, table_name, use_rowid):
     db = datasette.databases[database_name]
     table_metadata = await datasette.table_config(database_name, table_name)
@@ -798,10 +858,12 @@ async def table_view_traced(datasette, request):
     extra_extras = None
     context_for_html_hack = False
     default_labels = False
+    stream_html = False
     if format_ == "html":
         extra_extras = {"_html"}
         context_for_html_hack = True
         default_labels = True
+        stream_html = datasette.setting("stream_html") and request.method == "GET"
 
     view_data = await table_view_data(
         datasette,
@@ -810,13 +872,19 @@ async def table_view_traced(datasette, request):
         extra_extras=extra_extras,
         context_for_html_hack=context_for_html_hack,
         default_labels=default_labels,
+        lazy_display_rows=stream_html,
+        observe_query_shape=True,
     )
     if isinstance(view_data, Response):
         return view_data
     data, rows, columns, expanded_columns, sql, next_url = view_data
 
     # Handle formats from plugins
-    if format_ == "csv":
+    if (
+        format_ == "csv"
+        or (format_ == "json" and request.args.get("_stream"))
+        or is_arrow_format(datasette, format_)
+    ):
 
         async def fetch_data(request, _next=None):
             (
@@ -841,12 +909,27 @@ async def table_view_traced(datasette, request):
             data["expanded_columns"] = expanded_columns
             return data, None, None
 
+        if format_ == "json":
+            return await stream_json(datasette, fetch_data, request)
+        if format_ != "csv":
+            return await stream_arrow(
+                datasette,
+                fetch_data,
+                request,
+                resolved.db,
+                format_,
+                table=resolved.table,
+            )
         return await stream_csv(datasette, fetch_data, request, resolved.db.name)
     elif format_ in datasette.renderers.keys():
         # Dispatch request to the correct output format renderer
         # (CSV is not handled here due to streaming)
+        renderer = datasette.renderers[format_][0]
+        if renderer is not json_renderer:
+            # Renderers from plugins expect data["rows"] to be dictionaries
+            data["rows"] = [dict(row) for row in data["rows"]]
         result = call_with_supported_arguments(
-            datasette.renderers[format_][0],
+            renderer,
             datasette=datasette,
             columns=columns,
             rows=rows,
@@ -899,43 +982,54 @@ async def table_view_traced(datasette, request):
                 )
             }
         )
-        r = Response.html(
-            await datasette.render_template(
-                template,
-                dict(
-                    data,
-                    append_querystring=append_querystring,
-                    path_with_replaced_args=path_with_replaced_args,
-                    fix_path=datasette.urls.path,
-                    settings=datasette.settings_dict(),
-                    # TODO: review up all of these hacks:
-                    alternate_url_json=alternate_url_json,
-                    datasette_allow_facet=(
-                        "true" if datasette.setting("allow_facet") else "false"
-                    ),
-                    is_sortable=any(c["sortable"] for c in data["display_columns"]),
-                    allow_execute_sql=await datasette.permission_allowed(
-                        request.actor, "execute-sql", resolved.db.name
-                    ),
-                    query_ms=1.2,
-                    select_templates=[
-                        f"{'*' if template_name == template.name else ''}{template_name}"
-                        for template_name in templates
-                    ],
-                    top_table=make_slot_function(
-                        "top_table",
-                        datasette,
-                        request,
-                        database=resolved.db.name,
-                        table=resolved.table,
-                    ),
-                    count_limit=resolved.db.count_limit,
-                ),
-                request=request,
-                view_name="table",
+        context = dict(
+            data,
+            append_querystring=append_querystring,
+            path_with_replaced_args=path_with_replaced_args,
+            fix_path=datasette.urls.path,
+            settings=datasette.settings_dict(),
+            # TODO: review up all of these hacks:
+            alternate_url_json=alternate_url_json,
+            datasette_allow_facet=(
+                "true" if datasette.setting("allow_facet") else "false"
             ),
-            headers=headers,
+            is_sortable=any(c["sortable"] for c in data["display_columns"]),
+            allow_execute_sql=await datasette.permission_allowed(
+                request.actor, "execute-sql", resolved.db.name
+            ),
+            query_ms=1.2,
+            select_templates=[
+                f"{'*' if template_name == template.name else ''}{template_name}"
+                for template_name in templates
+            ],
+            top_table=make_slot_function(
+                "top_table",
+                datasette,
+                request,
+                database=resolved.db.name,
+                table=resolved.table,
+            ),
+            count_limit=resolved.db.count_limit,
         )
+        if stream_html:
+            chunks = await datasette.render_template_stream(
+                template, context, request=request, view_name="table"
+            )
+
+            async def stream_fn(r):
+                async for chunk in chunks:
+                    await r.write(chunk)
+
+            r = AsgiStream(
+                stream_fn, headers=headers, content_type="text/html; charset=utf-8"
+            )
+        else:
+            r = Response.html(
+                await datasette.render_template(
+                    template, context, request=request, view_name="table"
+                ),
+                headers=headers,
+            )
     else:
         assert False, "Invalid format: {}".format(format_)
     if next_url:
@@ -951,6 +1045,8 @@ async def table_view_data(
     context_for_html_hack=False,
     default_labels=False,
     _next=None,
+    lazy_display_rows=False,
+    observe_query_shape=False,
 ):
     extra_extras = extra_extras or set()
     # We have a table or view
@@ -976,12 +1072,27 @@ async def table_view_data(
     if redirect_response:
         return redirect_response
 
+    table_metadata = await datasette.table_config(database_name, table_name)
+
     # Introspect columns and primary keys for table
     pks = await db.primary_keys(table_name)
     table_columns = await db.table_columns(table_name)
 
+    # Views can use keyset pagination if they declare keyset_columns,
+    # otherwise they fall back to offset pagination. View columns may have
+    # no type affinity, so their _next tokens record the type of each value
+    pagination_keys = pks
+    use_offset = False
+    typed_next = False
+    if is_view:
+        pagination_keys = _keyset_columns_for_view(table_metadata, table_columns)
+        use_offset = not pagination_keys
+        typed_next = not use_offset
+
     # Take ?_col= and ?_nocol= into account
-    specified_columns = await _columns_to_select(table_columns, pks, request)
+    specified_columns = await _columns_to_select(
+        table_columns, pagination_keys, request
+    )
     select_specified_columns = ", ".join(escape_sqlite(t) for t in specified_columns)
     select_all_columns = ", ".join(escape_sqlite(t) for t in table_columns)
 
@@ -994,10 +1105,10 @@ async def table_view_data(
         order_by = "rowid"
         order_by_pks = "rowid"
     else:
-        order_by_pks = ", ".join([escape_sqlite(pk) for pk in pks])
+        order_by_pks = ", ".join([escape_sqlite(pk) for pk in pagination_keys])
         order_by = order_by_pks
 
-    if is_view:
+    if use_offset:
         order_by = ""
 
     # TODO: This logic should turn into logic about which ?_extras get
@@ -1009,8 +1120,6 @@ async def table_view_data(
         nocount = True
         nofacet = True
 
-    table_metadata = await datasette.table_config(database_name, table_name)
-
     # Arguments that start with _ and don't contain a __ are
     # special - things like ?_search= - and should not be
     # treated as filters.
@@ -1051,6 +1160,20 @@ async def table_view_data(
         table_metadata, sortable_columns, request, order_by
     )
 
+    # Only recorded once per request, not for every page that is streamed
+    if observe_query_shape and not is_view:
+        facet_columns = []
+        if not nofacet:
+            facet_columns = [
+                config["config"].get("column") or config["config"]["simple"]
+                for config in load_facet_configs(request, table_metadata).get(
+                    "column", []
+                )
+            ]
+        datasette._index_advisor.observe(
+            database_name, table_name, filters, sort or sort_desc, facet_columns
+        )
+
     from_sql = "from {table_name} {where}".format(
         table_name=escape_sqlite(table_name),
         where=(
@@ -1068,17 +1191,23 @@ async def table_view_data(
     offset = ""
     if _next:
         sort_value = None
-        if is_view:
+        if use_offset:
             # _next is an offset
             offset = f" offset {int(_next)}"
         else:
-            components = urlsafe_components(_next)
+            if typed_next:
+                try:
+                    components = keyset_token_values(_next)
+                except ValueError:
+                    raise BadRequest("Invalid _next value")
+            else:
+                components = urlsafe_components(_next)
             # If a sort order is applied and there are multiple components,
             # the first of these is the sort value
             if (sort or sort_desc) and (len(components) > 1):
                 sort_value = components[0]
                 # Special case for if non-urlencoded first token was $null
-                if _next.split(",")[0] == "$null":
+                if not typed_next and _next.split(",")[0] == "$null":
                     sort_value = None
                 components = components[1:]
 
@@ -1089,9 +1218,11 @@ async def table_view_data(
                 params[f"p{len(params)}"] = components[0]
             else:
                 # Apply the tie-breaker based on primary keys
-                if len(components) == len(pks):
+                if len(components) == len(pagination_keys):
                     param_len = len(params)
-                    next_by_pk_clauses.append(compound_keys_after_sql(pks, param_len))
+                    next_by_pk_clauses.append(
+                        compound_keys_after_sql(pagination_keys, param_len)
+                    )
                     for i, pk_value in enumerate(components):
                         params[f"p{param_len + i}"] = pk_value
 
@@ -1196,7 +1327,9 @@ async def table_view_data(
         raise DatasetteError(str(e))
 
     columns = [r[0] for r in results.description]
-    rows = list(results.rows)
+    # sqlite3.Row objects share the cursor description across the page, so
+    # they are used as the row representation all the way to the renderers
+    rows = results.rows
 
     # Expand labeled columns if requested
     expanded_columns = []
@@ -1237,24 +1370,23 @@ async def table_view_data(
                 )
             )
         if expanded_labels:
-            # Rewrite the rows
+            # Rewrite the rows, touching only the expanded columns
+            expanded_indexes = [
+                (columns.index(column), column) for column in expanded_columns
+            ]
             new_rows = []
             for row in rows:
-                new_row = CustomRow(columns)
-                for column in row.keys():
-                    value = row[column]
+                values = list(row)
+                for index, column in expanded_indexes:
+                    value = values[index]
                     if (column, value) in expanded_labels and value is not None:
-                        new_row[column] = {
+                        values[index] = {
                             "value": value,
                             "label": expanded_labels[(column, value)],
                         }
-                    else:
-                        new_row[column] = value
-                new_rows.append(new_row)
+                new_rows.append(CustomRow(columns, zip(columns, values)))
             rows = new_rows
 
-    _next = request.args.get("_next")
-
     # Pagination next link
     next_value, next_url = await _next_value_and_url(
         datasette,
@@ -1263,14 +1395,15 @@ async def table_view_data(
         table_name,
         _next,
         rows,
-        pks,
+        pagination_keys,
         use_rowid,
         sort,
         sort_desc,
         page_size,
-        is_view,
+        use_offset,
+        typed_next,
     )
-    rows = rows[:page_size]
+    del rows[page_size:]
 
     # Resolve extras
     extras = _get_extras(request)
@@ -1278,6 +1411,8 @@ async def table_view_data(
         extras.add("facet_results")
     if request.args.get("_shape") == "object":
         extras.add("primary_keys")
+    if request.args.get("_shape") == "columns":
+        extras.add("columns")
     if extra_extras:
         extras.update(extra_extras)
 
@@ -1413,6 +1548,16 @@ async def table_view_data(
         "Primary keys for this table"
         return pks
 
+    async def extra_column_types():
+        "Declared SQLite types of the returned columns"
+        declared_types = {
+            column.name: column.type
+            for column in await db.table_column_details(table_name)
+        }
+        if not pks:
+            declared_types.setdefault("rowid", "INTEGER")
+        return {column: declared_types.get(column) for column in columns}
+
     async def extra_actions():
         async def actions():
             links = []
@@ -1469,6 +1614,7 @@ async def table_view_data(
             truncate_cells=datasette.setting("truncate_cells_html"),
             sortable_columns=sortable_columns,
             request=request,
+            lazy=lazy_display_rows,
         )
         return {
             "columns": display_columns,
@@ -1664,6 +1810,7 @@ async def table_view_data(
         extra_next_url,
         extra_columns,
         extra_primary_keys,
+        extra_column_types,
         run_display_columns_and_rows,
         extra_display_columns,
         extra_display_rows,
@@ -1702,8 +1849,8 @@ async def table_view_data(
             if key.startswith("extra_") and key.replace("extra_", "") in extras
         }
     )
-    raw_sqlite_rows = rows[:page_size]
-    data["rows"] = [dict(r) for r in raw_sqlite_rows]
+    # Renderers turn these into dictionaries only if they need to
+    data["rows"] = rows
 
     if context_for_html_hack:
         data.update(extra_context_from_filters)
@@ -1745,7 +1892,7 @@ async def table_view_data(
         data["sort"] = sort
         data["sort_desc"] = sort_desc
 
-    return data, rows[:page_size], columns, expanded_columns, sql, next_url
+    return data, rows, columns, expanded_columns, sql, next_url
 
 
 async def _next_value_and_url(
@@ -1760,17 +1907,20 @@ async def _next_value_and_url(
     sort,
     sort_desc,
     page_size,
-    is_view,
+    use_offset,
+    typed_next=False,
 ):
     next_value = None
     next_url = None
     if 0 < page_size < len(rows):
-        if is_view:
+        if use_offset:
             next_value = int(_next or 0) + page_size
+        elif typed_next:
+            next_value = keyset_token([rows[-2][pk] for pk in pks])
         else:
             next_value = path_from_row_pks(rows[-2], pks, use_rowid)
         # If there's a sort or sort_desc, add that value as a prefix
-        if (sort or sort_desc) and not is_view:
+        if (sort or sort_desc) and not use_offset:
             try:
                 prefix = rows[-2][sort or sort_desc]
             except IndexError:
@@ -1794,7 +1944,9 @@ async def _next_value_and_url(
                 ).single_value()
             if isinstance(prefix, dict) and "value" in prefix:
                 prefix = prefix["value"]
-            if prefix is None:
+            if typed_next:
+                prefix = keyset_token([prefix])
+            elif prefix is None:
                 prefix = "$null"
             else:
                 prefix = tilde_encode(str(prefix))
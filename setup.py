@@ -1,6 +1,15 @@
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+import gzip
 import os
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_STATIC_EXTENSIONS = (".css", ".js", ".svg", ".html", ".json")
+
 
 def get_long_description():
     with open(
@@ -20,8 +29,34 @@ def get_version():
     return g["__version__"]
 
 
+class BuildPyWithPrecompressedStatic(build_py):
+    """
+    Write .gz - and .br, if brotli is available - copies of the text files in
+    datasette/static, which Datasette serves to clients that accept them
+    """
+
+    def run(self):
+        super().run()
+        static_dir = os.path.join(self.build_lib, "datasette", "static")
+        for dirpath, _, filenames in os.walk(static_dir):
+            for filename in filenames:
+                if not filename.endswith(COMPRESSIBLE_STATIC_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as fp:
+                    content = fp.read()
+                variants = {".gz": gzip.compress(content, 9, mtime=0)}
+                if brotli is not None:
+                    variants[".br"] = brotli.compress(content)
+                for suffix, compressed in variants.items():
+                    if len(compressed) < len(content):
+                        with open(path + suffix, "wb") as fp:
+                            fp.write(compressed)
+
+
 setup(
     name="datasette",
+    cmdclass={"build_py": BuildPyWithPrecompressedStatic},
     version=get_version(),
     description="An open source multi-tool for exploring and publishing data",
     long_description=get_long_description(),
@@ -90,6 +125,7 @@ setup(
             "cogapp>=3.3.0",
         ],
         "rich": ["rich"],
+        "arrow": ["pyarrow"],
     },
     classifiers=[
         "Development Status :: 4 - Beta",
@@ -77,6 +77,7 @@ EXPECTED_PLUGINS = [
             "prepare_jinja2_environment",
             "register_routes",
             "render_cell",
+            "render_cells",
             "startup",
             "table_actions",
         ],
@@ -16,6 +16,18 @@ def extra_js_urls():
     ]
 
 
+@hookimpl
+def render_cells(column):
+    # Called once per column, the returned function is used for each cell
+    if column != "render_cells_demo":
+        return None
+
+    def render(row, value):
+        return markupsafe.Markup("<em>{}</em>".format(markupsafe.escape(value)))
+
+    return render
+
+
 @hookimpl
 def render_cell(value, database):
     # Render {"href": "...", "label": "..."} as link
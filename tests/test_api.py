@@ -17,10 +17,12 @@ from .fixtures import (  # noqa
     EXPECTED_PLUGINS,
     METADATA,
 )
+import asyncio
 import pathlib
 import pytest
 import sys
 import urllib
+from unittest import mock
 
 
 @pytest.mark.asyncio
@@ -784,7 +786,7 @@ def test_databases_json(app_client_two_attached_databases_one_immutable):
 @pytest.mark.asyncio
 async def test_threads_json(ds_client):
     response = await ds_client.get("/-/threads.json")
-    expected_keys = {"threads", "num_threads"}
+    expected_keys = {"threads", "num_threads", "executor"}
     if sys.version_info >= (3, 7, 0):
         expected_keys.update({"tasks", "num_tasks"})
     data = response.json()
@@ -792,6 +794,48 @@ async def test_threads_json(ds_client):
     # Should be at least one _execute_writes thread for __INTERNAL__
     thread_names = [thread["name"] for thread in data["threads"]]
     assert "_execute_writes for database __INTERNAL__" in thread_names
+    executor = data["executor"]
+    assert executor["max_threads"] == 1
+    assert executor["recent_queue_wait_ms"]["count"] >= 1
+    assert executor["recent_queue_wait_ms"]["max"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_metrics(ds_client):
+    await ds_client.get("/fixtures/facetable.json")
+    # Counting forever will be interrupted by sql_time_limit_ms
+    await ds_client.get(
+        "/fixtures/-/query.json",
+        params={
+            "sql": "with recursive c(x) as (select 1 union all select x + 1 from c) "
+            "select count(*) from c"
+        },
+    )
+    assert (await ds_client.get("/-/metrics")).status_code == 403
+    response = await ds_client.get(
+        "/-/metrics",
+        cookies={"ds_actor": ds_client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in response.text.splitlines():
+        if not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    table_count = [
+        value
+        for name, value in samples.items()
+        if name.startswith("datasette_request_duration_seconds_count{")
+        and 'view="table_view"' in name
+    ]
+    assert table_count and table_count[0] >= 1
+    assert samples['datasette_sql_duration_seconds_count{database="fixtures"}'] >= 1
+    assert samples['datasette_sql_interrupted_total{database="fixtures"}'] >= 1
+    assert samples["datasette_executor_max_threads"] == 1
+    assert samples["datasette_executor_queue_wait_seconds_count"] >= 1
+    assert 'datasette_write_queue_depth{database="fixtures"}' in samples
+    assert 'datasette_cache_hits_total{cache="templates"}' in samples
 
 
 @pytest.mark.asyncio
@@ -844,6 +888,7 @@ async def test_settings_json(ds_client):
         "max_insert_rows": 100,
         "sql_time_limit_ms": 200,
         "allow_download": True,
+        "allow_snapshot_download": False,
         "allow_signed_tokens": True,
         "max_signed_tokens_ttl": 0,
         "allow_facet": True,
@@ -852,11 +897,21 @@ async def test_settings_json(ds_client):
         "num_sql_threads": 1,
         "cache_size_kb": 0,
         "allow_csv_stream": True,
+        "allow_json_stream": True,
         "max_csv_mb": 100,
+        "json_encoder": "json",
         "truncate_cells_html": 2048,
         "force_https_urls": False,
+        "stream_html": False,
+        "compress_responses": False,
+        "reload_templates": True,
         "template_debug": False,
         "trace_debug": False,
+        "slow_query_ms": 0,
+        "trace_sample_rate": 0,
+        "trace_slow_ms": 0,
+        "sql_queue_limit_ms": 0,
+        "hash_strategy": "sha256",
         "base_url": "/",
     }
 
@@ -1197,3 +1252,82 @@ async def test_upgrade_metadata(metadata, expected_config, expected_metadata):
     assert response.json() == expected_config
     response2 = await ds.client.get("/-/metadata.json")
     assert response2.json() == expected_metadata
+
+
+@pytest.mark.asyncio
+async def test_slow_queries():
+    ds = Datasette(
+        memory=True, settings={"slow_query_ms": 50, "sql_time_limit_ms": 100}
+    )
+    await ds.invoke_startup()
+    root_cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    await ds.client.get("/_memory/-/query.json?sql=select+1")
+    # Counting forever will be interrupted by sql_time_limit_ms
+    await ds.client.get(
+        "/_memory/-/query.json",
+        params={
+            "sql": "with recursive c(x) as (select :start union all "
+            "select x + 1 from c) select count(*) from c",
+            "start": "1",
+        },
+    )
+    # Slow queries are logged in the background
+    await asyncio.gather(*ds.get_database("_memory")._slow_query_tasks)
+    assert (await ds.client.get("/-/slow-queries.json")).status_code == 403
+    response = await ds.client.get("/-/slow-queries.json", cookies=root_cookies)
+    assert response.status_code == 200
+    entry = response.json()[0]
+    assert entry["database_name"] == "_memory"
+    assert entry["path"] == "/_memory/-/query.json"
+    assert entry["sql"].startswith("with recursive c(x)")
+    # Only parameter types are recorded, never values
+    assert entry["params"] == {"start": "str"}
+    assert entry["interrupted"] is True
+    assert entry["duration_ms"] >= 50
+    assert any("SCAN" in step["detail"] for step in entry["query_plan"])
+    response = await ds.client.get(
+        "/-/slow-queries.json?database=other", cookies=root_cookies
+    )
+    assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log_errors_do_not_affect_query(capsys):
+    ds = Datasette(memory=True, settings={"slow_query_ms": 1})
+    await ds.invoke_startup()
+    db = ds.get_database("_memory")
+    with mock.patch.object(
+        db, "_log_slow_query", side_effect=RuntimeError("log failed")
+    ):
+        response = await ds.client.get(
+            "/_memory/-/query.json",
+            params={
+                "sql": "with recursive c(x) as (select 1 union all select x + 1 "
+                "from c where x < 200000) select count(*) from c"
+            },
+        )
+        await asyncio.gather(*db._slow_query_tasks, return_exceptions=True)
+    assert response.status_code == 200
+    assert response.json()["rows"] == [{"count(*)": 200000}]
+    assert "Error logging slow query: log failed" in capsys.readouterr().err
+
+
+@pytest.mark.asyncio
+async def test_sql_queue_limit_ms():
+    ds = Datasette(memory=True, settings={"sql_queue_limit_ms": 100})
+    await ds.invoke_startup()
+    response = await ds.client.get("/_memory/-/query.json?sql=select+1")
+    assert response.status_code == 200
+    # Pretend ten slow queries are ahead in the queue for three threads
+    ds.metrics.executor_in_flight = 10
+    ds.metrics.executor_run_time = 0.5
+    response = await ds.client.get("/_memory/-/query.json?sql=select+1")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "2"
+    assert "Too many queries are waiting to run" in response.json()["error"]
+    assert ds.metrics.queries_rejected == {"_memory": 1}
+    # The internal database is never rejected
+    await ds.get_internal_database().execute("select 1")
+    ds.metrics.executor_in_flight = 0
+    response = await ds.client.get("/_memory/-/query.json?sql=select+1")
+    assert response.status_code == 200
@@ -0,0 +1,248 @@
+import io
+import pytest
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.parquet  # noqa
+from datasette import hookimpl  # noqa
+from datasette.app import Datasette  # noqa
+from datasette.arrow_renderer import ArrowEncoder, declared_types_for_stream  # noqa
+from datasette.plugins import pm  # noqa
+from datasette.utils.asgi import Response  # noqa
+
+
+def read_arrow(body):
+    return pyarrow.ipc.open_stream(body).read_all()
+
+
+def read_parquet(body):
+    return pyarrow.parquet.read_table(io.BytesIO(body))
+
+
+@pytest.mark.asyncio
+async def test_table_arrow(ds_client):
+    response = await ds_client.get("/fixtures/simple_primary_key.arrow")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    assert (
+        response.headers["content-disposition"]
+        == 'attachment; filename="simple_primary_key.arrow"'
+    )
+    table = read_arrow(response.content)
+    assert table.schema.names == ["id", "content"]
+    # Types come from the declared column types - id is varchar(30)
+    assert table.schema.field("id").type == pyarrow.string()
+    assert table.schema.field("content").type == pyarrow.string()
+    assert table.to_pydict() == {
+        "id": ["1", "2", "3", "4", "5"],
+        "content": ["hello", "world", "", "RENDER_CELL_DEMO", "RENDER_CELL_ASYNC"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_table_parquet(ds_client):
+    response = await ds_client.get("/fixtures/simple_primary_key.parquet")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.parquet"
+    table = read_parquet(response.content)
+    assert table.to_pydict()["id"] == ["1", "2", "3", "4", "5"]
+
+
+@pytest.mark.asyncio
+async def test_table_arrow_with_labels(ds_client):
+    response = await ds_client.get(
+        "/fixtures/facetable.arrow?_labels=on&_size=2&_col=_city_id&_col=on_earth"
+    )
+    table = read_arrow(response.content)
+    assert table.to_pydict() == {
+        "pk": [1, 2],
+        "on_earth": [1, 1],
+        "_city_id": [1, 1],
+        "_city_id_label": ["San Francisco", "San Francisco"],
+    }
+
+
+@pytest.mark.asyncio
+async def test_table_arrow_binary(ds_client):
+    response = await ds_client.get("/fixtures/binary_data.arrow")
+    assert response.status_code == 200
+    table = read_arrow(response.content)
+    assert table.schema.field("data").type == pyarrow.binary()
+    assert table.to_pydict()["data"] == [
+        b"\x15\x1c\x02\xc7\xad\x05\xfe",
+        b"\x15\x1c\x03\xc7\xad\x05\xfe",
+        None,
+    ]
+
+
+def test_arrow_encoder_widens_mismatched_values():
+    # SQLite allows any value in any column, whatever its declared type
+    rows = [(1, "a", 1, 1.5), ("two", 2, 2.5, 2), (3.5, b"c", 3, None)]
+    encoder = ArrowEncoder(
+        "arrow",
+        ["n", "s", "f", "r"],
+        rows,
+        declared_types={"n": "INTEGER", "s": "TEXT", "f": "INTEGER", "r": "REAL"},
+    )
+    table = read_arrow(encoder.encode(rows) + encoder.close())
+    assert [field.type for field in table.schema] == [
+        pyarrow.string(),
+        pyarrow.string(),
+        pyarrow.float64(),
+        pyarrow.float64(),
+    ]
+    assert table.to_pydict() == {
+        "n": ["1", "two", "3.5"],
+        "s": ["a", "2", "c"],
+        "f": [1.0, 2.5, 3.0],
+        "r": [1.5, 2.0, None],
+    }
+
+
+def test_arrow_encoder_stream_schema():
+    first_page = [(1, 2), (2, 3)]
+    encoder = ArrowEncoder(
+        "arrow",
+        ["id", "value"],
+        first_page,
+        declared_types={"id": "INTEGER"},
+        stream=True,
+    )
+    # Columns without a declared type are strings, whatever the first page holds
+    assert encoder.schema.field("id").type == pyarrow.int64()
+    assert encoder.schema.field("value").type == pyarrow.string()
+    body = encoder.encode(first_page) + encoder.encode([(3, "three")])
+    table = read_arrow(body + encoder.close())
+    assert table.to_pydict() == {"id": [1, 2, 3], "value": ["2", "3", "three"]}
+    with pytest.raises(ValueError) as ex:
+        encoder.encode([("four", None)])
+    assert "Column id has values that do not fit its type of int64" in str(ex.value)
+
+
+@pytest.mark.asyncio
+async def test_table_arrow_mixed_types():
+    ds = Datasette(memory=True)
+    db = ds.add_memory_database("arrow_mixed")
+    await db.execute_write(
+        "create table if not exists mixed (id integer primary key, value integer)"
+    )
+    await db.execute_write_many(
+        "insert or ignore into mixed (id, value) values (?, ?)",
+        [(1, 1), (2, 2.5), (3, "three"), (4, None)],
+    )
+    response = await ds.client.get("/arrow_mixed/mixed.arrow")
+    assert response.status_code == 200
+    table = read_arrow(response.content)
+    assert table.schema.field("value").type == pyarrow.string()
+    assert table.to_pydict()["value"] == ["1", "2.5", "three", None]
+    # Streamed one row at a time, the first page alone cannot decide the types
+    response = await ds.client.get("/arrow_mixed/mixed.arrow?_stream=1&_size=1")
+    assert response.status_code == 200
+    table = read_arrow(response.content)
+    assert table.schema.field("id").type == pyarrow.int64()
+    assert table.schema.field("value").type == pyarrow.string()
+    assert table.to_pydict()["value"] == ["1", "2.5", "three", None]
+
+
+@pytest.mark.asyncio
+async def test_declared_types_for_stream():
+    ds = Datasette(memory=True)
+    db = ds.add_memory_database("arrow_declared_types")
+    await db.execute_write(
+        "create table if not exists t (id integer primary key, "
+        "i integer, f integer, big integer, r real, s text, b blob, d date)"
+    )
+    await db.execute_write_many(
+        "insert or ignore into t values (?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (1, 1, 1, 2**60, 1.5, "a", b"b", "2024-01-01"),
+            (2, 2, 2.5, 2.5, 2, 3, 4, 5),
+        ],
+    )
+    assert await declared_types_for_stream(db, "t") == {
+        "id": "INTEGER",
+        "i": "INTEGER",
+        "f": "REAL",
+        "big": "TEXT",
+        "r": "REAL",
+        "s": "TEXT",
+        "b": "BLOB",
+        "d": "date",
+        "rowid": "INTEGER",
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format_", ("arrow", "parquet"))
+async def test_table_arrow_stream(ds_client, format_):
+    read = read_arrow if format_ == "arrow" else read_parquet
+    # Without _stream should return a single page
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.{}".format(format_)
+    )
+    assert read(response.content).num_rows == 50
+    # With _stream=1 should return every row, one record batch per page
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.{}?_stream=1".format(format_)
+    )
+    table = read(response.content)
+    assert table.num_rows == 1001
+    assert table.schema.names == ["pk1", "pk2", "pk3", "content"]
+
+
+@pytest.mark.asyncio
+async def test_custom_sql_arrow(ds_client):
+    response = await ds_client.get(
+        "/fixtures/-/query.arrow",
+        params={"sql": "select 1 as one, 2.5 as two, 'three' as three, null as four"},
+    )
+    assert response.status_code == 200
+    assert (
+        response.headers["content-disposition"]
+        == 'attachment; filename="fixtures.arrow"'
+    )
+    table = read_arrow(response.content)
+    # Types are inferred from the values in the first page
+    assert [field.type for field in table.schema] == [
+        pyarrow.int64(),
+        pyarrow.float64(),
+        pyarrow.string(),
+        pyarrow.string(),
+    ]
+    assert table.to_pylist() == [{"one": 1, "two": 2.5, "three": "three", "four": None}]
+    # SQL query columns have no declared types, so they are strings when streamed
+    response = await ds_client.get(
+        "/fixtures/-/query.arrow",
+        params={"sql": "select 1 as one, 2.5 as two", "_stream": "1"},
+    )
+    table = read_arrow(response.content)
+    assert [field.type for field in table.schema] == [pyarrow.string()] * 2
+    assert table.to_pylist() == [{"one": "1", "two": "2.5"}]
+
+
+@pytest.mark.asyncio
+async def test_arrow_stream_next_not_allowed(ds_client):
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.arrow?_stream=1&_next=1"
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_plugin_parquet_renderer_takes_precedence():
+    class ParquetPlugin:
+        __name__ = "ParquetPlugin"
+
+        @hookimpl
+        def register_output_renderer(self):
+            return {
+                "extension": "parquet",
+                "render": lambda: Response.text("from plugin"),
+            }
+
+    pm.register(ParquetPlugin(), name="ParquetPlugin")
+    try:
+        ds = Datasette(memory=True)
+        response = await ds.client.get("/_memory/-/query.parquet?sql=select+1")
+        assert response.text == "from plugin"
+    finally:
+        pm.unregister(name="ParquetPlugin")
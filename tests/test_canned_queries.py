@@ -1,4 +1,6 @@
 from bs4 import BeautifulSoup as Soup
+from datasette.app import Datasette
+from datasette.views.database import _execute_keyset_page
 import json
 import pytest
 import re
@@ -455,3 +457,108 @@ def test_canned_write_query_disabled_for_immutable_database(
     )
     assert response.status == 403
     assert "Database is immutable" in response.text
+
+
+@pytest.mark.asyncio
+async def test_canned_query_keyset_pagination():
+    ds = Datasette(
+        config={
+            "databases": {
+                "keyset_canned": {
+                    "queries": {
+                        "by_name": {
+                            "sql": "select id, name from people where id > :min_id;",
+                            "keyset_columns": ["name", "id"],
+                        }
+                    }
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("keyset_canned")
+    await db.execute_write(
+        "create table if not exists people (id integer primary key, name text)"
+    )
+    names = ["c", "a", "b", "a", "d", "b", "c", "e"]
+    await db.execute_write_many(
+        "insert or ignore into people (id, name) values (?, ?)",
+        list(enumerate(names, start=1)),
+    )
+    path = "/keyset_canned/by_name.json?min_id=1&_size=3"
+    fetched = []
+    pages = 0
+    while path:
+        response = await ds.client.get(path)
+        assert response.status_code == 200
+        data = response.json()
+        fetched.extend((row["name"], row["id"]) for row in data["rows"])
+        pages += 1
+        path = data["next_url"]
+        if path:
+            assert response.headers["link"] == '<{}>; rel="next"'.format(path)
+            path = path.replace("http://localhost", "")
+        assert pages < 10, "Possible infinite loop detected"
+    assert pages == 3
+    assert fetched == [
+        ("a", 2),
+        ("a", 4),
+        ("b", 3),
+        ("b", 6),
+        ("c", 7),
+        ("d", 5),
+        ("e", 8),
+    ]
+    # HTML version should link to the next page
+    response = await ds.client.get("/keyset_canned/by_name?min_id=1&_size=3")
+    assert (
+        '<a href="http://localhost/keyset_canned/by_name?min_id=1&amp;_size=3&amp;_next=sb%2Ci3">Next page</a>'
+        in (response.text)
+    )
+    # Invalid _next
+    response = await ds.client.get("/keyset_canned/by_name.json?_next=a,b,c")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_canned_query_keyset_pagination_computed_column():
+    # k has no type affinity, so _next values must keep their integer type
+    ds = Datasette(
+        config={
+            "databases": {
+                "keyset_canned_computed": {
+                    "queries": {
+                        "doubled": {
+                            "sql": "select id * 2 as k from numbers",
+                            "keyset_columns": ["k"],
+                        }
+                    }
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("keyset_canned_computed")
+    await db.execute_write(
+        "create table if not exists numbers (id integer primary key)"
+    )
+    await db.execute_write_many(
+        "insert or ignore into numbers (id) values (?)", [(i,) for i in range(1, 31)]
+    )
+    path = "/keyset_canned_computed/doubled.json?_size=10"
+    fetched = []
+    while path:
+        response = await ds.client.get(path)
+        assert response.status_code == 200
+        fetched.extend(row["k"] for row in response.json()["rows"])
+        path = response.json()["next_url"]
+        if path:
+            path = path.replace("http://localhost", "")
+        assert len(fetched) <= 30, "Possible infinite loop detected"
+    assert fetched == [i * 2 for i in range(1, 31)]
+    # The caller's params are not modified
+    params = {"min_id": 1}
+    results, next_value = await _execute_keyset_page(
+        db, "select id from numbers where id > :min_id", params, ["id"], "i5", 3
+    )
+    assert [row["id"] for row in results.rows] == [6, 7, 8]
+    assert next_value == "i8"
+    assert params == {"min_id": 1}
@@ -4,13 +4,15 @@ from .fixtures import (
     TestClient as _TestClient,
     EXPECTED_PLUGINS,
 )
-from datasette.app import SETTINGS
+from datasette.app import Datasette, SETTINGS
 from datasette.plugins import DEFAULT_PLUGINS
 from datasette.cli import cli, serve
+from datasette.startup_snapshot import create_startup_snapshot
 from datasette.version import __version__
 from datasette.utils import tilde_encode
 from datasette.utils.sqlite import sqlite3
 from click.testing import CliRunner
+import asyncio
 import io
 import json
 import pathlib
@@ -47,6 +49,114 @@ def test_inspect_cli_writes_to_file(app_client):
     assert ["fixtures"] == list(data.keys())
 
 
+def test_inspect_cli_previous(tmp_path):
+    paths = []
+    for name in ("one", "two"):
+        path = str(tmp_path / "{}.db".format(name))
+        sqlite3.connect(path).execute("create table t (id integer primary key)")
+        paths.append(path)
+    previous_file = str(tmp_path / "previous.json")
+    result = CliRunner().invoke(
+        cli, ["inspect", *paths, "--inspect-file", previous_file, "--threads", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    with open(previous_file) as fp:
+        previous = json.load(fp)
+    assert previous["one"]["tables"] == {"t": {"count": 0}}
+    # Entries for files with the same size and mtime are reused as they are
+    previous["one"]["hash"] = "reused"
+    previous["two"]["hash"] = "reused"
+    with open(previous_file, "w") as fp:
+        json.dump(previous, fp)
+    conn = sqlite3.connect(paths[1])
+    conn.execute("insert into t default values")
+    conn.commit()
+    conn.close()
+    result = CliRunner().invoke(cli, ["inspect", *paths, "--previous", previous_file])
+    assert result.exit_code == 0, result.output
+    data = json.loads(result.output)
+    assert data["one"]["hash"] == "reused"
+    assert data["two"]["hash"] != "reused"
+    assert data["two"]["tables"] == {"t": {"count": 1}}
+
+
+def test_snapshot_cli(tmp_path):
+    mutable = str(tmp_path / "mutable.db")
+    immutable = str(tmp_path / "immutable.db")
+    sqlite3.connect(mutable).execute("create table dogs (id integer primary key)")
+    conn = sqlite3.connect(immutable)
+    conn.execute("create table cats (id integer primary key, name text)")
+    conn.execute("create index cats_name on cats (name)")
+    conn.execute("insert into cats (name) values ('Cleo')")
+    conn.commit()
+    conn.close()
+    snapshot_file = str(tmp_path / "snapshot.json")
+    result = CliRunner().invoke(
+        cli, ["snapshot", mutable, "-i", immutable, "--snapshot-file", snapshot_file]
+    )
+    assert result.exit_code == 0, result.output
+    with open(snapshot_file) as fp:
+        data = json.load(fp)
+    assert data["datasette_version"] == __version__
+    assert set(data["databases"]) == {"mutable", "immutable"}
+    assert "hash" not in data["databases"]["mutable"]
+    assert data["databases"]["immutable"]["tables"] == {"cats": {"count": 1}}
+    assert [
+        row["name"]
+        for row in data["databases"]["immutable"]["catalog"]["catalog_indexes"]
+    ] == ["cats_name"]
+    assert data["templates"]
+
+
+def test_serve_with_startup_snapshot(tmp_path):
+    # Not an async test: pytest-asyncio closing its event loop would break
+    # the CliRunner tests that follow, which expect a current event loop
+    asyncio.run(_test_serve_with_startup_snapshot(tmp_path))
+
+
+async def _test_serve_with_startup_snapshot(tmp_path):
+    path = str(tmp_path / "immutable.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table cats (id integer primary key, name text)")
+    conn.execute("create index cats_name on cats (name)")
+    conn.commit()
+    conn.close()
+    data = await create_startup_snapshot(Datasette(immutables=[path]))
+    ds = Datasette(immutables=[path], startup_snapshot=data)
+    assert ds.inspect_data["immutable"]["tables"] == {"cats": {"count": 0}}
+    assert ds._jinja_env.bytecode_cache.bytecode
+    # The catalog is loaded from the snapshot rather than from the database
+    with mock.patch("datasette.app.populate_schema_tables") as populate:
+        await ds.refresh_schemas()
+        assert not populate.called
+    indexes = await ds.get_internal_database().execute(
+        "select name from catalog_indexes where database_name = 'immutable'"
+    )
+    assert [row["name"] for row in indexes] == ["cats_name"]
+    response = await ds.client.get("/immutable/cats.json")
+    assert response.status_code == 200
+    # Hashes and counts are ignored if the file has changed since
+    conn = sqlite3.connect(path)
+    conn.execute("insert into cats (name) values ('Cleo')")
+    conn.commit()
+    conn.close()
+    ds = Datasette(immutables=[path], startup_snapshot=data)
+    assert ds.inspect_data is None
+    # Including the catalogs of mutable databases
+    data = await create_startup_snapshot(Datasette([path]))
+    assert Datasette([path], startup_snapshot=data)._snapshot_catalogs
+    conn = sqlite3.connect(path)
+    conn.execute("insert into cats (name) values ('Pancakes')")
+    conn.commit()
+    conn.close()
+    assert not Datasette([path], startup_snapshot=data)._snapshot_catalogs
+    # Snapshots from other versions of Datasette are ignored entirely
+    data["datasette_version"] = "0.1"
+    ds = Datasette(immutables=[path], startup_snapshot=data)
+    assert not ds._snapshot_catalogs
+    assert not ds._jinja_env.bytecode_cache.bytecode
+
+
 def test_serve_with_inspect_file_prepopulates_table_counts_cache():
     inspect_data = {"fixtures": {"tables": {"hithere": {"count": 44}}}}
     with make_app_client(inspect_data=inspect_data, is_immutable=True) as client:
@@ -0,0 +1,166 @@
+from datasette.app import Datasette
+from datasette.utils import calculate_etag
+from datasette.utils.asgi import Request, asgi_static, choose_encoding
+from unittest import mock
+import gzip
+import hashlib
+import pytest
+import urllib.parse
+
+
+def numbers_path(format_, count):
+    sql = (
+        "with recursive n(value) as (select 1 union all select value + 1 from n "
+        "where value < {}) select value from n".format(count)
+    )
+    return "/_memory/-/query.{}?{}".format(
+        format_, urllib.parse.urlencode({"sql": sql})
+    )
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,encodings,expected",
+    (
+        (None, ["br", "gzip"], None),
+        ("", ["br", "gzip"], None),
+        ("gzip", ["br", "gzip"], "gzip"),
+        ("gzip, deflate, br", ["br", "gzip"], "br"),
+        ("br;q=0, gzip", ["br", "gzip"], "gzip"),
+        ("GZIP;q=0.5", ["br", "gzip"], "gzip"),
+        ("gzip;q=0", ["br", "gzip"], None),
+        ("*", ["br", "gzip"], "br"),
+        ("*, br;q=0", ["br", "gzip"], "gzip"),
+        ("identity", ["gzip"], None),
+    ),
+)
+def test_choose_encoding(accept_encoding, encodings, expected):
+    assert choose_encoding(accept_encoding, encodings) == expected
+
+
+@pytest.fixture(scope="module")
+def ds_compress():
+    ds = Datasette(memory=True, settings={"compress_responses": True})
+    yield ds
+    ds.executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_compress_json(ds_compress):
+    path = numbers_path("json", 1000)
+    response = await ds_compress.client.get(path, headers={"accept-encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert "content-length" not in response.headers or int(
+        response.headers["content-length"]
+    ) < len(response.content)
+    assert len(response.json()["rows"]) == 1000
+    # Clients that do not accept compressed responses get the original
+    response = await ds_compress.client.get(
+        path, headers={"accept-encoding": "identity"}
+    )
+    assert "content-encoding" not in response.headers
+    assert len(response.json()["rows"]) == 1000
+
+
+@pytest.mark.asyncio
+async def test_compress_skips_small_responses(ds_compress):
+    response = await ds_compress.client.get(
+        numbers_path("json", 1), headers={"accept-encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_compress_streamed_csv(ds_compress):
+    response = await ds_compress.client.get(
+        numbers_path("csv", 5000),
+        headers={"accept-encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text.split("\r\n")[:3] == ["value", "1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_compress_responses_off_by_default():
+    ds = Datasette(memory=True)
+    response = await ds.client.get(
+        numbers_path("json", 1000),
+        headers={"accept-encoding": "gzip"},
+    )
+    assert "content-encoding" not in response.headers
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "accept_encoding,expected_encoding",
+    (("gzip", "gzip"), ("identity", None)),
+)
+async def test_asgi_static_precompressed(tmp_path, accept_encoding, expected_encoding):
+    content = b"body { color: red; }\n" * 100
+    (tmp_path / "app.css").write_bytes(content)
+    (tmp_path / "app.css.gz").write_bytes(gzip.compress(content))
+    static = asgi_static(tmp_path, immutable=True)
+
+    async def get(headers):
+        request = Request.fake("/app.css", url_vars={"path": "app.css"})
+        request.scope["headers"] = [
+            [key.encode("latin-1"), value.encode("latin-1")]
+            for key, value in headers.items()
+        ]
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await static(request, send)
+        headers = {
+            key.decode("latin-1").lower(): value.decode("latin-1")
+            for key, value in messages[0]["headers"]
+        }
+        body = b"".join(message.get("body", b"") for message in messages[1:])
+        return messages[0]["status"], headers, body
+
+    status, headers, body = await get({"accept-encoding": accept_encoding})
+    assert status == 200
+    assert headers["content-type"] == "text/css"
+    assert headers["vary"] == "Accept-Encoding"
+    assert headers.get("content-encoding") == expected_encoding
+    if expected_encoding:
+        assert gzip.decompress(body) == content
+        assert headers["etag"].endswith('-gzip"')
+    else:
+        assert body == content
+    # Revalidating with the ETag of that representation returns a 304
+    status, _, _ = await get(
+        {"accept-encoding": accept_encoding, "if-none-match": headers["etag"]}
+    )
+    assert status == 304
+
+
+@pytest.mark.asyncio
+async def test_asgi_static_immutable_reads_files_on_first_request(tmp_path):
+    (tmp_path / "one.css").write_text("one")
+    (tmp_path / "two.css").write_text("two")
+    with mock.patch(
+        "datasette.utils.asgi.calculate_etag", wraps=calculate_etag
+    ) as etag_mock:
+        static = asgi_static(tmp_path, immutable=True)
+        # Nothing is hashed until a file is requested
+        assert not etag_mock.called
+        request = Request.fake("/one.css", url_vars={"path": "one.css"})
+        for _ in range(2):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            await static(request, send)
+            assert messages[0]["status"] == 200
+            assert (b"etag", b'"%s"' % hashlib.md5(b"one").hexdigest().encode()) in [
+                (key.lower(), value) for key, value in messages[0]["headers"]
+            ]
+        # Only one.css was hashed, and only once
+        assert etag_mock.call_count == 1
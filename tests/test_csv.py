@@ -229,6 +229,40 @@ async def test_table_csv_stream(ds_client):
         "/fixtures/compound_three_primary_keys.csv?_stream=1"
     )
     assert len([b for b in response.content.split(b"\r\n") if b]) == 1002
+    # Views paginated by offset should stream every row exactly once
+    response = await ds_client.get("/fixtures/paginated_view.csv?_stream=1")
+    assert len([b for b in response.content.split(b"\r\n") if b]) == 202
+
+
+@pytest.mark.asyncio
+async def test_table_csv_stream_coalesces_chunks(ds_client):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        messages.append(message)
+
+    path = "/fixtures/compound_three_primary_keys.csv"
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "path": path,
+        "raw_path": path.encode("latin-1"),
+        "query_string": b"_stream=1",
+        "headers": [],
+    }
+    await ds_client.ds.app()(scope, receive, send)
+    bodies = [
+        message["body"]
+        for message in messages
+        if message["type"] == "http.response.body" and message["body"]
+    ]
+    # Two pages totalling around 20KB are sent as a single chunk
+    assert len(bodies) == 1
+    assert bodies[0].count(b"\r\n") == 1002
 
 
 def test_csv_trace(app_client_with_trace):
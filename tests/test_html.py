@@ -15,6 +15,7 @@ import copy
 import json
 import pathlib
 import pytest
+import sqlite3
 import re
 import urllib.parse
 
@@ -110,6 +111,35 @@ async def test_static(ds_client):
     assert response.status_code == 304
 
 
+@pytest.mark.asyncio
+async def test_static_range(ds_client):
+    full = (await ds_client.get("/-/static/app.css")).content
+    response = await ds_client.get("/-/static/app.css", headers={"range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes {}-{}/{}".format(
+        len(full) - 10, len(full) - 1, len(full)
+    )
+    assert response.content == full[-10:]
+    response = await ds_client.get(
+        "/-/static/app.css", headers={"range": "bytes={}-".format(len(full))}
+    )
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */{}".format(len(full))
+
+
+def test_static_mount_etag_changes_with_file(tmp_path):
+    (tmp_path / "one.txt").write_text("one")
+    with make_app_client(static_mounts=[("custom-static", str(tmp_path))]) as client:
+        response = client.get("/custom-static/one.txt")
+        etag = response.headers["etag"]
+        assert response.text == "one"
+        (tmp_path / "one.txt").write_text("changed")
+        response = client.get("/custom-static/one.txt", if_none_match=etag)
+        assert response.status == 200
+        assert response.text == "changed"
+        assert response.headers["etag"] != etag
+
+
 def test_static_mounts():
     with make_app_client(
         static_mounts=[("custom-static", str(pathlib.Path(__file__).parent))]
@@ -515,7 +545,8 @@ def test_database_download_for_immutable():
             download_response.headers["content-disposition"]
             == 'attachment; filename="fixtures.db"'
         )
-        assert download_response.headers["transfer-encoding"] == "chunked"
+        assert download_response.headers["accept-ranges"] == "bytes"
+        assert "transfer-encoding" not in download_response.headers
         # ETag header should be present and match db.hash
         assert "etag" in download_response.headers
         etag = download_response.headers["etag"]
@@ -526,6 +557,64 @@ def test_database_download_for_immutable():
         assert download_response2.status == 304
 
 
+def test_database_download_range():
+    with make_app_client(is_immutable=True) as client:
+        full = client.get("/fixtures.db").body
+        response = client.get("/fixtures.db", headers={"range": "bytes=100-199"})
+        assert response.status == 206
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.headers["content-range"] == "bytes 100-199/{}".format(len(full))
+        assert response.headers["content-length"] == "100"
+        assert response.body == full[100:200]
+        # Resuming from an offset returns the rest of the file
+        response = client.get("/fixtures.db", headers={"range": "bytes=1000-"})
+        assert response.status == 206
+        assert response.body == full[1000:]
+
+
+def test_database_download_if_range():
+    with make_app_client(is_immutable=True) as client:
+        etag = '"{}"'.format(client.ds.databases["fixtures"].hash)
+        response = client.get(
+            "/fixtures.db", headers={"range": "bytes=0-9", "if-range": etag}
+        )
+        assert response.status == 206
+        assert len(response.body) == 10
+        # A different ETag means the client has an old copy: send it all
+        response = client.get(
+            "/fixtures.db", headers={"range": "bytes=0-9", "if-range": '"old"'}
+        )
+        assert response.status == 200
+        assert len(response.body) > 10
+
+
+def test_database_download_multiple_ranges():
+    with make_app_client(is_immutable=True) as client:
+        full = client.get("/fixtures.db").body
+        response = client.get("/fixtures.db", headers={"range": "bytes=0-9,-5"})
+        assert response.status == 206
+        content_type = response.headers["content-type"]
+        assert content_type.startswith("multipart/byteranges; boundary=")
+        boundary = content_type.split("boundary=")[1].encode("latin-1")
+        assert int(response.headers["content-length"]) == len(response.body)
+        assert response.body == (
+            b"--%s\r\nContent-Type: application/octet-stream\r\n"
+            b"Content-Range: bytes 0-9/%d\r\n\r\n%s\r\n"
+            b"--%s\r\nContent-Type: application/octet-stream\r\n"
+            b"Content-Range: bytes %d-%d/%d\r\n\r\n%s\r\n--%s--\r\n"
+        ) % (
+            boundary,
+            len(full),
+            full[:10],
+            boundary,
+            len(full) - 5,
+            len(full) - 1,
+            len(full),
+            full[-5:],
+            boundary,
+        )
+
+
 def test_database_download_disallowed_for_mutable(app_client):
     # Use app_client because we need a file database, not in-memory
     response = app_client.get("/fixtures")
@@ -534,6 +623,24 @@ def test_database_download_disallowed_for_mutable(app_client):
     assert app_client.get("/fixtures.db").status_code == 403
 
 
+def test_database_download_snapshot_for_mutable(tmp_path):
+    with make_app_client(settings={"allow_snapshot_download": True}) as client:
+        response = client.get("/fixtures")
+        soup = Soup(response.content, "html.parser")
+        assert len(soup.findAll("a", {"href": re.compile(r"\.db$")})) == 1
+        response = client.get("/fixtures.db")
+        assert response.status == 200
+        assert response.headers["content-type"] == "application/octet-stream"
+        # Snapshots are taken per request, so cannot be cached or resumed
+        assert "etag" not in response.headers
+        assert "accept-ranges" not in response.headers
+        path = tmp_path / "snapshot.db"
+        path.write_bytes(response.body)
+        conn = sqlite3.connect(str(path))
+        assert conn.execute("pragma integrity_check").fetchone()[0] == "ok"
+        assert conn.execute("select count(*) from facetable").fetchone()[0] == 15
+
+
 def test_database_download_disallowed_for_memory():
     with make_app_client(memory=True) as client:
         # Memory page should NOT have a download link
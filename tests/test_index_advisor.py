@@ -0,0 +1,116 @@
+from datasette.app import Datasette
+from datasette.index_advisor import create_index_sql, plan_problems
+import pytest
+import sqlite_utils
+
+
+@pytest.mark.parametrize(
+    "plan,filtered,expected",
+    (
+        (["SCAN t"], True, ["SCAN t"]),
+        (["SCAN t"], False, []),
+        (["SCAN TABLE t"], True, ["SCAN TABLE t"]),
+        (["SEARCH t USING INDEX idx_t_a (a=?)"], True, []),
+        (["SCAN t USING INDEX idx_t_a"], True, []),
+        (["SCAN t2"], True, []),
+        (
+            ["SCAN t", "USE TEMP B-TREE FOR ORDER BY"],
+            False,
+            ["USE TEMP B-TREE FOR ORDER BY"],
+        ),
+    ),
+)
+def test_plan_problems(plan, filtered, expected):
+    plan = [{"id": i, "parent": 0, "detail": detail} for i, detail in enumerate(plan)]
+    assert plan_problems(plan, "t", filtered=filtered) == expected
+
+
+def test_create_index_sql():
+    assert (
+        create_index_sql("my table", ["a", "b c"])
+        == "CREATE INDEX [idx_my table_a_b c] ON [my table] (a, [b c])"
+    )
+
+
+@pytest.mark.asyncio
+async def test_index_advice(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path)["t"].insert_all(
+        [{"id": i, "a": i % 5, "b": str(i), "c": i * 2} for i in range(20)], pk="id"
+    )
+    ds = Datasette([path])
+    await ds.invoke_startup()
+    root_cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    for query_string in ("a=1", "a=1&_sort=c", "a=2&_sort=c", "_facet=b", "_sort=id"):
+        response = await ds.client.get("/data/t?" + query_string)
+        assert response.status_code == 200
+    assert (await ds.client.get("/-/index-advice.json")).status_code == 403
+    advice = (await ds.client.get("/-/index-advice.json", cookies=root_cookies)).json()
+    # Sorting by the primary key is already fast, and the index on (a, c)
+    # can also be used by the query that only filters on a
+    assert [(item["columns"], item["count"]) for item in advice] == [
+        (["a", "c"], 3),
+        (["b"], 1),
+    ]
+    assert advice[0]["sql"] == "CREATE INDEX idx_t_a_c ON t (a, c)"
+    assert advice[0]["queries"][0] == {
+        "sql": "select * from t where a = :p0 order by c",
+        "count": 2,
+        "problems": ["SCAN t", "USE TEMP B-TREE FOR ORDER BY"],
+    }
+    # Apply the first suggestion
+    response = await ds.client.post(
+        "/-/index-advice",
+        json={"database": "data", "table": "t", "columns": ["a", "c"]},
+        cookies=root_cookies,
+    )
+    assert response.status_code == 201
+    assert response.json() == {"ok": True, "sql": "CREATE INDEX idx_t_a_c ON t (a, c)"}
+    advice = (await ds.client.get("/-/index-advice.json", cookies=root_cookies)).json()
+    assert [item["columns"] for item in advice] == [["b"]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "body,cookies,expected_status",
+    (
+        ({"database": "data", "table": "t", "columns": ["a"]}, False, 403),
+        # Does not reveal whether the table exists
+        ({"database": "data", "table": "nope", "columns": ["a"]}, False, 403),
+        ({"database": "data", "table": "t"}, True, 400),
+        ({"database": "data", "table": "t", "columns": ["nope"]}, True, 400),
+        ({"database": "data", "table": "nope", "columns": ["a"]}, True, 404),
+    ),
+)
+async def test_index_advice_apply_errors(tmp_path, body, cookies, expected_status):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path)["t"].insert({"id": 1, "a": 1}, pk="id")
+    ds = Datasette([path])
+    response = await ds.client.post(
+        "/-/index-advice",
+        json=body,
+        cookies=(
+            {"ds_actor": ds.client.actor_cookie({"id": "root"})} if cookies else None
+        ),
+    )
+    assert response.status_code == expected_status
+    assert response.json()["ok"] is False
+
+
+@pytest.mark.asyncio
+async def test_index_advice_streamed_pages_counted_once(tmp_path):
+    path = str(tmp_path / "data.db")
+    sqlite_utils.Database(path)["t"].insert_all(
+        [{"id": i, "c": i * 2} for i in range(20)], pk="id"
+    )
+    ds = Datasette([path])
+    response = await ds.client.get("/data/t.csv?_sort=c&_size=2&_stream=1")
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 21
+    advice = (
+        await ds.client.get(
+            "/-/index-advice.json",
+            cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+        )
+    ).json()
+    assert [(item["columns"], item["count"]) for item in advice] == [(["c"], 1)]
@@ -5,9 +5,12 @@ Tests for the datasette.database.Database class
 from datasette.app import Datasette
 from datasette.database import Database, Results, MultipleValues
 from datasette.utils.sqlite import sqlite3, sqlite_version
-from datasette.utils import Column
+from datasette.utils import Column, StartupError
 from .fixtures import app_client, app_client_two_attached_databases_crossdb_enabled
+import asyncio
+import hashlib
 import pytest
+import threading
 import time
 import uuid
 
@@ -637,6 +640,110 @@ def test_is_mutable(app_client):
     assert Database(app_client.ds, is_memory=True, is_mutable=False).is_mutable is False
 
 
+@pytest.mark.asyncio
+async def test_snapshot(db, tmp_path, monkeypatch):
+    monkeypatch.setattr("datasette.database.SNAPSHOT_PAGES", 4)
+    progress = []
+    path = tmp_path / "snapshot.db"
+    await db.snapshot(path, progress=lambda copied, total: progress.append(copied))
+    assert db.snapshot_progress is None
+    # Reported for each batch of pages copied
+    assert len(progress) > 1
+    assert progress == sorted(progress)
+    conn = sqlite3.connect(str(path))
+    tables = [r[0] for r in conn.execute("select name from sqlite_master")]
+    assert set(await db.table_names()) <= set(tables)
+    assert conn.execute("select count(*) from facetable").fetchone()[0] == 15
+
+
+@pytest.mark.asyncio
+async def test_snapshot_finishes_during_writes(tmp_path):
+    path = tmp_path / "busy.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("create table t (id integer primary key, body text)")
+    # Large enough that copying in batches would be restarted by each write
+    conn.executemany(
+        "insert into t (body) values (?)", [("x" * 4000,) for _ in range(3000)]
+    )
+    conn.commit()
+    conn.close()
+    stop = threading.Event()
+
+    def write_continuously():
+        writer = sqlite3.connect(str(path), timeout=0.01)
+        while not stop.is_set():
+            try:
+                writer.execute("insert into t (body) values ('more')")
+                writer.commit()
+            except sqlite3.OperationalError:
+                # Locked while the snapshot is being copied
+                pass
+        writer.close()
+
+    thread = threading.Thread(target=write_continuously)
+    thread.start()
+    try:
+        ds = Datasette([str(path)])
+        snapshot_path = tmp_path / "snapshot.db"
+        await asyncio.wait_for(ds.get_database("busy").snapshot(snapshot_path), 30)
+    finally:
+        stop.set()
+        thread.join()
+    snapshot = sqlite3.connect(str(snapshot_path))
+    assert snapshot.execute("select count(*) from t").fetchone()[0] >= 3000
+
+
+@pytest.fixture
+def immutable_path(tmp_path):
+    path = tmp_path / "immutable.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("create table t (id integer primary key, body text)")
+    conn.executemany(
+        "insert into t (body) values (?)", [("x" * 1000,) for _ in range(200)]
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.mark.parametrize("strategy", ("sha256", "sampled", "header"))
+def test_hash_strategy(immutable_path, strategy):
+    ds = Datasette(
+        immutables=[str(immutable_path)], settings={"hash_strategy": strategy}
+    )
+    hash = ds.get_database("immutable").hash
+    assert len(hash) == 64
+    if strategy == "sha256":
+        assert hash == hashlib.sha256(immutable_path.read_bytes()).hexdigest()
+    # Changing the file changes the hash
+    conn = sqlite3.connect(str(immutable_path))
+    conn.execute("insert into t (body) values ('changed')")
+    conn.commit()
+    conn.close()
+    ds = Datasette(
+        immutables=[str(immutable_path)], settings={"hash_strategy": strategy}
+    )
+    assert ds.get_database("immutable").hash != hash
+
+
+def test_hash_strategy_invalid():
+    with pytest.raises(StartupError) as ex:
+        Datasette(settings={"hash_strategy": "md5"})
+    assert ex.value.args[0].startswith("hash_strategy setting must be one of")
+
+
+@pytest.mark.asyncio
+async def test_hash_in_background(immutable_path, monkeypatch):
+    monkeypatch.setattr("datasette.database.BACKGROUND_HASH_SIZE", 0)
+    ds = Datasette(immutables=[str(immutable_path)])
+    db = ds.get_database("immutable")
+    await ds.invoke_startup()
+    assert db._hash_future is not None
+    expected = hashlib.sha256(immutable_path.read_bytes()).hexdigest()
+    assert await db.wait_for_hash() == expected
+    assert db.hash == expected
+
+
 @pytest.mark.asyncio
 async def test_attached_databases(app_client_two_attached_databases_crossdb_enabled):
     database = app_client_two_attached_databases_crossdb_enabled.ds.get_database(
@@ -721,3 +828,14 @@ async def test_hidden_tables(app_client):
         "r_parent",
         "r_rowid",
     ]
+
+
+@pytest.mark.asyncio
+async def test_explain_query_plan(db):
+    plan = await db.explain_query_plan(
+        "select * from facetable where state = :state", {"state": "CA"}
+    )
+    assert plan and set(plan[0].keys()) == {"id", "parent", "detail"}
+    assert "facetable" in plan[0]["detail"]
+    with pytest.raises(sqlite3.OperationalError):
+        await db.explain_query_plan("select * from no_such_table")
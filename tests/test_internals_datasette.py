@@ -3,8 +3,9 @@ Tests for the datasette.app.Datasette class
 """
 
 import dataclasses
-from datasette import Forbidden, Context
+from datasette import Forbidden, Context, cacheable, hookimpl
 from datasette.app import Datasette, Database
+from datasette.plugins import pm
 from itsdangerous import BadSignature
 import pytest
 
@@ -154,6 +155,86 @@ async def test_datasette_render_template_with_dataclass():
     assert "Error message" in rendered
 
 
+@pytest.mark.parametrize("reload_templates", (False, True))
+def test_select_template_cache(tmp_path, reload_templates):
+    (tmp_path / "custom.html").write_text("one", "utf-8")
+    ds = Datasette(
+        memory=True,
+        template_dir=str(tmp_path),
+        settings={"reload_templates": reload_templates},
+    )
+    environment = ds.get_jinja_environment()
+    names = ["missing.html", "custom.html"]
+    template = environment.select_template(names)
+    assert template.name == "custom.html"
+    assert environment.select_template(names) is template
+    # New candidate templates are only seen when templates are reloaded
+    (tmp_path / "missing.html").write_text("two", "utf-8")
+    assert environment.select_template(names).name == (
+        "missing.html" if reload_templates else "custom.html"
+    )
+
+
+@pytest.mark.asyncio
+async def test_asset_urls_cached_for_cacheable_hooks():
+    calls = []
+    uncached_calls = []
+
+    class CachedAssetsPlugin:
+        __name__ = "CachedAssetsPlugin"
+
+        @hookimpl
+        @cacheable
+        def extra_css_urls(self, view_name):
+            calls.append(view_name)
+            return ["/static/{}.css".format(view_name)]
+
+    class UncachedAssetsPlugin:
+        __name__ = "UncachedAssetsPlugin"
+
+        # Takes neither request nor datasette, but is not marked @cacheable
+        @hookimpl
+        def extra_css_urls(self, view_name):
+            uncached_calls.append(view_name)
+            return ["/static/uncached-{}.css".format(len(uncached_calls))]
+
+    hook_calls = []
+    ds = Datasette(memory=True)
+    await ds.invoke_startup()
+    try:
+        pm.register(CachedAssetsPlugin(), name="cached_assets")
+        pm.register(UncachedAssetsPlugin(), name="uncached_assets")
+        undo = pm.add_hookcall_monitoring(
+            lambda hook_name, hook_impls, kwargs: hook_calls.append(
+                (hook_name, [impl.plugin_name for impl in hook_impls])
+            ),
+            lambda outcome, hook_name, hook_impls, kwargs: None,
+        )
+        try:
+            for i in range(3):
+                rendered = await ds.render_template("error.html", view_name="one")
+                assert "/static/one.css" in rendered
+                assert "/static/uncached-{}.css".format(i + 1) in rendered
+            await ds.render_template("error.html", view_name="two")
+        finally:
+            undo()
+        assert calls == ["one", "two"]
+        assert uncached_calls == ["one", "one", "one", "two"]
+        # Implementations are still called through pluggy
+        assert ("extra_css_urls", ["cached_assets"]) in hook_calls
+        assert ("extra_css_urls", ["uncached_assets"]) in hook_calls
+        # Callers are only built again when the registered plugins change
+        callers = ds._asset_url_callers("extra_css_urls")
+        assert ds._asset_url_callers("extra_css_urls") is callers
+        pm.unregister(name="uncached_assets")
+        assert ds._asset_url_callers("extra_css_urls") is not callers
+        assert "uncached" not in await ds.render_template("error.html", view_name="one")
+    finally:
+        pm.unregister(name="cached_assets")
+        if pm.get_plugin("uncached_assets"):
+            pm.unregister(name="uncached_assets")
+
+
 def test_datasette_error_if_string_not_list(tmpdir):
     # https://github.com/simonw/datasette/issues/1985
     db_path = str(tmpdir / "data.db")
@@ -216,6 +216,18 @@ async def test_hook_render_cell_async(ds_client, path):
     assert b"RENDER_CELL_ASYNC_RESULT" in response.content
 
 
+@pytest.mark.asyncio
+async def test_hook_render_cells(ds_client):
+    sql = "select '<b>one</b>' as render_cells_demo, 'two' as other"
+    path = "/fixtures/-/query?" + urllib.parse.urlencode({"sql": sql})
+    response = await ds_client.get(path)
+    tds = Soup(response.text, "html.parser").find("table").find("tbody").find_all("td")
+    assert str(tds[0]) == (
+        '<td class="col-render_cells_demo">' "<em>&lt;b&gt;one&lt;/b&gt;</em></td>"
+    )
+    assert tds[1].text == "two"
+
+
 @pytest.mark.asyncio
 async def test_plugin_config(ds_client):
     assert {"depth": "table"} == ds_client.ds.plugin_config(
@@ -443,6 +455,35 @@ async def test_hook_register_output_renderer_no_parameters(ds_client):
     assert b"Hello" == response.content
 
 
+@pytest.mark.asyncio
+async def test_hook_register_output_renderer_data_rows_are_dicts():
+    class DataRowsRenderer:
+        __name__ = "DataRowsRenderer"
+
+        @hookimpl
+        def register_output_renderer(self):
+            return {
+                "extension": "datarows",
+                "render": lambda data: {
+                    "body": json.dumps([row.get("pk") for row in data["rows"]])
+                },
+            }
+
+    pm.register(DataRowsRenderer(), name="DataRowsRenderer")
+    try:
+        ds = Datasette(memory=True)
+        db = ds.add_memory_database("data_rows")
+        await db.execute_write(
+            "create table if not exists t (pk integer primary key, name text)"
+        )
+        await db.execute_write("insert or ignore into t values (1, 'one'), (2, 'two')")
+        response = await ds.client.get("/data_rows/t.datarows")
+        assert response.status_code == 200
+        assert response.json() == [1, 2]
+    finally:
+        pm.unregister(name="DataRowsRenderer")
+
+
 @pytest.mark.asyncio
 async def test_hook_register_output_renderer_all_parameters(ds_client):
     response = await ds_client.get("/fixtures/facetable.testall")
@@ -1101,6 +1142,7 @@ def test_hook_register_commands():
         "package",
         "plugins",
         "publish",
+        "snapshot",
         "uninstall",
         "create-token",
     }
@@ -1130,6 +1172,7 @@ def test_hook_register_commands():
         "package",
         "plugins",
         "publish",
+        "snapshot",
         "uninstall",
         "verify",
         "unverify",
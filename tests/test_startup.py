@@ -0,0 +1,48 @@
+import subprocess
+import sys
+import pytest
+
+# Modules that are slow to import and only needed by the CLI or by rarely
+# used features, so should not be imported by "import datasette.app"
+LAZY_MODULES = (
+    "click",
+    "httpx",
+    "pyarrow",
+    "sqlite_utils",
+    "uvicorn",
+    "yaml",
+    "datasette.cli",
+    "datasette.publish.common",
+)
+
+
+def imported_modules(code):
+    # python -X importtime writes one line to stderr for each module imported
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {
+        line.split("|")[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+@pytest.fixture(scope="module")
+def app_imports():
+    return imported_modules("import datasette.app")
+
+
+@pytest.mark.parametrize("module", LAZY_MODULES)
+def test_import_does_not_load_lazy_modules(app_imports, module):
+    assert module not in app_imports
+
+
+def test_cli_still_registers_publish_commands():
+    modules = imported_modules(
+        "from datasette.cli import cli; assert 'heroku' in cli.commands['publish'].commands"
+    )
+    assert "datasette.publish.common" in modules
@@ -1,5 +1,6 @@
+from datasette.app import Datasette
 from datasette.utils import detect_json1
-from datasette.utils.sqlite import sqlite_version
+from datasette.utils.sqlite import sqlite3, sqlite_version
 from .fixtures import (  # noqa
     app_client,
     app_client_with_trace,
@@ -54,6 +55,83 @@ async def test_table_shape_arrays(ds_client):
     ]
 
 
+@pytest.mark.asyncio
+async def test_table_shape_arrays_with_labels(ds_client):
+    response = await ds_client.get(
+        "/fixtures/facetable.json?_shape=arrays&_labels=on&_col=_city_id&_size=2"
+    )
+    assert response.json()["rows"] == [
+        [1, {"value": 1, "label": "San Francisco"}],
+        [2, {"value": 1, "label": "San Francisco"}],
+    ]
+
+
+@pytest.mark.asyncio
+async def test_table_json_columns(ds_client):
+    response = await ds_client.get(
+        "/fixtures/facetable.json?_extra=columns&_json=tags&_col=tags&_size=2"
+    )
+    assert response.json()["rows"] == [
+        {"pk": 1, "tags": ["tag1", "tag2"]},
+        {"pk": 2, "tags": ["tag1", "tag3"]},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_table_shape_columns(ds_client):
+    response = await ds_client.get("/fixtures/simple_primary_key.json?_shape=columns")
+    data = response.json()
+    assert data["rows"] == {
+        "id": ["1", "2", "3", "4", "5"],
+        "content": ["hello", "world", "", "RENDER_CELL_DEMO", "RENDER_CELL_ASYNC"],
+    }
+    assert "columns" not in data
+
+
+@pytest.mark.asyncio
+async def test_table_shape_columns_with_labels_and_types(ds_client):
+    response = await ds_client.get(
+        "/fixtures/facetable.json?_shape=columns&_labels=on&_col=_city_id"
+        "&_col=planet_int&_size=2&_extra=column_types"
+    )
+    data = response.json()
+    assert data["rows"] == {
+        "pk": [1, 2],
+        "_city_id": [
+            {"value": 1, "label": "San Francisco"},
+            {"value": 1, "label": "San Francisco"},
+        ],
+        "planet_int": [1, 1],
+    }
+    assert data["column_types"] == {
+        "pk": "INTEGER",
+        "_city_id": "INTEGER",
+        "planet_int": "INTEGER",
+    }
+
+
+@pytest.mark.asyncio
+async def test_table_shape_columns_no_rows(ds_client):
+    response = await ds_client.get(
+        "/fixtures/simple_primary_key.json?_shape=columns&id=no-such-id"
+    )
+    assert response.json()["rows"] == {"id": [], "content": []}
+
+
+@pytest.mark.asyncio
+async def test_query_shape_columns(ds_client):
+    response = await ds_client.get(
+        "/fixtures/-/query.json?"
+        + urllib.parse.urlencode(
+            {
+                "sql": "select 1 as a, 'x' as b union all select 2, 'y'",
+                "_shape": "columns",
+            }
+        )
+    )
+    assert response.json()["rows"] == {"a": [1, 2], "b": ["x", "y"]}
+
+
 @pytest.mark.asyncio
 async def test_table_shape_arrayfirst(ds_client):
     response = await ds_client.get(
@@ -265,6 +343,134 @@ async def test_paginate_compound_keys(ds_client):
     assert expected == contents
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query_string",
+    ("_stream=1", "_stream=1&_shape=array", "_stream=1&_shape=arrays"),
+)
+async def test_table_json_stream(ds_client, query_string):
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.json?_size=max&" + query_string
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json; charset=utf-8"
+    data = response.json()
+    rows = data if "_shape=array&" in query_string + "&" else data["rows"]
+    assert len(rows) == 1001
+    expected = [r[3] for r in generate_compound_rows(1001)]
+    if "_shape=arrays" in query_string:
+        assert [row[3] for row in rows] == expected
+    else:
+        assert [row["content"] for row in rows] == expected
+
+
+@pytest.mark.asyncio
+async def test_table_json_stream_newline_delimited(ds_client):
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.json?_stream=1&_shape=array&_nl=1"
+    )
+    assert response.status_code == 200
+    lines = response.text.split("\n")
+    assert len(lines) == 1001
+    assert json.loads(lines[-1]) == {
+        "pk1": "b",
+        "pk2": "m",
+        "pk3": "m",
+        "content": "b-m-m",
+    }
+
+
+@pytest.mark.asyncio
+async def test_table_json_stream_nl_off(ds_client):
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.json?_stream=1&_shape=array&_nl=0"
+    )
+    assert response.status_code == 200
+    assert len(response.json()) == 1001
+
+
+async def _json_stream_datasette(name):
+    ds = Datasette()
+    db = ds.add_memory_database(name)
+    await db.execute_write("create table if not exists t (id integer primary key)")
+    await db.execute_write_many(
+        "insert or ignore into t (id) values (?)", [(i,) for i in range(1001)]
+    )
+    page_sqls = []
+    execute = db.execute
+
+    async def recording_execute(sql, *args, **kwargs):
+        if sql.startswith("select id from t"):
+            page_sqls.append(sql)
+        return await execute(sql, *args, **kwargs)
+
+    db.execute = recording_execute
+    return ds, db, page_sqls
+
+
+@pytest.mark.asyncio
+async def test_table_json_stream_uses_max_size_pages():
+    ds, _, page_sqls = await _json_stream_datasette("json_stream_pages")
+    response = await ds.client.get("/json_stream_pages/t.json?_stream=1")
+    assert len(response.json()["rows"]) == 1001
+    # The first query is the table view's own, before streaming starts
+    streamed = page_sqls[1:]
+    assert len(streamed) == 2
+    assert all("limit 1001" in sql for sql in streamed)
+    # An explicit ?_size= is respected
+    page_sqls.clear()
+    response = await ds.client.get("/json_stream_pages/t.json?_stream=1&_size=500")
+    assert len(response.json()["rows"]) == 1001
+    assert len(page_sqls[1:]) == 3
+
+
+@pytest.mark.asyncio
+async def test_table_json_stream_error_part_way():
+    ds, db, page_sqls = await _json_stream_datasette("json_stream_error")
+    execute = db.execute
+
+    async def failing_execute(sql, *args, **kwargs):
+        results = await execute(sql, *args, **kwargs)
+        # Fail on the second page of the stream
+        if len(page_sqls) > 2:
+            raise sqlite3.OperationalError("disk I/O error")
+        return results
+
+    db.execute = failing_execute
+    response = await ds.client.get("/json_stream_error/t.json?_stream=1&_size=100")
+    assert response.status_code == 200
+    # Still well-formed JSON, with the error after the rows sent so far
+    data = response.json()
+    assert len(data["rows"]) == 100
+    assert data["ok"] is False
+    assert data["error"] == "disk I/O error"
+    # A plain list of rows cannot report the error, so the response is aborted
+    page_sqls.clear()
+    with pytest.raises(Exception):
+        await ds.client.get(
+            "/json_stream_error/t.json?_stream=1&_size=100&_shape=array"
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query_string,expected_error",
+    (
+        (
+            "_stream=1&_shape=object",
+            "_shape=object is not supported for JSON streaming",
+        ),
+        ("_stream=1&_next=a,a,a", "_next not allowed for JSON streaming"),
+    ),
+)
+async def test_table_json_stream_errors(ds_client, query_string, expected_error):
+    response = await ds_client.get(
+        "/fixtures/compound_three_primary_keys.json?" + query_string
+    )
+    assert response.status_code == 400
+    assert response.json()["error"] == expected_error
+
+
 @pytest.mark.asyncio
 async def test_paginate_compound_keys_with_extra_filters(ds_client):
     fetched = []
@@ -1382,3 +1588,108 @@ async def test_table_extras(ds_client, extra, expected_json):
     )
     assert response.status_code == 200
     assert response.json() == expected_json
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "query_string,expected_ids",
+    (
+        ("", list(range(1, 24))),
+        ("_sort_desc=category", sorted(range(1, 24), key=lambda i: (-(i % 3), i))),
+        ("id__gt=10", list(range(11, 24))),
+    ),
+)
+async def test_paginate_view_with_keyset_columns(query_string, expected_ids):
+    ds = Datasette(
+        config={
+            "databases": {
+                "keyset": {
+                    "tables": {"items_view": {"keyset_columns": ["id"], "size": 5}}
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("keyset")
+    await db.execute_write(
+        "create table if not exists items (id integer primary key, category integer)"
+    )
+    await db.execute_write_many(
+        "insert or ignore into items (id, category) values (?, ?)",
+        [(i, i % 3) for i in range(1, 24)],
+    )
+    await db.execute_write(
+        "create view if not exists items_view as "
+        "select id, category from items order by id desc"
+    )
+    path = "/keyset/items_view.json?_extra=next_url&" + query_string
+    fetched = []
+    sqls = []
+    while path:
+        response = await ds.client.get(path + "&_extra=query")
+        assert response.status_code == 200
+        fetched.extend(row["id"] for row in response.json()["rows"])
+        sqls.append(response.json()["query"]["sql"])
+        path = response.json()["next_url"]
+        if path:
+            path = path.replace("http://localhost", "")
+        assert len(fetched) < 100, "Possible infinite loop detected"
+    assert fetched == expected_ids
+    # Should not be using offset pagination
+    assert not any(" offset " in sql for sql in sqls)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query_string", ("", "_sort=label"))
+async def test_paginate_view_with_computed_keyset_column(query_string):
+    # Expression columns in a view have no type affinity, so comparing them
+    # to a text _next value would match nothing after the first page
+    ds = Datasette(
+        config={
+            "databases": {
+                "keyset_view_computed": {
+                    "tables": {"doubled": {"keyset_columns": ["k"], "size": 10}}
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("keyset_view_computed")
+    await db.execute_write(
+        "create table if not exists numbers (id integer primary key)"
+    )
+    await db.execute_write_many(
+        "insert or ignore into numbers (id) values (?)", [(i,) for i in range(1, 31)]
+    )
+    await db.execute_write(
+        "create view if not exists doubled as "
+        "select id * 2 as k, id % 3 + 0.5 as label from numbers"
+    )
+    path = "/keyset_view_computed/doubled.json?_extra=next_url&" + query_string
+    fetched = []
+    while path:
+        response = await ds.client.get(path)
+        assert response.status_code == 200
+        fetched.extend(row["k"] for row in response.json()["rows"])
+        path = response.json()["next_url"]
+        if path:
+            path = path.replace("http://localhost", "")
+        assert len(fetched) <= 30, "Possible infinite loop detected"
+    assert sorted(fetched) == [i * 2 for i in range(1, 31)]
+    assert len(fetched) == 30
+
+
+@pytest.mark.asyncio
+async def test_view_keyset_columns_invalid_column():
+    ds = Datasette(
+        config={
+            "databases": {
+                "keyset_bad": {
+                    "tables": {"items_view": {"keyset_columns": ["missing"]}}
+                }
+            }
+        }
+    )
+    db = ds.add_memory_database("keyset_bad")
+    await db.execute_write("create view if not exists items_view as select 1 as id")
+    response = await ds.client.get("/keyset_bad/items_view.json")
+    assert response.status_code == 500
+    assert response.json()["error"] == "keyset_columns=missing - invalid columns"
@@ -1,4 +1,5 @@
 from datasette.app import Datasette
+from datasette.arrow_renderer import pyarrow_available
 from bs4 import BeautifulSoup as Soup
 from .fixtures import (  # noqa
     app_client,
@@ -9,6 +10,9 @@ import pytest
 import urllib.parse
 from .utils import assert_footer_links, inner_html
 
+# Only offered as export formats if pyarrow is installed
+ARROW_FORMATS = ("arrow", "parquet") if pyarrow_available else ()
+
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
@@ -44,6 +48,27 @@ async def test_table_definition_sql(path, expected_definition_sql, ds_client):
     assert expected_definition_sql == pre.string
 
 
+@pytest.mark.parametrize(
+    "path",
+    (
+        "/fixtures/facetable?_labels=on",
+        "/fixtures/simple_primary_key",
+        "/fixtures/compound_three_primary_keys?_size=max",
+        "/fixtures/paginated_view",
+        "/fixtures/facetable?state=XX",
+    ),
+)
+def test_table_html_stream(app_client, path):
+    with make_app_client(settings={"stream_html": True}) as client:
+        response = client.get(path)
+        assert response.status == 200
+        assert response.headers["content-type"] == "text/html; charset=utf-8"
+        streamed = Soup(response.body, "html.parser")
+    expected = Soup(app_client.get(path).body, "html.parser")
+    assert streamed.find("table") == expected.find("table")
+    assert streamed.select(".zero-results") == expected.select(".zero-results")
+
+
 def test_table_cell_truncation():
     with make_app_client(settings={"truncate_cells_html": 5}) as client:
         response = client.get("/fixtures/facetable")
@@ -484,6 +509,10 @@ async def test_table_csv_json_export_interface(ds_client):
     actual = [link["href"] for link in links]
     expected = [
         "/fixtures/simple_primary_key.json?id__gt=2",
+        *(
+            f"/fixtures/simple_primary_key.{format_}?id__gt=2"
+            for format_ in ARROW_FORMATS
+        ),
         "/fixtures/simple_primary_key.testall?id__gt=2",
         "/fixtures/simple_primary_key.testnone?id__gt=2",
         "/fixtures/simple_primary_key.testresponse?id__gt=2",
@@ -524,6 +553,7 @@ async def test_csv_json_export_links_include_labels_if_foreign_keys(ds_client):
     actual = [link["href"] for link in links]
     expected = [
         "/fixtures/facetable.json?_labels=on",
+        *(f"/fixtures/facetable.{format_}?_labels=on" for format_ in ARROW_FORMATS),
         "/fixtures/facetable.testall?_labels=on",
         "/fixtures/facetable.testnone?_labels=on",
         "/fixtures/facetable.testresponse?_labels=on",
@@ -45,6 +45,11 @@ def test_trace(trace_debug):
             sql.startswith(prefix) for sql in sqls
         ), "No trace beginning with: {}".format(prefix)
 
+    # Read queries record time spent waiting for a thread separately
+    reads = [trace for trace in traces if "queue_ms" in trace]
+    assert reads
+    assert all(0 <= trace["queue_ms"] <= trace["duration_ms"] for trace in reads)
+
     # Should be at least one executescript
     assert any(trace for trace in traces if trace.get("executescript"))
     # And at least one executemany
@@ -97,3 +102,42 @@ def test_trace_parallel_queries():
     one, two = traces
     # "two" should have started before "one" ended
     assert two["start"] < one["end"]
+
+
+def test_sampled_traces():
+    with make_app_client(settings={"trace_sample_rate": 2}) as client:
+        root_cookies = {"ds_actor": client.actor_cookie({"id": "root"})}
+        # Requires the debug-menu permission
+        assert client.get("/-/traces.json").status == 403
+        for _ in range(4):
+            client.get("/fixtures/simple_primary_key.json")
+        response = client.get("/-/traces.json", cookies=root_cookies)
+        assert response.status == 200
+        traces = response.json
+        # One in every two requests, including the forbidden one
+        assert len(traces) == 2
+        trace = traces[0]
+        assert trace["path"] == "/fixtures/simple_primary_key.json"
+        assert trace["status"] == 200
+        assert trace["sampled"] is True
+        assert trace["num_spans"] == len(trace["spans"])
+        sql_spans = [span for span in trace["spans"] if span["type"] == "sql"]
+        assert any(span["database"] == "fixtures" for span in sql_spans)
+        for span in sql_spans:
+            # Sampled traces skip the traceback
+            assert "traceback" not in span
+            assert 0 <= span["offset_ms"] <= trace["duration_ms"]
+
+
+def test_sampled_traces_slow_requests():
+    with make_app_client(settings={"trace_slow_ms": 50}) as client:
+        client.get("/fixtures/simple_primary_key.json")
+        client.get("/fixtures/-/query.json?sql=select+sleep(0.1)")
+        traces = client.get(
+            "/-/traces.json",
+            cookies={"ds_actor": client.actor_cookie({"id": "root"})},
+        ).json
+        assert traces[0]["path"] == "/fixtures/-/query.json"
+        for trace in traces:
+            assert trace["sampled"] is False
+            assert trace["duration_ms"] >= 50
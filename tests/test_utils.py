@@ -4,7 +4,7 @@ Tests for various datasette helper functions.
 
 from datasette.app import Datasette
 from datasette import utils
-from datasette.utils.asgi import Request
+from datasette.utils.asgi import Request, asgi_send_file, parse_range_header
 from datasette.utils.sqlite import sqlite3
 import json
 import os
@@ -134,6 +134,42 @@ def test_custom_json_encoder(obj, expected):
     assert expected == actual
 
 
+@pytest.mark.parametrize(
+    "encoder",
+    [
+        "json",
+        pytest.param(
+            "orjson",
+            marks=pytest.mark.skipif(
+                utils.orjson is None, reason="orjson not installed"
+            ),
+        ),
+    ],
+)
+def test_encode_json(encoder):
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("select 1 as id, 'hello' as name").fetchone()
+    data = {
+        "rows": [row],
+        "floats": [1.5, float("inf"), float("-inf")],
+        "blobs": [b"utf8", b"\x15\x1c\x02\xc7"],
+    }
+    assert json.loads(utils.encode_json(data, encoder=encoder)) == {
+        "rows": [[1, "hello"]],
+        "floats": [1.5, None, None],
+        "blobs": ["utf8", {"$base64": True, "encoded": "FRwCxw=="}],
+    }
+
+
+def test_encode_json_infinity():
+    encoded = utils.encode_json([float("inf"), float("-inf")], infinity=True)
+    assert encoded == "[Infinity, -Infinity]"
+    # Output matches json.dumps() when there is nothing to replace
+    data = {"a": [1, "two", None]}
+    assert utils.encode_json(data) == json.dumps(data)
+
+
 @pytest.mark.parametrize(
     "bad_sql",
     [
@@ -527,6 +563,41 @@ def test_multi_params(data, should_raise):
 )
 def test_actor_matches_allow(actor, allow, expected):
     assert expected == utils.actor_matches_allow(actor, allow)
+    # Second call uses the cached compiled matcher
+    assert expected == utils.actor_matches_allow(actor, allow)
+
+
+def test_actor_matches_allow_compiled_cache():
+    allow = {"id": ["root", "bob"]}
+    assert utils.actor_matches_allow({"id": "root"}, allow)
+    matcher = utils._allow_matcher_cache[id(allow)]
+    assert matcher.allow is allow
+    assert utils.actor_matches_allow({"id": "bob"}, allow)
+    assert utils._allow_matcher_cache[id(allow)] is matcher
+    # An equal but distinct allow block gets its own matcher
+    other = {"id": ["root", "bob"]}
+    assert utils.actor_matches_allow({"id": "root"}, other)
+    assert utils._allow_matcher_cache[id(other)] is not matcher
+
+
+def test_actor_matches_allow_modified_in_place():
+    allow = {"id": ["root"]}
+    assert utils.actor_matches_allow({"id": "bob"}, allow) is False
+    allow["id"].append("bob")
+    assert utils.actor_matches_allow({"id": "bob"}, allow) is True
+    allow["id"] = "*"
+    assert utils.actor_matches_allow({"id": "alice"}, allow) is True
+    del allow["id"]
+    assert utils.actor_matches_allow({"id": "bob"}, allow) is False
+
+
+def test_actor_matches_allow_cache_evicts_oldest(monkeypatch):
+    monkeypatch.setattr(utils, "_ALLOW_MATCHER_CACHE_SIZE", 2)
+    monkeypatch.setattr(utils, "_allow_matcher_cache", {})
+    allows = [{"id": [str(i)]} for i in range(3)]
+    for allow in allows:
+        utils.actor_matches_allow({"id": "x"}, allow)
+    assert list(utils._allow_matcher_cache) == [id(allows[1]), id(allows[2])]
 
 
 @pytest.mark.parametrize(
@@ -724,6 +795,71 @@ async def test_calculate_etag(tmp_path):
     utils._etag_cache.clear()
 
 
+@pytest.mark.asyncio
+async def test_calculate_etag_with_stat_result(tmp_path):
+    path = tmp_path / "test.txt"
+    path.write_text("hello")
+    etag = await utils.calculate_etag(path, stat_result=os.stat(path))
+    assert etag == '"5d41402abc4b2a76b9719d911017c592"'
+    # A changed file is hashed again
+    path.write_text("hello world")
+    assert etag != await utils.calculate_etag(path, stat_result=os.stat(path))
+    utils._etag_cache.clear()
+    utils._etag_stats.clear()
+
+
+@pytest.mark.parametrize(
+    "range_header,expected",
+    (
+        (None, None),
+        ("", None),
+        ("items=0-10", None),
+        ("bytes=0-99", [(0, 99)]),
+        ("bytes=900-", [(900, 999)]),
+        ("bytes=-100", [(900, 999)]),
+        ("bytes=-5000", [(0, 999)]),
+        ("bytes=990-2000", [(990, 999)]),
+        ("bytes=0-0, 10-19", [(0, 0), (10, 19)]),
+        ("bytes=1000-", []),
+        ("bytes=-0", []),
+        ("bytes=20-10", None),
+        ("bytes=a-b", None),
+    ),
+)
+def test_parse_range_header(range_header, expected):
+    assert parse_range_header(range_header, 1000) == expected
+
+
+@pytest.mark.asyncio
+async def test_asgi_send_file_zerocopy(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"0123456789")
+    messages = []
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopysend":
+            message = dict(
+                message, file=message["file"].read(), closed=message["file"].closed
+            )
+        messages.append(message)
+
+    await asgi_send_file(
+        send,
+        path,
+        range_header="bytes=2-5",
+        scope={"extensions": {"http.response.zerocopysend": {}}},
+    )
+    assert messages[0]["status"] == 206
+    assert messages[1] == {
+        "type": "http.response.zerocopysend",
+        "file": b"0123456789",
+        "closed": False,
+        "offset": 2,
+        "count": 4,
+        "more_body": False,
+    }
+
+
 @pytest.mark.parametrize(
     "dict1,dict2,expected",
     [